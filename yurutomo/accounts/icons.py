@@ -0,0 +1,167 @@
+"""
+ユーザーアイコンの変換
+
+アップロードされた画像はそのまま保存し、リクエストの外（ジョブ用のスレッド）で
+SIZES の各サイズに切り抜いて WebP と JPEG で保存する（EXIF などのメタデータは含めない）。
+元の画像は撮影場所などのメタデータを含みうるので配信しない（is_public）。
+ページには縮小版だけを出し、変換が終わるまで（User.icon_processed が False）は既定のアイコンを使う。
+
+    uploads/icon/<name>.png -> uploads/icon/<name>_48v1.webp, uploads/icon/<name>_48v1.jpg, ...
+
+ページでは srcset(user) の srcset と sizes から、ブラウザが表示サイズに合う
+最小の画像を選ぶ。
+"""
+import io
+import logging
+import os
+import posixpath
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from imagekit.processors import ResizeToFill
+from PIL import Image, ImageOps
+
+from .models import DEFAULT_USER_ICON_IMAGE
+from .storage import icon_storage, is_hashed
+
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+
+# 一辺のピクセル数
+SIZES = (48, 96, 200)
+
+# SIZES や FORMATS を変えたら上げる（縮小版の URL が変わり、キャッシュされたものを使わなくなる）
+RENDITION_VERSION = 1
+
+# (拡張子, Pillow の形式, 保存時のオプション)
+FORMATS = (
+    ('webp', 'WEBP', {'quality': 75, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 80, 'optimize': True, 'progressive': True}),
+)
+
+
+# srcset を使わない img の src（どのブラウザでも表示できる JPEG）
+FALLBACK_SIZE = max(SIZES)
+FALLBACK_EXT = 'jpg'
+
+_RENDITION_NAME = re.compile(r'_\d+v\d+\.(?:{})$'.format('|'.join(ext for ext, _, _ in FORMATS)))
+
+
+def rendition_name(name, size, ext):
+    base, _ = os.path.splitext(name)
+    return '{}_{}v{}.{}'.format(base, size, RENDITION_VERSION, ext)
+
+
+def is_public(name):
+    """ 配信してよいファイルか（アップロードされた元の画像は配信しない） """
+    upload_dir = posixpath.normpath(settings.USER_ICON_UPLOAD_DIR) + '/'
+    return not posixpath.normpath(name).startswith(upload_dir) or bool(_RENDITION_NAME.search(name))
+
+
+def render(data):
+    """
+    画像のバイト列から各サイズ・各形式のバイト列を作る
+    {(size, ext): bytes}
+    """
+    image = Image.open(io.BytesIO(data))
+    # JPEG は必要な大きさまで縮小しながら読み込む
+    image.draft('RGB', (max(SIZES) * 2, max(SIZES) * 2))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    results = {}
+    # 大きいサイズから順に縮小する（小さいサイズは前のサイズから作る）
+    source = image
+    for size in sorted(SIZES, reverse=True):
+        source = ResizeToFill(size, size).process(source)
+        for ext, image_format, options in FORMATS:
+            output = source if image_format != 'JPEG' or source.mode == 'RGB' else _flatten(source)
+            buffer = io.BytesIO()
+            output.save(buffer, image_format, **options)
+            results[(size, ext)] = buffer.getvalue()
+    return results
+
+
+# 透過部分を白にする（JPEG は透過できない）
+def _flatten(image):
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def process(name):
+    """ 保存済みのアイコン name の変換後の画像を保存する """
+    with icon_storage.open(name, 'rb') as f:
+        data = f.read()
+    for (size, ext), content in render(data).items():
+        path = rendition_name(name, size, ext)
+        # ハッシュ名の縮小版は内容が同じなので作り直さない
+        if icon_storage.exists(path):
+            if is_hashed(path):
+                continue
+            icon_storage.delete(path)
+        icon_storage.save(path, ContentFile(content))
+
+
+def process_user_icon(name):
+    """ アイコンを変換し、そのアイコンを使っているユーザーに反映する """
+    # chatrooms.roster はこのモジュールを import する
+    from chatrooms import roster
+
+    process(name)
+    users = User.objects.filter(icon_image=name, icon_processed=False)
+    user_ids = list(users.values_list('pk', flat=True))
+    users.update(icon_processed=True)
+    # ルームのメンバー表を変換後のアイコンで作り直す
+    for user_id in user_ids:
+        roster.refresh_user(user_id)
+
+
+def icon_url(user):
+    """ ページに出すアイコンの URL。変換が終わっていなければ既定のアイコン """
+    if not user.icon_processed:
+        return icon_storage.url(DEFAULT_USER_ICON_IMAGE)
+    return icon_storage.url(rendition_name(user.icon_image.name, FALLBACK_SIZE, FALLBACK_EXT))
+
+
+def srcset(user):
+    """
+    {'webp': srcset, 'jpg': srcset}
+    変換が終わっていなければ None
+    """
+    if not user.icon_processed:
+        return None
+    name = user.icon_image.name
+    return {
+        ext: ', '.join(
+            '{} {}w'.format(icon_storage.url(rendition_name(name, size, ext)), size) for size in SIZES)
+        for ext, _, _ in FORMATS
+    }
+
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'USER_ICON_WORKERS', 1), thread_name_prefix='icons')
+
+
+def _run(name):
+    close_old_connections()
+    try:
+        process_user_icon(name)
+    except Exception:
+        # icon_processed は False のまま残し、process_icons でやり直せるようにする
+        logger.exception('icon processing failed', extra={'icon': name})
+    finally:
+        close_old_connections()
+
+
+def schedule(name):
+    """ アイコンの変換をリクエストの外で行う """
+    return _executor.submit(_run, name)
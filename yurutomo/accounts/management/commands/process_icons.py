@@ -0,0 +1,31 @@
+"""
+縮小版のないユーザーアイコンを変換する
+
+    python manage.py process_icons
+
+icon_processed が False のユーザーのアイコン（既定のアイコンを含む）を
+その場で変換する。同じ画像を使うユーザーはまとめて 1 回だけ変換する。
+"""
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from accounts import icons
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Create the resized renditions of user icons that do not have them yet.'
+
+    def handle(self, *args, **options):
+        names = User.objects.filter(icon_processed=False).values_list('icon_image', flat=True).distinct()
+        count = 0
+        for name in names.iterator():
+            try:
+                icons.process_user_icon(name)
+            except (OSError, ValueError) as e:
+                self.stderr.write('{}: {}'.format(name, e))
+                continue
+            count += 1
+        self.stdout.write('processed {} icons'.format(count))
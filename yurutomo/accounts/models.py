@@ -8,8 +8,8 @@ from django.core.mail import send_mail
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from django.contrib.auth.validators import UnicodeUsernameValidator
-from imagekit.models import ProcessedImageField
-from imagekit.processors import ResizeToFill
+
+from .storage import icon_storage, file_digest
 
 
 # Default user icon image ( /media/DEFAULT_USER_ICON_IMAGE )
@@ -17,8 +17,9 @@ DEFAULT_USER_ICON_IMAGE = 'default-user-icon.png'
 
 def _user_icon_image_upload_to(instance, filename):
     path = settings.USER_ICON_UPLOAD_DIR
-    ext = str(filename).split('.')[-1]
-    name = str(uuid4()) + '.' + ext
+    ext = str(filename).split('.')[-1].lower()
+    # 内容のハッシュをファイル名にする（内容が変われば URL も変わる）
+    name = file_digest(instance.icon_image) + '.' + ext
     return '{}/{}'.format(path, name)
 
 # Create your models here.
@@ -63,13 +64,18 @@ class User(AbstractBaseUser, PermissionsMixin):
         validators=[username_validator],
     )
 
-    icon_image = ProcessedImageField(
+    # アップロードされた画像をそのまま保存する（縮小は accounts.icons でリクエストの外で行う）
+    # 元の画像はメタデータを含みうるので配信せず、ページには icon_url を使う
+    icon_image = models.ImageField(
         upload_to=_user_icon_image_upload_to,
-        processors=[ResizeToFill(200, 200)],
-        format='JPEG',
-        options={'quality': 60},
+        storage=icon_storage,
         default=DEFAULT_USER_ICON_IMAGE
     )
+    # icon_image の縮小版（accounts.icons.SIZES）を作成済みか
+    icon_processed = models.BooleanField(
+        _('icon processed'),
+        default=False,
+    )
 
     is_staff = models.BooleanField(
         _('staff status'),
@@ -88,6 +94,13 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     objects = UserManager()
 
+    @property
+    def icon_url(self):
+        """ ページに出すアイコン（縮小版）の URL """
+        # accounts.icons はこのモジュールを import する
+        from . import icons
+        return icons.icon_url(self)
+
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = []
 
@@ -0,0 +1,90 @@
+"""
+ユーザーアイコンの保存先
+
+アップロードされたアイコンはファイル名を内容のハッシュにする（<sha256 の先頭 32 文字>.<拡張子>）。
+内容が変われば URL も変わるので、ブラウザに期限なしでキャッシュさせられる。
+同じ内容のファイルは同じ名前になるので、既にあれば書き込まない。
+
+ハッシュ名でないファイル（既定のアイコンや以前の uuid 名のファイル）は
+URL に ?v=<内容のハッシュ> を付ける。
+"""
+import hashlib
+import os
+import re
+import threading
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+DIGEST_LENGTH = 32
+
+# ハッシュ名のファイル（縮小版 <hash>_48v1.webp なども含む）
+_HASHED_NAME = re.compile(r'^[0-9a-f]{%d}[._]' % DIGEST_LENGTH)
+
+
+def file_digest(f):
+    """ ファイルの内容のハッシュ（16 進） """
+    digest = hashlib.sha256()
+    for chunk in f.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+def is_hashed(name):
+    return bool(_HASHED_NAME.match(os.path.basename(name)))
+
+
+@deconstructible
+class IconStorage(FileSystemStorage):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        # name -> (mtime, digest)
+        self._digests = {}
+
+    def get_available_name(self, name, max_length=None):
+        # ハッシュ名なら同じ名前のファイルは同じ内容（上書きしない）
+        if is_hashed(name):
+            return name
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if is_hashed(name) and self.exists(name):
+            return name
+        return super()._save(name, content)
+
+    def digest(self, name):
+        """ ハッシュ名でないファイルの内容のハッシュ（更新されるまで覚えておく） """
+        try:
+            mtime = self.get_modified_time(name)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._digests.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with self.open(name, 'rb') as f:
+            digest = file_digest(f)
+        with self._lock:
+            self._digests[name] = (mtime, digest)
+        return digest
+
+    def is_immutable(self, name, version=None):
+        """ name（?v=version）の URL の内容が変わらないか """
+        if is_hashed(name):
+            return True
+        return version is not None and version == self.digest(name)
+
+    def url(self, name):
+        url = super().url(name)
+        if is_hashed(name):
+            return url
+        digest = self.digest(name)
+        if digest is None:
+            return url
+        return '{}?v={}'.format(url, digest)
+
+
+icon_storage = IconStorage()
@@ -1,3 +1,110 @@
-from django.test import TestCase
+import io
+import logging
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from PIL import Image
+
+from . import icons
+from .storage import file_digest, icon_storage, is_hashed
+
+User = get_user_model()
+
+
+def _image_bytes(size=(640, 480), mode='RGB', image_format='PNG'):
+    buffer = io.BytesIO()
+    Image.new(mode, size, (200, 100, 50) if mode == 'RGB' else (200, 100, 50, 128)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+# アイコンの変換のテスト
+class IconTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_render(self):
+        results = icons.render(_image_bytes(mode='RGBA'))
+        self.assertEqual(set(results), {(size, ext) for size in icons.SIZES for ext, _, _ in icons.FORMATS})
+        for (size, ext), data in results.items():
+            image = Image.open(io.BytesIO(data))
+            self.assertEqual(image.size, (size, size))
+            self.assertEqual(image.format, 'WEBP' if ext == 'webp' else 'JPEG')
+
+    def test_process_user_icon(self):
+        name = icon_storage.save('uploads/icon/test.png', ContentFile(_image_bytes()))
+        user = User.objects.create_user('testuser', password='password', icon_image=name)
+        self.assertIsNone(icons.srcset(user))
+
+        icons.process_user_icon(name)
+        user.refresh_from_db()
+        self.assertTrue(user.icon_processed)
+        self.assertTrue(icon_storage.exists('uploads/icon/test_48v1.webp'))
+        self.assertIn('test_96v1.jpg?v=', icons.srcset(user)['jpg'])
+
+    # ページには元の画像を出さない（変換が終わるまでは既定のアイコン）
+    def test_icon_url(self):
+        icon_storage.save('default-user-icon.png', ContentFile(_image_bytes()))
+        name = icon_storage.save('uploads/icon/test.png', ContentFile(_image_bytes()))
+        user = User.objects.create_user('testuser', password='password', icon_image=name)
+        self.assertIn('default-user-icon.png', user.icon_url)
+
+        icons.process_user_icon(name)
+        user.refresh_from_db()
+        self.assertIn('uploads/icon/test_200v1.jpg', user.icon_url)
+
+    # 変換に失敗したらログに出し、process_icons でやり直せるように残す
+    def test_schedule_failure(self):
+        name = icon_storage.save('uploads/icon/test.png', ContentFile(_image_bytes()))
+        user = User.objects.create_user('testuser', password='password', icon_image=name)
+        with mock.patch.object(icons, 'process', side_effect=OSError('broken')), \
+                self.assertLogs('accounts.icons', logging.ERROR):
+            icons.schedule(name).result()
+        user.refresh_from_db()
+        self.assertFalse(user.icon_processed)
+
+    # 内容のハッシュ名の URL は変わらない
+    def test_hashed_name(self):
+        data = _image_bytes()
+        name = 'uploads/icon/{}.png'.format(file_digest(ContentFile(data)))
+        self.assertTrue(is_hashed(name))
+        self.assertEqual(icon_storage.save(name, ContentFile(data)), name)
+        # 同じ内容なら同じ名前のまま
+        self.assertEqual(icon_storage.save(name, ContentFile(data)), name)
+        self.assertNotIn('?v=', icon_storage.url(name))
+        self.assertTrue(icon_storage.is_immutable(name))
+
+    # ハッシュ名でないファイルは ?v= を付ける
+    def test_versioned_url(self):
+        name = icon_storage.save('default-user-icon.png', ContentFile(_image_bytes()))
+        version = icon_storage.url(name).split('?v=')[1]
+        self.assertTrue(icon_storage.is_immutable(name, version))
+        self.assertFalse(icon_storage.is_immutable(name, 'stale'))
+        self.assertFalse(icon_storage.is_immutable(name))
+
+    # ファイルの中身は Web サーバーに送らせる
+    @override_settings(MEDIA_SENDFILE='x-accel-redirect', MEDIA_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_serve_media(self):
+        data = _image_bytes()
+        name = icon_storage.save('uploads/icon/{}.png'.format(file_digest(ContentFile(data))), ContentFile(data))
+        icons.process(name)
+        rendition = icons.rendition_name(name, 200, 'jpg')
+        response = self.client.get('/media/' + rendition)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + rendition)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response.content, b'')
+        self.assertIn('immutable', response['Cache-Control'])
+        # アップロードされた元の画像は配信しない
+        self.assertEqual(self.client.get('/media/' + name).status_code, 404)
+
+        legacy = icon_storage.save('default-user-icon.png', ContentFile(data))
+        self.assertNotIn('immutable', self.client.get('/media/' + legacy)['Cache-Control'])
+        self.assertIn('immutable', self.client.get(icon_storage.url(legacy))['Cache-Control'])
+        self.assertEqual(self.client.get('/media/../settings.py').status_code, 404)
@@ -15,6 +15,8 @@ from django.template.loader import render_to_string
 from django.utils.crypto import get_random_string
 
 
+from chatrooms import roster
+from . import icons
 from .forms import UserCreateForm, LoginForm, CustomUserChangeForm, ProfileForm
 
 
@@ -131,7 +133,17 @@ class ProfileUpdateView(LoginRequiredMixin, UserPassesTestMixin, generic.UpdateV
 
     def form_valid(self, form):
         messages.success(self.request, '正常に更新されました')
-        return super().form_valid(form)
+        icon_changed = 'icon_image' in form.changed_data
+        if icon_changed:
+            # 縮小版ができるまでは既定のアイコンを表示する（元の画像は配信しない）
+            form.instance.icon_processed = False
+        response = super().form_valid(form)
+        # 入っているルームのメンバー表に新しい名前とアイコンを反映する
+        roster.refresh_user(self.object.pk)
+        if icon_changed:
+            # 縮小はリクエストの外で行う（終わったらメンバー表を作り直す）
+            icons.schedule(self.object.icon_image.name)
+        return response
 
     def form_invalid(self, form):
         messages.warning(self.request, '更新に失敗しました')
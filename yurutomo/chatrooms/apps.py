@@ -1,5 +1,22 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_migrate
+
+
+# トピック検索のインデックスに使う pg_trgm を有効にする
+def create_trigram_extension(sender, using, **kwargs):
+    from django.db import connections
+
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
 
 
 class ChatroomsConfig(AppConfig):
     name = 'chatrooms'
+
+    def ready(self):
+        pre_migrate.connect(create_trigram_extension, sender=self)
+        # トピック補完のシグナルを登録
+        from . import autocomplete  # noqa: F401
@@ -0,0 +1,217 @@
+"""
+トピック名の前方一致補完
+
+Topic.name と Tag.name を正規化したキーのソート済み配列をメモリ上に持ち、
+bisect で前方一致するものを取り出す。DB には問い合わせない。
+最初に使われたときに DB から作り、以降はシグナルで差分を反映する。
+
+正規化は Topic.clean() と同じく空白を取り除いたうえで、
+NFKC で全角英数字・半角カナをそろえ、大文字小文字を区別しない。
+"""
+import bisect
+import threading
+import unicodedata
+from collections import defaultdict
+
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import Topic, Tag
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKC', str(text))
+    return "".join(text.split()).casefold()
+
+
+class PrefixIndex:
+    """ (キー, 値) のソート済み配列 """
+
+    def __init__(self):
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, value):
+        entry = (key, value)
+        i = bisect.bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            return
+        self._entries.insert(i, entry)
+
+    def remove(self, key, value):
+        entry = (key, value)
+        i = bisect.bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            del self._entries[i]
+
+    def search(self, prefix):
+        """ prefix で始まるキーの値をキー順に返す """
+        i = bisect.bisect_left(self._entries, (prefix,))
+        while i < len(self._entries):
+            key, value = self._entries[i]
+            if not key.startswith(prefix):
+                break
+            yield value
+            i += 1
+
+
+class TopicSuggester:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index = PrefixIndex()
+        # topic_id -> (キー, data)
+        self._topics = {}
+        # tag_id -> キー
+        self._tags = {}
+        # tag_id -> {topic_id, ...}
+        self._tag_topics = defaultdict(set)
+        self._loaded = False
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def clear(self):
+        with self._lock:
+            self._index = PrefixIndex()
+            self._topics.clear()
+            self._tags.clear()
+            self._tag_topics.clear()
+            self._loaded = False
+
+    def load(self):
+        """ DB から作り直す """
+        with self._lock:
+            self.clear()
+            for topic in Topic.objects.all():
+                self.set_topic(topic)
+            for tag in Tag.objects.all():
+                self.set_tag(tag)
+            for topic_id, tag_id in Topic.tags.through.objects.values_list('topic', 'tag'):
+                self._tag_topics[tag_id].add(topic_id)
+            self._loaded = True
+
+    def set_topic(self, topic):
+        with self._lock:
+            self.remove_topic(topic.pk)
+            key = normalize(topic.name)
+            self._topics[topic.pk] = (key, topic.data())
+            self._index.add(key, (0, topic.pk))
+
+    def remove_topic(self, topic_id):
+        with self._lock:
+            old = self._topics.pop(topic_id, None)
+            if old is not None:
+                self._index.remove(old[0], (0, topic_id))
+
+    def set_tag(self, tag):
+        with self._lock:
+            self.remove_tag(tag.pk, keep_topics=True)
+            key = normalize(tag.name)
+            self._tags[tag.pk] = key
+            self._index.add(key, (1, tag.pk))
+
+    def remove_tag(self, tag_id, keep_topics=False):
+        with self._lock:
+            key = self._tags.pop(tag_id, None)
+            if key is not None:
+                self._index.remove(key, (1, tag_id))
+            if not keep_topics:
+                self._tag_topics.pop(tag_id, None)
+
+    def set_tag_topics(self, tag_id, topic_ids, add=True):
+        with self._lock:
+            if add:
+                self._tag_topics[tag_id].update(topic_ids)
+            else:
+                self._tag_topics[tag_id].difference_update(topic_ids)
+
+    def suggest(self, prefix, limit):
+        """
+        前方一致するトピックを最大 limit 件返す
+        トピック名の一致を先に、タグの一致を後に並べる
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        with self._lock:
+            topic_ids = []
+            tag_topic_ids = []
+            for kind, pk in self._index.search(prefix):
+                if kind == 0:
+                    topic_ids.append(pk)
+                    if len(topic_ids) >= limit:
+                        break
+                else:
+                    tag_topic_ids.extend(sorted(self._tag_topics.get(pk, ())))
+
+            result = []
+            seen = set()
+            for topic_id in topic_ids + tag_topic_ids:
+                if topic_id in seen or topic_id not in self._topics:
+                    continue
+                seen.add(topic_id)
+                result.append(self._topics[topic_id][1])
+                if len(result) >= limit:
+                    break
+            return result
+
+
+suggester = TopicSuggester()
+
+
+def suggest(prefix, limit):
+    if not suggester.loaded:
+        suggester.load()
+    return suggester.suggest(prefix, limit)
+
+
+# モデルの変更を反映する
+# まだ作っていなければ何もしない（最初に使うときに DB から作る）
+@receiver(post_save, sender=Topic)
+def _topic_saved(sender, instance, **kwargs):
+    if suggester.loaded:
+        suggester.set_topic(instance)
+
+
+@receiver(post_delete, sender=Topic)
+def _topic_deleted(sender, instance, **kwargs):
+    if suggester.loaded:
+        suggester.remove_topic(instance.pk)
+
+
+@receiver(post_save, sender=Tag)
+def _tag_saved(sender, instance, **kwargs):
+    if suggester.loaded:
+        suggester.set_tag(instance)
+
+
+@receiver(post_delete, sender=Tag)
+def _tag_deleted(sender, instance, **kwargs):
+    if suggester.loaded:
+        suggester.remove_tag(instance.pk)
+
+
+@receiver(m2m_changed, sender=Topic.tags.through)
+def _topic_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not suggester.loaded:
+        return
+    if action == 'post_clear':
+        # clear は pk_set がないので作り直す
+        suggester.load()
+        return
+    if action not in ('post_add', 'post_remove'):
+        return
+
+    add = action == 'post_add'
+    if reverse:
+        # tag.topic_set.add(topics)
+        suggester.set_tag_topics(instance.pk, pk_set, add)
+    else:
+        # topic.tags.add(tags)
+        for tag_id in pk_set:
+            suggester.set_tag_topics(tag_id, [instance.pk], add)
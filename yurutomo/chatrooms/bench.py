@@ -0,0 +1,89 @@
+"""
+ベンチマーク・負荷試験の集計
+
+計測した時間（秒）のリストを ms のパーセンタイルにまとめる。
+結果は JSON にできる dict で返すので、コミット間で比較できる。
+"""
+import math
+import threading
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+def percentile(ordered, p):
+    """ ソート済みのリストの p パーセンタイル（最近傍法） """
+    if not ordered:
+        return None
+    k = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[k]
+
+
+def _ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 3)
+
+
+def summarize(seconds):
+    """ 時間（秒）のリストを件数・平均・p50/p95/p99・最大（ms）にまとめる """
+    ordered = sorted(seconds)
+    return {
+        'count': len(ordered),
+        'mean_ms': _ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': _ms(percentile(ordered, 50)),
+        'p95_ms': _ms(percentile(ordered, 95)),
+        'p99_ms': _ms(percentile(ordered, 99)),
+        'max_ms': _ms(ordered[-1]) if ordered else None,
+    }
+
+
+def format_summary(summary):
+    """ summarize() の結果を 1 行で表示する """
+    if not summary['count']:
+        return 'n=0'
+    return 'n={count} mean={mean_ms}ms p50={p50_ms}ms p95={p95_ms}ms p99={p99_ms}ms max={max_ms}ms'.format(
+        **summary)
+
+
+class QueryCounter:
+    """
+    全スレッドの DB 接続で実行されたクエリを数える
+
+    CaptureQueriesContext は呼び出したスレッドの接続しか見ないので、
+    database_sync_to_async のスレッドで開かれた接続にも execute_wrapper を付ける。
+    with の前から他のスレッドで開いている接続は数えられないので、最初に作ること。
+
+        with QueryCounter() as counter:
+            ...
+        counter.count
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = False
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if self._active:
+            with self._lock:
+                self.count += 1
+        return execute(sql, params, many, context)
+
+    def _wrap(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def _connection_created(self, sender, connection, **kwargs):
+        self._wrap(connection)
+
+    def __enter__(self):
+        self._active = True
+        connection_created.connect(self._connection_created)
+        for connection in connections.all():
+            self._wrap(connection)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._active = False
+        connection_created.disconnect(self._connection_created)
@@ -0,0 +1,257 @@
+"""
+ルームの承認カウンタ
+
+ルームごとにメンバー・承認済みユーザー・キャンセルフラグを Redis に持ち、
+承認やキャンセルを Redis だけで処理する。
+最後に承認したユーザーのリクエストが、メンバー全員へ完了を通知する。
+MatchingRecord への書き込みは persist() でリクエストの外に逃がす。
+
+Redis には channels_redis のチャンネルレイヤーの接続を使う。
+チャンネルレイヤーが Redis でなければプロセス内のストアで代用する。
+
+settings.ROOM_CONFIRMATION_COUNTERS が False なら使わない。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import notifications, popularity
+
+
+# confirm() の結果
+UNKNOWN = -1        # カウンタのないルーム、またはメンバーでない
+CANCELLED = -2      # キャンセル済み
+PENDING = 0         # 他のメンバーの承認待ち
+COMPLETED = 1       # 既に全員承認済み
+COMPLETED_NOW = 2   # この承認で全員そろった
+
+KEY_PREFIX = 'yurutomo:room:'
+
+
+def is_enabled():
+    return getattr(settings, 'ROOM_CONFIRMATION_COUNTERS', False)
+
+
+def _ttl():
+    return getattr(settings, 'ROOM_CONFIRMATION_TTL', 600)
+
+
+def _keys(room_id):
+    prefix = '{}{}:'.format(KEY_PREFIX, room_id)
+    return [prefix + 'members', prefix + 'confirmed', prefix + 'cancelled']
+
+
+# KEYS: members, confirmed, cancelled  ARGV: user_id, ttl
+CONFIRM_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then return -1 end
+if redis.call('EXISTS', KEYS[3]) == 1 then return -2 end
+local added = redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+if redis.call('SCARD', KEYS[2]) < redis.call('SCARD', KEYS[1]) then return 0 end
+if added == 1 then return 2 end
+return 1
+"""
+
+# KEYS: members, confirmed, cancelled  ARGV: user_id, ttl
+CANCEL_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then return -1 end
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('SET', KEYS[3], 1, 'NX', 'EX', ARGV[2]) then return 1 end
+return 0
+"""
+
+# KEYS: members, confirmed, cancelled  ARGV: user_id
+STATUS_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then return -1 end
+if redis.call('EXISTS', KEYS[3]) == 1 then return -2 end
+if redis.call('SCARD', KEYS[2]) < redis.call('SCARD', KEYS[1]) then return 0 end
+return 1
+"""
+
+
+class RedisStore:
+    """ channels_redis のコネクションプールを使うストア """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    def _connection(self, room_id):
+        # 同じルームのキーは同じシャードに置く
+        index = self.channel_layer.consistent_hash(str(room_id))
+        return self.channel_layer.connection(index)
+
+    async def open_room(self, room_id, user_ids):
+        members, confirmed, cancelled = _keys(room_id)
+        async with self._connection(room_id) as connection:
+            transaction = connection.multi_exec()
+            transaction.delete(members, confirmed, cancelled)
+            transaction.sadd(members, *[str(user_id) for user_id in user_ids])
+            transaction.expire(members, _ttl())
+            await transaction.execute()
+
+    async def _eval(self, room_id, script, *args):
+        async with self._connection(room_id) as connection:
+            return await connection.eval(script, keys=_keys(room_id), args=list(args))
+
+    async def confirm(self, room_id, user_id):
+        return await self._eval(room_id, CONFIRM_SCRIPT, str(user_id), _ttl())
+
+    async def withdraw(self, room_id, user_id):
+        confirmed = _keys(room_id)[1]
+        async with self._connection(room_id) as connection:
+            return bool(await connection.srem(confirmed, str(user_id)))
+
+    async def cancel(self, room_id, user_id):
+        return await self._eval(room_id, CANCEL_SCRIPT, str(user_id), _ttl())
+
+    async def status(self, room_id, user_id):
+        return await self._eval(room_id, STATUS_SCRIPT, str(user_id))
+
+    async def members(self, room_id):
+        async with self._connection(room_id) as connection:
+            return [member.decode() for member in await connection.smembers(_keys(room_id)[0])]
+
+
+class MemoryStore:
+    """ プロセス内のストア（チャンネルレイヤーが Redis でない場合） """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # room_id -> {'members': set, 'confirmed': set, 'cancelled': bool}
+        self._rooms = {}
+
+    def _room(self, room_id, user_id):
+        room = self._rooms.get(str(room_id))
+        if room is None or str(user_id) not in room['members']:
+            return None
+        return room
+
+    async def open_room(self, room_id, user_ids):
+        with self._lock:
+            self._rooms[str(room_id)] = {
+                'members': {str(user_id) for user_id in user_ids},
+                'confirmed': set(),
+                'cancelled': False,
+            }
+
+    async def confirm(self, room_id, user_id):
+        with self._lock:
+            room = self._room(room_id, user_id)
+            if room is None:
+                return UNKNOWN
+            if room['cancelled']:
+                return CANCELLED
+            added = str(user_id) not in room['confirmed']
+            room['confirmed'].add(str(user_id))
+            if len(room['confirmed']) < len(room['members']):
+                return PENDING
+            return COMPLETED_NOW if added else COMPLETED
+
+    async def withdraw(self, room_id, user_id):
+        with self._lock:
+            room = self._room(room_id, user_id)
+            if room is None or str(user_id) not in room['confirmed']:
+                return False
+            room['confirmed'].discard(str(user_id))
+            return True
+
+    async def cancel(self, room_id, user_id):
+        with self._lock:
+            room = self._room(room_id, user_id)
+            if room is None:
+                return UNKNOWN
+            room['confirmed'].discard(str(user_id))
+            if room['cancelled']:
+                return 0
+            room['cancelled'] = True
+            return 1
+
+    async def status(self, room_id, user_id):
+        with self._lock:
+            room = self._room(room_id, user_id)
+            if room is None:
+                return UNKNOWN
+            if room['cancelled']:
+                return CANCELLED
+            if len(room['confirmed']) < len(room['members']):
+                return PENDING
+            return COMPLETED
+
+    async def members(self, room_id):
+        with self._lock:
+            room = self._rooms.get(str(room_id))
+            return list(room['members']) if room else []
+
+
+_stores = {}
+
+
+def get_store():
+    channel_layer = get_channel_layer()
+    store = _stores.get(id(channel_layer))
+    if store is None:
+        if hasattr(channel_layer, 'consistent_hash'):
+            store = RedisStore(channel_layer)
+        else:
+            store = MemoryStore()
+        _stores[id(channel_layer)] = store
+    return store
+
+
+# ルーム作成時にメンバーを登録
+async def open_room(room_id, user_ids):
+    await get_store().open_room(room_id, user_ids)
+
+
+async def confirm(room_id, user_id):
+    """
+    承認する
+    この承認で全員そろったらメンバー全員に完了を通知し、人気度に加算する
+    """
+    result = await get_store().confirm(room_id, user_id)
+    if result == COMPLETED_NOW:
+        persist(popularity.record_completion, user_id)
+        members = await get_store().members(room_id)
+        await notifications.send_room_status(room_id, 'completed', members)
+    return result
+
+
+# 承認を取り消す
+async def withdraw(room_id, user_id):
+    return await get_store().withdraw(room_id, user_id)
+
+
+async def cancel(room_id, user_id):
+    """
+    ルームをキャンセルする
+    最初のキャンセルでメンバー全員に通知する
+    """
+    result = await get_store().cancel(room_id, user_id)
+    if result == 1:
+        members = await get_store().members(room_id)
+        await notifications.send_room_status(room_id, 'cancelled', members)
+    return result
+
+
+# 承認状態（UNKNOWN / CANCELLED / PENDING / COMPLETED）
+async def get_status(room_id, user_id):
+    return await get_store().status(room_id, user_id)
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='confirmations')
+
+
+def _run(func, args):
+    close_old_connections()
+    try:
+        func(*args)
+    finally:
+        close_old_connections()
+
+
+def persist(func, *args):
+    """ MatchingRecord の更新をリクエストの外で行う """
+    _executor.submit(_run, func, args)
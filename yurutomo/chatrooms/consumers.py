@@ -1,17 +1,23 @@
-import json
 import uuid
 import copy
 import datetime
 import asyncio
+import logging
+import random
+import time
+from django.conf import settings
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth import get_user_model
 from django.dispatch import receiver
-from channels.db import database_sync_to_async
+from channels.db import DatabaseSyncToAsync
 from channels.generic.websocket import AsyncWebsocketConsumer
 
 
-from .models import Room, MatchingRecord
+from .models import MatchingRecord, Topic
+from . import confirmations, matching, notifications, popularity, protocol
+from .ratelimit import RateLimiter
+from .metrics import registry
 
 # from asgiref.sync import async_to_sync  # async_to_sync() : 非同期関数を同期的に実行する際に使用する
 
@@ -20,20 +26,82 @@ User = get_user_model()
 
 USERNAME_SYSTEM = '*system*'
 
+logger = logging.getLogger(__name__)
+
+CONNECTIONS = registry.gauge(
+    'chatrooms_ws_connections', 'Open WebSocket connections.', ['consumer'])
+MESSAGES = registry.counter(
+    'chatrooms_ws_messages', 'WebSocket messages received.', ['method'])
+HANDLER_DURATION = registry.histogram(
+    'chatrooms_ws_handler_duration_seconds', 'Time to handle a WebSocket message.', ['method'])
+RATE_LIMITED = registry.counter(
+    'chatrooms_ws_rate_limited', 'WebSocket messages dropped by the rate limiter.', ['method'])
+COALESCED = registry.counter(
+    'chatrooms_ws_coalesced', 'WebSocket requests answered by a request already in flight.', ['method'])
+GROUP_SIZE = registry.histogram(
+    'chatrooms_ws_group_size', 'Members of the room groups consumers join.',
+    buckets=(2, 3, 4, 5, 6, 8, 10, 15, 20))
+
+
+def _method_label(method):
+    # 任意の値をラベルにしない（リストなどは辞書を引けないので先に除く）
+    return method if isinstance(method, str) and method in protocol.METHOD_CODES else 'unknown'
+
+
+def _sampled():
+    """ メッセージごとのログは WS_LOG_SAMPLE_RATE の割合だけ出す """
+    return random.random() < getattr(settings, 'WS_LOG_SAMPLE_RATE', 0.01)
+
+
+# user_id -> このプロセスで開いている MatchingConsumer の数
+# 待ち行列（matching.engine）もプロセスごとなので、プロセス内で数えれば足りる
+_open_connections = {}
+
+
+def _acquire(user_id):
+    _open_connections[user_id] = _open_connections.get(user_id, 0) + 1
+
+
+def _release(user_id):
+    """ 接続の数を減らし、そのユーザーの最後の接続だったら True """
+    count = _open_connections.get(user_id, 0) - 1
+    if count > 0:
+        _open_connections[user_id] = count
+        return False
+    _open_connections.pop(user_id, None)
+    return True
+
+
+def db_call(func):
+    """
+    1 メッセージ分の DB 処理をまとめて 1 回で実行する
+    thread_sensitive=False でスレッドプールに逃がし、
+    既定の単一スレッドに全コンシューマーの DB 処理が並ばないようにする
+    """
+    return DatabaseSyncToAsync(func, thread_sensitive=False)
+
 class UserConsumer(AsyncWebsocketConsumer):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.user_id = ''
         self.group_id = ''
+        self.codec = protocol.JSON
+        self.connected = False
 
     
     async def connect(self):
         self.user_id = self.scope['user'].pk
-        await self.accept()
+        # msgpack を指定されていればバイナリでやり取りする
+        self.codec = protocol.negotiate(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.connected = True
+        CONNECTIONS.labels(type(self).__name__).inc()
     
     async def disconnect(self, code):
-        pass
+        if self.connected:
+            self.connected = False
+            CONNECTIONS.labels(type(self).__name__).dec()
 
     # グループに参加
     async def join_group(self, group_id):
@@ -46,282 +114,331 @@ class UserConsumer(AsyncWebsocketConsumer):
         await self.channel_layer.group_discard(self.group_id, self.channel_name)
         self.group_id = ''
     
+    # 接続ごとの形式で送信
+    async def send_data(self, data):
+        await self.send(**self.codec.encode(data))
+
+    # protocol.encode_frames で作成済みのフレームを送信（なければ data を変換）
+    async def send_frames(self, frames, data):
+        raw = frames.get(self.codec.name) if frames else None
+        if raw is None:
+            await self.send_data(data)
+            return
+        await self.send(**self.codec.frame(raw))
+
     # タイムスタンプ付きメッセージ送信
     async def send_info(self, message, **kwargs):
         data = {
             'message': message,
-            'datetime': '{:%d-%m-%Y:%H:%M:%S}.{:06d}'.format(timezone.localtime(timezone.now()), timezone.now().microsecond),
+            'datetime': self.codec.timestamp(),
         }
 
         for k, v in kwargs.items():
-            kwargs[k] = str(v)
+            if not isinstance(v, str):
+                kwargs[k] = str(v)
         data.update(kwargs)
-        await self.send(text_data=json.dumps(data))
+        await self.send_data(data)
 
-    # メッセージ送信
+    # メッセージ送信（group_send から）
     async def send_message(self, data):
-        data_json = {
+        await self.send_frames(data.get('frames'), {
             'message': data['message'],
-            'datetime': '{:%d-%m-%Y:%H:%M:%S}.{:06d}'.format(timezone.localtime(timezone.now()), timezone.now().microsecond),
-        }
-        await self.send(text_data=json.dumps(data_json))
+            'datetime': self.codec.timestamp(),
+        })
 
     
 class MatchingConsumer(UserConsumer):
 
+    # method -> ハンドラー
+    handlers = {
+        'start_wait': 'on_start_wait',
+        'quit_wait': 'on_quit_wait',
+        'get_room': 'on_get_room',
+        'status': 'on_status',
+        'confirm_matching': 'on_confirm_matching',
+        'heartbeat': 'on_heartbeat',
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.rate_limiter = RateLimiter()
+        # 実行中の get_room（同じ接続からの get_room はこの結果を待つ）
+        self.get_room_task = None
+        # get_room の結果を待って返信するタスク
+        self.get_room_waiters = set()
+        # 最後に last_seen を更新した時刻（time.monotonic）
+        self.last_touched = None
 
     # WebSocket接続時
     async def connect(self):
         await super().connect()
-        await self.join_group(self.user_id)
+        if self.user_id:
+            _acquire(self.user_id)
+        await self.join_group(str(self.user_id))
 
     # WebSocket切断時
     async def disconnect(self, close_code):
-        print('DISCONNECT', close_code)
+        try:
+            for task in list(self.get_room_waiters) + [self.get_room_task]:
+                if task is not None:
+                    task.cancel()
+            # 最後の接続が切れたユーザーはすぐに待ち行列から外す（レコードは reaper が無効にする）
+            # 同じユーザーの別のタブの接続が残っていれば外さない
+            # 再接続して get_room かハートビートを送れば並び直す
+            if self.connected and self.user_id and _release(self.user_id):
+                await self.leave_queue()
+        finally:
+            # 待ち行列から外せなくても接続数のゲージは減らす
+            await super().disconnect(close_code)
+        logger.info('ws disconnect', extra={'user_id': str(self.user_id), 'code': close_code})
 
     # WebSocketからデータ受信時
     async def receive(self, text_data=None, bytes_data=None):
-        text_data_json = json.loads(text_data)
+        text_data_json = self.codec.decode(text_data, bytes_data)
+        if text_data_json is None:
+            await self.send_info('invalid message')
+            return
         method = text_data_json.get('method')
+        label = _method_label(method)
+
+        start = time.perf_counter()
+        deferred = None
+        try:
+            deferred = await self.handle_method(method, text_data_json)
+        finally:
+            # 返信をタスクに回したハンドラーは、そのタスクが終わったときに記録する
+            if isinstance(deferred, asyncio.Future):
+                deferred.add_done_callback(lambda _: self.record_message(label, start))
+            else:
+                self.record_message(label, start)
+
+    def record_message(self, label, start):
+        duration = time.perf_counter() - start
+        MESSAGES.labels(label).inc()
+        HANDLER_DURATION.labels(label).observe(duration)
+        if _sampled():
+            logger.info('ws message', extra={
+                'user_id': str(self.user_id), 'method': label, 'duration_ms': round(duration * 1000, 3)})
+
+    async def handle_method(self, method, text_data_json):
+        """ ハンドラーを実行する。返信をタスクに回した場合はそのタスクを返す """
+        # リストなどの辞書を引けない値も知らない method として扱う
+        handler = self.handlers.get(method) if isinstance(method, str) else None
+        if handler is None:
+            await self.send_info('unknown method')
+            return
 
-        if method == 'start_wait':
-            print(f'Got data from {self.user_id}. method: "start_wait"')
-            
-            condition = text_data_json.get('condition')
-            submission_time = timezone.now()
+        # 1 つの接続が DB のスレッドプールを使い切らないようにする
+        if not self.rate_limiter.allow(method):
+            RATE_LIMITED.labels(method).inc()
+            await self.send_info('rate limited', method=method)
+            return
 
-            # マッチング登録
-            is_registered = await self.register_matching(condition, submission_time)
-            if not is_registered:
-                await self.send_info('fail to register')
-                return
-            
-            await self.send_info('registered!')
+        return await getattr(self, handler)(text_data_json)
 
+    async def on_start_wait(self, text_data_json):
+        condition = text_data_json.get('condition')
+        submission_time = timezone.now()
 
-        elif method == 'quit_wait':
-            print(f'Got data from {self.user_id}. method: "quit_wait"')
+        # マッチング登録
+        is_registered = await self.register_matching(condition, submission_time)
+        if not is_registered:
+            await self.send_info('fail to register')
+            return
+        
+        await self.send_info('registered!')
 
-            # マッチングの登録解除
-            is_unregistered = await self.unregister_matching()
-            if not is_registered:
-                await self.send_info('fail to unregister.')
-                return
-            
-            await self.send_info('unregistered!')
+    async def on_quit_wait(self, text_data_json):
+        # マッチングの登録解除
+        is_unregistered = await self.unregister_matching()
+        if not is_unregistered:
+            await self.send_info('fail to unregister.')
+            return
         
-        elif method == 'get_room':
-            print(f'Got data from {self.user_id}. method: "get_room"')
-
-            try:
-                room_id = await self.get_match_room()
-            except ObjectDoesNotExist as e:
-                print(e)
-                await self.send_info('error', error=e)
-                return
-            
-            print(room_id)
-            if room_id is None:
-                await self.send_info('now waiting...')
-                return
-            
-            # 保留状態にする
-            await self.pending()
-            
+        await self.send_info('unregistered!')
+
+    async def on_get_room(self, text_data_json):
+        """
+        get_room はバックグラウンドで実行し、次のメッセージを受け取れるようにする
+        実行中に届いた get_room は新たに DB を引かず、実行中の結果を返す
+        返信するタスクを返す（メトリクスは返信までの時間を記録する）
+        """
+        if self.get_room_task is None:
+            self.get_room_task = asyncio.ensure_future(self.find_room())
+            self.get_room_task.add_done_callback(self._get_room_done)
+        else:
+            COALESCED.labels('get_room').inc()
+
+        waiter = asyncio.ensure_future(self.reply_room(self.get_room_task))
+        self.get_room_waiters.add(waiter)
+        waiter.add_done_callback(self.get_room_waiters.discard)
+        return waiter
+
+    def _get_room_done(self, task):
+        if self.get_room_task is task:
+            self.get_room_task = None
+
+    # マッチングしたルームを探し、あればそのグループに参加する
+    async def find_room(self):
+        room_id = await self.get_match_room()
+        if room_id is not None:
             await self.join_group(str(room_id))
-            data = {
-                'room_id': str(room_id),
-                'message': 'got matched!'
-            }
-            await self.send(text_data=json.dumps(data))
-
-        elif method == 'status':
-            print(f'Got data from {self.user_id}. method: "status"')
-
-            data = {
-                'message': 'status',
-            }
-            await self.send(text_data=json.dumps(data))
+        return room_id
+
+    async def reply_room(self, task):
+        try:
+            room_id = await asyncio.shield(task)
+        except ObjectDoesNotExist as e:
+            logger.info('ws get_room failed', extra={'user_id': str(self.user_id), 'error': str(e)})
+            await self.send_info('error', error=e)
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 返信しないとクライアントは待ち続ける
+            logger.exception('ws get_room failed', extra={'user_id': str(self.user_id)})
+            await self.send_info('error', error='internal error')
+            return
+        
+        if room_id is None:
+            await self.send_info('now waiting...')
+            return
         
-        elif method == 'confirm_matching':
-            print(f'Got data from {self.user_id}. method: "confirm_matching"')
+        data = {
+            'room_id': str(room_id),
+            'message': 'got matched!'
+        }
+        await self.send_data(data)
+
+    async def on_status(self, text_data_json):
+        data = {
+            'message': 'status',
+        }
+        await self.send_data(data)
 
-            room_id = text_data_json.get('room_id')
+    async def on_heartbeat(self, text_data_json):
+        # last_seen の書き込みは heartbeat_interval に 1 回まで
+        now = time.monotonic()
+        if self.last_touched is not None and now - self.last_touched < matching.heartbeat_interval():
+            return
+        self.last_touched = now
+        await self.touch_record()
+
+    async def on_confirm_matching(self, text_data_json):
+        room_id = text_data_json.get('room_id')
 
-            # room_id のバリデーション
-            if not await self.room_exists(room_id):
-                await self.send_info('invalid room id')
+        # Redis のカウンタで承認する（MatchingRecord は後から更新）
+        if room_id and confirmations.is_enabled():
+            result = await confirmations.confirm(room_id, self.user_id)
+            if result == confirmations.CANCELLED:
+                await self.send_info('matching cancelled')
                 return
-            
-            # マッチングを承認する
-            await self.confirm()
-
-            # マッチングしたユーザーらが承認したか
-            ok = await self.check_other_confirmations(room_id)
-            if not ok:
-                await self.send_info('waiting for other confirmations...')
+            if result != confirmations.UNKNOWN:
+                confirmations.persist(matching.confirm_record, self.user_id)
+                if result == confirmations.PENDING:
+                    await self.send_info('waiting for other confirmations...')
+                elif result == confirmations.COMPLETED_NOW and not notifications.is_enabled():
+                    # 最後に承認したユーザーがグループの全員に伝える
+                    await self.channel_layer.group_send(
+                        str(room_id), protocol.group_message('matching complete'))
                 return
-            
-            # グループの全員にマッチングが完了したことを伝える
-            await self.channel_layer.group_send(self.group_id, {
-                'type': 'send.message',
-                'message': 'matching complete'
-            })
+
+        # 承認してルームの状態を取得（room_id のバリデーションも兼ねる）
+        status = await self.confirm_matching(room_id)
+        if status is None:
+            await self.send_info('invalid room id')
+            return
+
+        # プッシュ通知が有効なら承認状態は room_status で届く
+        if notifications.is_enabled():
+            await self.send_info('confirmed')
+            return
+
+        # マッチングしたユーザーらが承認したか
+        if status != matching.ROOM_COMPLETED:
+            await self.send_info('waiting for other confirmations...')
+            return
+        
+        # グループの全員にマッチングが完了したことを伝える
+        await self.channel_layer.group_send(
+            self.group_id, protocol.group_message('matching complete'))
+
+    # マッチングしたとき（notifications.notify_matched から）
+    async def match_found(self, event):
+        await self.join_group(event['room_id'])
+        if 'group_size' in event:
+            GROUP_SIZE.labels().observe(event['group_size'])
+        await self.send_frames(event.get('frames'), {
+            'room_id': event['room_id'],
+            'room_url': event['room_url'],
+            'message': 'got matched!'
+        })
+
+    # 承認状態が変わったとき（notifications.notify_room_status から）
+    async def room_status(self, event):
+        await self.send_frames(event.get('frames'), {
+            'room_id': event['room_id'],
+            'status': event['status'],
+            'message': 'room status'
+        })
         
     
 
     # マッチングに登録
-    @database_sync_to_async
+    @db_call
     def register_matching(self, condition, submission_time):
-        defaults = dict(
-            user=User.objects.get(pk=self.user_id),
-            game_name=condition['game_name'],
-            number=condition['number'],
-            submission_time=submission_time,
-            is_active=True,
-            is_pending=False,
-            is_confirmed=False
-        )
-
-        record, created = MatchingRecord.objects.update_or_create(
-            user=User.objects.get(pk=self.user_id),
-            defaults=defaults,
-        )
-        record.save()
+        if condition is None:
+            return False
+        topic = Topic.objects.filter(name=condition.get('topic')).first()
+        if topic is None:
+            return False
 
+        # 既に待ち状態であれば登録しない
+        record = MatchingRecord.objects.register(self.user_id, topic, condition['number'], submission_time)
+        if record is None:
+            return False
+
+        popularity.record_registration(topic.pk)
+
+        # 待ち行列に追加（人数が揃えばここでルームが作られる）
+        matching.enqueue(record)
         return True
 
     # マッチングを登録解除
-    @database_sync_to_async
+    @db_call
     def unregister_matching(self):
-        
-        record = MatchingRecord.objects.filter(user=self.user_id, is_active=True).first()
-        if record is None:
+        # 承認待ちのルームがあればキャンセルする
+        matching.leave_room(self.user_id)
+
+        updated = MatchingRecord.objects.filter(user=self.user_id).transition(
+            MatchingRecord.ACTIVE_STATES, MatchingRecord.State.INACTIVE)
+        if not updated:
             return False
-        # is_active is_confirmedを False にする
-        record.is_active = False
-        record.is_pending = False
-        record.is_confirmed = False
-        record.save()
+
+        matching.dequeue(self.user_id)
         return True
     
-    # マッチングを保留状態にする（承認待ち状態）
-    @database_sync_to_async
-    def pending(self):
-        record = MatchingRecord.objects.filter(user=self.user_id, is_active=True).first()
-        if record is None:
-            return False
-        
-        record.is_pending = True
-        record.save()
-        return True
+    @db_call
+    def leave_queue(self):
+        matching.dequeue(self.user_id)
+
+    @db_call
+    def touch_record(self):
+        matching.touch(self.user_id)
 
     # マッチング処理
-    @database_sync_to_async
+    @db_call
     def get_match_room(self):
-        myrecord = MatchingRecord.objects.filter(
-            user=self.user_id,
-            is_active=True,
-            is_pending=False,
-            is_confirmed=False).first()
-        if myrecord is None:
+        try:
+            room = matching.get_match_room(self.user_id)
+        except MatchingRecord.DoesNotExist:
             raise ObjectDoesNotExist('Not registered.')
 
-        # 入れるルームが既にあればそれを返す
-        room = Room.objects.filter(
-            users=self.user_id,
-            is_active=True,
-            created_date__gte=myrecord.submission_time).order_by('-created_date').first()
-        if room is not None:
-            return room.pk
-
-        '''
-        マッチングできるかチェック
-        '''
-        # マッチングするものがあるか検索
-        match_records = MatchingRecord.objects.filter(
-            game_name=myrecord.game_name,
-            number=myrecord.number,
-            is_active=True,
-            is_pending=False,
-            is_confirmed=False).order_by('submission_time')
-
-        # クエリセットが条件の数より少ない場合は不適
-        if match_records.count() < myrecord.number:
-            return
-
-        # クエリセットを条件の数に制限
-        match_records = match_records[:myrecord.number]
-
-        # クエリセットと関連した User を取得し、idをリスト match_users_id に格納
-        match_users_id = [record.user.pk for record in match_records]
-
-        # 自分が入っていない場合は不適
-        if not self.user_id in match_users_id:
-            return
-        
-        print(match_users_id)
-
-        print('matching ok', self.user_id)
-
-
-        '''
-        ルームを作成
-        '''
-        # 既に作られているか
-        room = Room.objects.filter(
-            users=self.user_id,
-            is_active=True,
-            created_date__gte=myrecord.submission_time).order_by('-created_date').first()
         if room is None:
-            # ない場合はルーム作成
-            print(self.user_id, 'create room')
-            room = Room.objects.create(is_active=True)
-            for user_id in match_users_id:
-                room.users.add(User.objects.get(pk=user_id))
-        
+            return
         return room.pk
     
-    # ルームが存在するか
-    @database_sync_to_async
-    def room_exists(self, room_id):
-        if not room_id:
-            return False
-        
-        room = Room.objects.filter(pk=room_id, users=self.user_id).first()
-        
-        return room is not None
-
     # マッチング承認
-    @database_sync_to_async
-    def confirm(self):
-        record = MatchingRecord.objects.filter(user=self.user_id).first()
-        if record is None:
-            return False
-        
-        record.is_confirmed = True
-        record.is_pending = False
-        record.save()
-        return True
-
-    # 他のユーザーが全員承認しているか
-    @database_sync_to_async
-    def check_other_confirmations(self, room_id):
-        room = Room.objects.get(pk=room_id)
-        users = room.users.all()
-
-        for user in users:
-            try:
-                record = MatchingRecord.objects.filter(user=user.pk).first()
-            except User.matchingrecord.RelatedObjectDoesNotExist:
-                print('User.matchingrecord.RelatedObjectDoesNotExist')
-                return False
-            except Exception:
-                return False
-            if not record.is_confirmed:
-                return False
-        
-        return True
-
+    @db_call
+    def confirm_matching(self, room_id):
+        return matching.confirm_room(room_id, self.user_id)
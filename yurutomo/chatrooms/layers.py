@@ -0,0 +1,80 @@
+"""
+負荷試験用のチャンネルレイヤー
+
+Redis なしで MatchingConsumer を負荷試験するための InMemoryChannelLayer。
+channels_redis と同じく capacity を超えると ChannelFull、expiry を過ぎたメッセージと
+group_expiry を過ぎたグループのメンバーは捨てられる（InMemoryChannelLayer の実装のまま）。
+そのうえで Redis との往復の分だけ、各操作を latency (+ 0〜jitter) 秒遅らせる。
+group_send は channels_redis と同じく 1 往復として、メンバー数によらず 1 回だけ遅らせる。
+
+settings.CHANNEL_LAYERS で選ぶ:
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chatrooms.layers.SimulatedChannelLayer',
+            'CONFIG': {'latency': 0.001, 'jitter': 0.002, 'capacity': 100, 'expiry': 60},
+        },
+    }
+"""
+import asyncio
+import random
+from contextlib import contextmanager
+
+from channels.exceptions import ChannelFull
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+
+
+class SimulatedChannelLayer(InMemoryChannelLayer):
+
+    def __init__(self, latency=0, jitter=0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.jitter = jitter
+
+    async def _delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, channel, message):
+        await self._delay()
+        await super().send(channel, message)
+
+    async def receive(self, channel):
+        message = await super().receive(channel)
+        await self._delay()
+        return message
+
+    async def group_add(self, group, channel):
+        await self._delay()
+        await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self._delay()
+        await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self._delay()
+        self._clean_expired()
+        for channel in list(self.groups.get(group, {})):
+            try:
+                await InMemoryChannelLayer.send(self, channel, message)
+            except ChannelFull:
+                pass
+
+
+@contextmanager
+def use_channel_layer(layer, alias=DEFAULT_CHANNEL_LAYER):
+    """ get_channel_layer() が返すレイヤーを一時的に差し替える（負荷試験・ベンチマーク用） """
+    old = channel_layers.set(alias, layer)
+    try:
+        yield layer
+    finally:
+        if old is None:
+            channel_layers.backends.pop(alias, None)
+        else:
+            channel_layers.set(alias, old)
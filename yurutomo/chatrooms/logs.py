@@ -0,0 +1,71 @@
+"""
+構造化ログ
+
+JsonFormatter はレコードを 1 行の JSON にする（extra で渡した値もキーとして含める）。
+QueueStreamHandler はレコードをキューに入れるだけで返り、書式化と書き出しは別スレッドで行う。
+イベントループのスレッドで stdout / stderr への書き込みを待たないように、
+コンシューマーからのログはこのハンドラーで出す（settings.LOGGING）。
+
+Django の設定より先に読み込まれるので、Django のモジュールを import しないこと。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class QueueStreamHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+        self._running = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ キューに残ったログを書き出して止める """
+        if self._running:
+            self._running = False
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+    def setFormatter(self, fmt):
+        # 書式化は書き出すスレッドで行う
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # あふれたら捨てる（ログのためにイベントループを止めない）
+            pass
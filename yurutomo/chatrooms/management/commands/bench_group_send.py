@@ -0,0 +1,144 @@
+"""
+チャンネルレイヤーの group_send のファンアウトを計測する
+
+    python manage.py bench_group_send --consumers 10000 --room-sizes 2 3 5 10
+    python manage.py bench_group_send --hosts 127.0.0.1:6379 127.0.0.1:6380 --json
+
+consumers 個のチャンネルを room_size 人ずつのグループに分けて group_add し、
+全グループに group_send して、group_send 1 回にかかった時間、
+送ってからメンバーに届くまでの時間、1 秒あたりの group_send 数と配信数を表示する。
+
+--hosts を指定するとそのホスト群にシャードした RedisChannelLayer を、
+--memory を指定すると InMemoryChannelLayer を使う（省略時は settings.CHANNEL_LAYERS）。
+"""
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from chatrooms import bench
+
+
+class Command(BaseCommand):
+    help = 'Measure group_send latency and throughput of the channel layer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumers', type=int, default=10000,
+                            help='number of channels (simulated consumers)')
+        parser.add_argument('--room-sizes', nargs='+', type=int, default=list(range(2, 11)),
+                            help='group sizes to measure')
+        parser.add_argument('--rounds', type=int, default=3,
+                            help='group_send to every group this many times')
+        parser.add_argument('--concurrency', type=int, default=500,
+                            help='maximum number of concurrent layer calls')
+        parser.add_argument('--timeout', type=float, default=60,
+                            help='seconds to wait for deliveries in each round')
+        parser.add_argument('--hosts', nargs='+',
+                            help='Redis hosts (host:port) to shard over')
+        parser.add_argument('--memory', action='store_true',
+                            help='use InMemoryChannelLayer')
+        parser.add_argument('--json', action='store_true',
+                            help='print results as JSON')
+
+    def handle(self, *args, **options):
+        layer = self.get_layer(options)
+        if layer is None:
+            raise CommandError('No channel layer is configured.')
+
+        results = asyncio.run(self.run(layer, options))
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'layer': type(layer).__name__,
+                'results': results,
+            }, indent=2))
+            return
+
+        for result in results:
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                '=== room size {room_size}: {rooms} groups, {consumers} consumers ==='.format(**result)))
+            self.stdout.write('group_send: ' + bench.format_summary(result['group_send']))
+            self.stdout.write('delivery:   ' + bench.format_summary(result['delivery']))
+            self.stdout.write(self.style.SUCCESS(
+                '{group_sends_per_sec} group_send/s, {deliveries_per_sec} deliveries/s '
+                '({delivered}/{expected} delivered)'.format(**result)))
+
+    def get_layer(self, options):
+        if options['memory']:
+            # 1 ラウンドで各チャンネルに 1 通ずつしか送らない
+            return InMemoryChannelLayer(capacity=options['rounds'] + 1)
+        if options['hosts']:
+            from channels_redis.core import RedisChannelLayer
+            hosts = []
+            for address in options['hosts']:
+                host, port = address.rsplit(':', 1)
+                hosts.append((host, int(port)))
+            return RedisChannelLayer(hosts=hosts)
+        return get_channel_layer()
+
+    async def run(self, layer, options):
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        results = []
+        for room_size in options['room_sizes']:
+            results.append(await self.bench(layer, room_size, options, limited))
+        return results
+
+    async def bench(self, layer, room_size, options, limited):
+        rooms = options['consumers'] // room_size
+        channels = [await layer.new_channel() for _ in range(rooms * room_size)]
+        groups = {
+            'bench.{}.{}'.format(room_size, i): channels[i * room_size:(i + 1) * room_size]
+            for i in range(rooms)
+        }
+        await asyncio.gather(*[
+            limited(layer.group_add(group, channel))
+            for group, members in groups.items() for channel in members
+        ])
+
+        send_latencies = []
+        delivery_latencies = []
+
+        async def receive(channel):
+            message = await layer.receive(channel)
+            delivery_latencies.append(time.perf_counter() - message['sent'])
+
+        async def send(group):
+            start = time.perf_counter()
+            await layer.group_send(group, {'type': 'bench.message', 'sent': start})
+            send_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(options['rounds']):
+            receivers = [asyncio.ensure_future(receive(channel)) for channel in channels]
+            await asyncio.gather(*[limited(send(group)) for group in groups])
+            done, pending = await asyncio.wait(receivers, timeout=options['timeout'])
+            # 届かなかった分は数えない
+            for receiver in pending:
+                receiver.cancel()
+        elapsed = time.perf_counter() - start
+
+        await asyncio.gather(*[
+            limited(layer.group_discard(group, channel))
+            for group, members in groups.items() for channel in members
+        ])
+
+        return {
+            'room_size': room_size,
+            'rooms': rooms,
+            'consumers': len(channels),
+            'rounds': options['rounds'],
+            'group_send': bench.summarize(send_latencies),
+            'delivery': bench.summarize(delivery_latencies),
+            'delivered': len(delivery_latencies),
+            'expected': len(channels) * options['rounds'],
+            'elapsed_s': round(elapsed, 3),
+            'group_sends_per_sec': round(len(send_latencies) / elapsed, 1),
+            'deliveries_per_sec': round(len(delivery_latencies) / elapsed, 1),
+        }
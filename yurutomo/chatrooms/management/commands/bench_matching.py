@@ -0,0 +1,427 @@
+"""
+マッチングのスループット・レイテンシのベンチマーク
+
+    python manage.py bench_matching --users 1000 --topics 10 --number 2 --output before.json
+    python manage.py bench_matching --users 1000 --topics 10 --number 2 --compare before.json
+
+HTTP API（django.test.Client）と WebSocket（WebsocketCommunicator）のそれぞれで、
+users 人のユーザーに次の操作を順に行う。
+
+    register        ルームがまだ揃わない登録
+    poll_waiting    マッチング待ち中のポーリング（get_match_room / get_room）
+    register_match  ルームが揃う登録
+    get_match_room  マッチングしたルームの取得
+    confirm         承認
+    completed       完了の確認（HTTP のみ。WebSocket はプッシュで届いた数を数える）
+    unregister      登録解除
+
+操作ごとに 1 回あたりのクエリ数（全スレッドの接続で数える）と p50/p95/p99 のレイテンシを、
+トランスポートごとに 1 秒あたりのマッチング数（register_match で作られたルーム数）を記録する。
+--output で結果を JSON に保存し、--compare で保存した結果との差を表示する。
+
+チャンネルレイヤーは chatrooms.layers.SimulatedChannelLayer に差し替えるので Redis は要らない。
+DB には benchmatch- で始まるユーザーとトピックを作り、終わったら消す。テスト用の DB で実行すること。
+"""
+import asyncio
+import json
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from chatrooms import bench, matching, notifications, popularity, protocol
+from chatrooms.layers import SimulatedChannelLayer, use_channel_layer
+from chatrooms.models import Room, Topic
+from chatrooms.routing import websocket_urlpatterns
+from yurutomo import dbpool
+
+
+User = get_user_model()
+
+PREFIX = 'benchmatch-'
+
+COMPLETED_MESSAGES = ('matching complete',)
+
+# API が JSON で返すステータス（エラーも JSON で返す）
+API_STATUSES = (200, 400, 404)
+
+
+def is_completed(data):
+    return data.get('message') in COMPLETED_MESSAGES or (
+        data.get('message') == 'room status' and data.get('status') == 'completed')
+
+
+class Recorder:
+    """ 操作ごとのレイテンシとクエリ数 """
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.ops = {}
+
+    def start(self, op):
+        self.ops[op] = {'latencies': [], 'queries': self.counter.count, 'start': time.perf_counter()}
+
+    def add(self, op, seconds):
+        self.ops[op]['latencies'].append(seconds)
+
+    def stop(self, op):
+        entry = self.ops[op]
+        entry['queries'] = self.counter.count - entry['queries']
+        entry['elapsed'] = time.perf_counter() - entry['start']
+
+    def elapsed(self, op):
+        return self.ops[op]['elapsed']
+
+    def results(self):
+        results = {}
+        for op, entry in self.ops.items():
+            count = len(entry['latencies'])
+            results[op] = {
+                'count': count,
+                'queries_per_op': round(entry['queries'] / count, 2) if count else None,
+                'latency': bench.summarize(entry['latencies']),
+            }
+        return results
+
+
+class Session:
+    """ WebSocket の 1 接続（届いたメッセージを読み飛ばさずに取っておく） """
+
+    def __init__(self, communicator, codec):
+        self.communicator = communicator
+        self.codec = codec
+        self.inbox = []
+
+    async def send(self, data):
+        if self.codec is protocol.MSGPACK:
+            data = dict(data, method=protocol.METHOD_CODES[data['method']])
+        await self.communicator.send_to(**self.codec.encode(data))
+
+    def _decode(self, output):
+        if output['type'] != 'websocket.send':
+            return None
+        return self.codec.decode(output.get('text'), output.get('bytes'))
+
+    def drain(self):
+        """ 既に届いているメッセージを inbox に移す """
+        queue = self.communicator.output_queue
+        while not queue.empty():
+            data = self._decode(queue.get_nowait())
+            if data is not None:
+                self.inbox.append(data)
+
+    async def expect(self, predicate, timeout):
+        """ predicate に合うメッセージを返す（届かなければ None） """
+        for i, data in enumerate(self.inbox):
+            if predicate(data):
+                return self.inbox.pop(i)
+
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            # receive_output() はタイムアウトするとコンシューマーを止めてしまうので、
+            # 出力のキューから直接受け取る
+            try:
+                output = await asyncio.wait_for(self.communicator.output_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            data = self._decode(output)
+            if data is None:
+                continue
+            if predicate(data):
+                return data
+            self.inbox.append(data)
+
+    async def request(self, data, predicate, timeout):
+        """ 送って応答を待つ（前の操作の残りは捨てる） """
+        self.drain()
+        self.inbox.clear()
+        await self.send(data)
+        return await self.expect(predicate, timeout)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark matching operations over the HTTP API and the WebSocket consumer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000,
+                            help='number of users per transport')
+        parser.add_argument('--topics', type=int, default=10,
+                            help='number of topics')
+        parser.add_argument('--number', type=int, default=2,
+                            help='room size')
+        parser.add_argument('--transports', nargs='+', choices=['http', 'ws'], default=['http', 'ws'])
+        parser.add_argument('--concurrency', type=int, default=100,
+                            help='concurrent WebSocket requests')
+        parser.add_argument('--timeout', type=float, default=10,
+                            help='seconds to wait for each WebSocket response')
+        parser.add_argument('--msgpack', action='store_true',
+                            help='use the msgpack subprotocol')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='seconds added to each channel layer call')
+        parser.add_argument('--label', default='',
+                            help='label stored with the results (e.g. commit id)')
+        parser.add_argument('--output',
+                            help='write results as JSON to this file')
+        parser.add_argument('--compare',
+                            help='JSON results to compare with')
+        parser.add_argument('--json', action='store_true',
+                            help='print results as JSON')
+
+    def handle(self, *args, **options):
+        if options['users'] % options['number']:
+            raise CommandError('--users must be a multiple of --number.')
+
+        results = {
+            'label': options['label'],
+            'options': {key: options[key] for key in ('users', 'topics', 'number', 'concurrency', 'msgpack', 'latency')},
+            'push': notifications.is_enabled(),
+            'transports': {},
+        }
+
+        with bench.QueryCounter() as counter, use_channel_layer(SimulatedChannelLayer(latency=options['latency'])):
+            self.cleanup()
+            try:
+                topics = Topic.objects.bulk_create([
+                    Topic(name='{}topic-{}'.format(PREFIX, i), number=options['number'])
+                    for i in range(options['topics'])
+                ])
+                for transport in options['transports']:
+                    users = self.seed(transport, options)
+                    recorder = Recorder(counter)
+                    if transport == 'http':
+                        summary = self.bench_http(users, topics, recorder, options)
+                    else:
+                        summary = asyncio.run(self.bench_ws(users, topics, recorder, options))
+
+                    rooms = Room.objects.filter(users__in=users).distinct().count()
+                    summary.update({
+                        'rooms': rooms,
+                        'matches_per_sec': round(rooms / recorder.elapsed('register_match'), 1),
+                        'ops': recorder.results(),
+                    })
+                    results['transports'][transport] = summary
+            finally:
+                self.cleanup()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.show(results)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), results)
+
+    def seed(self, transport, options):
+        return User.objects.bulk_create([
+            User(username='{}{}-{}'.format(PREFIX, transport, i), password='!')
+            for i in range(options['users'])
+        ], batch_size=5000)
+
+    def cleanup(self):
+        users = User.objects.filter(username__startswith=PREFIX)
+        Room.objects.filter(users__in=users).delete()
+        users.delete()
+        Topic.objects.filter(name__startswith=PREFIX).delete()
+        popularity.invalidate()
+        matching.engine.clear()
+
+    def split(self, users, topics, number):
+        """
+        number 人ずつ同じトピックにして、ルームが揃わない登録と揃う登録に分ける
+        [(user, topic), ...] を 2 つ返す
+        """
+        waiting = []
+        completing = []
+        for i, user in enumerate(users):
+            topic = topics[(i // number) % len(topics)]
+            if i % number == number - 1:
+                completing.append((user, topic))
+            else:
+                waiting.append((user, topic))
+        return waiting, completing
+
+    # HTTP API
+
+    def bench_http(self, users, topics, recorder, options):
+        # django.test.Client は Host: testserver で送る
+        with override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+            return self._bench_http(users, topics, recorder, options)
+
+    def _bench_http(self, users, topics, recorder, options):
+        number = options['number']
+        clients = {}
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            clients[user.pk] = client
+
+        def call(op, user, method, name, data=None):
+            client = clients[user.pk]
+            start = time.perf_counter()
+            if method == 'get':
+                response = client.get(reverse(name), data or {})
+            else:
+                response = client.post(reverse(name), data or {}, content_type='application/json')
+            recorder.add(op, time.perf_counter() - start)
+            if response.status_code not in API_STATUSES or response.get('Content-Type') != 'application/json':
+                raise CommandError('{}: unexpected response {} from {}.'.format(
+                    op, response.status_code, reverse(name)))
+            return response.json()
+
+        def run(op, pairs, method, name, data=None):
+            recorder.start(op)
+            responses = [call(op, user, method, name, data(user, topic) if data else None) for user, topic in pairs]
+            recorder.stop(op)
+            return responses
+
+        def condition(user, topic):
+            return {'condition': {'topic': topic.name, 'number': number}}
+
+        waiting, completing = self.split(users, topics, number)
+        everyone = waiting + completing
+
+        run('register', waiting, 'post', 'chatrooms:register_matching', condition)
+        run('poll_waiting', waiting, 'get', 'chatrooms:get_match_room')
+        run('register_match', completing, 'post', 'chatrooms:register_matching', condition)
+        responses = run('get_match_room', everyone, 'get', 'chatrooms:get_match_room')
+
+        room_ids = {user.pk: response.get('room_id') for (user, _), response in zip(everyone, responses)}
+        run('confirm', everyone, 'post', 'chatrooms:confirm_matching',
+            lambda user, topic: {'room_id': room_ids[user.pk]})
+        # マッチングしなかったユーザーは空の room_id で問い合わせる（400 が返る）
+        responses = run('completed', everyone, 'get', 'chatrooms:get_match_completed',
+                        lambda user, topic: {'room_id': room_ids[user.pk] or ''})
+        run('unregister', everyone, 'post', 'chatrooms:unregister_matching')
+
+        return {
+            'matched': sum(1 for room_id in room_ids.values() if room_id),
+            'completed': sum(1 for response in responses if response.get('is_completed')),
+        }
+
+    # WebSocket
+
+    async def bench_ws(self, users, topics, recorder, options):
+        dbpool.install(asyncio.get_running_loop())
+
+        number = options['number']
+        timeout = options['timeout']
+        codec = protocol.MSGPACK if options['msgpack'] else protocol.JSON
+        application = URLRouter(websocket_urlpatterns)
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        sessions = {}
+        for user in users:
+            subprotocols = [codec.subprotocol] if codec.subprotocol else None
+            communicator = WebsocketCommunicator(application, '/ws/room-match/', subprotocols=subprotocols)
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect(timeout=timeout)
+            if not connected:
+                raise CommandError('Could not connect to ws/room-match/.')
+            sessions[user.pk] = Session(communicator, codec)
+
+        async def call(op, user, data, predicate):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await sessions[user.pk].request(data, predicate, timeout)
+                recorder.add(op, time.perf_counter() - start)
+                return response or {}
+
+        async def run(op, pairs, data, messages):
+            recorder.start(op)
+            responses = await asyncio.gather(*[
+                call(op, user, data(user, topic), lambda data: data.get('message') in messages)
+                for user, topic in pairs
+            ])
+            recorder.stop(op)
+            return responses
+
+        def method(name):
+            return lambda user, topic: {'method': name}
+
+        def start_wait(user, topic):
+            return {'method': 'start_wait', 'condition': {'topic': topic.name, 'number': number}}
+
+        waiting, completing = self.split(users, topics, number)
+        everyone = waiting + completing
+        room_messages = ('got matched!', 'now waiting...', 'error')
+
+        try:
+            await run('register', waiting, start_wait, ('registered!', 'fail to register'))
+            await run('poll_waiting', waiting, method('get_room'), room_messages)
+            await run('register_match', completing, start_wait, ('registered!', 'fail to register'))
+            responses = await run('get_match_room', everyone, method('get_room'), room_messages)
+
+            room_ids = {user.pk: response.get('room_id') for (user, _), response in zip(everyone, responses)}
+            responses = await run('confirm', everyone, lambda user, topic: {
+                'method': 'confirm_matching', 'room_id': room_ids[user.pk]}, (
+                'waiting for other confirmations...', 'confirmed', 'matching complete',
+                'matching cancelled', 'invalid room id', 'room status'))
+
+            # 全員の承認がそろったことが届いたか（最後に承認したユーザーには承認の応答として届く）
+            async def check_completed(user, response):
+                if is_completed(response):
+                    return True
+                return await sessions[user.pk].expect(is_completed, timeout) is not None
+
+            completed = await asyncio.gather(*[
+                check_completed(user, response) for (user, _), response in zip(everyone, responses)
+            ])
+
+            await run('unregister', everyone, method('quit_wait'), ('unregistered!', 'fail to unregister.'))
+        finally:
+            for session in sessions.values():
+                await session.communicator.disconnect()
+
+        return {
+            'matched': sum(1 for room_id in room_ids.values() if room_id),
+            'completed': sum(completed),
+        }
+
+    # 表示
+
+    def show(self, results):
+        for transport, summary in results['transports'].items():
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                '=== {} ({} users, room size {}) ==='.format(
+                    transport, results['options']['users'], results['options']['number'])))
+            for op, entry in summary['ops'].items():
+                self.stdout.write('{:<16} {:>6} queries/op  {}'.format(
+                    op, entry['queries_per_op'], bench.format_summary(entry['latency'])))
+            self.stdout.write(self.style.SUCCESS(
+                '{rooms} rooms, {matches_per_sec} matches/s, {matched} matched, {completed} completed'.format(
+                    **summary)))
+
+    def compare(self, base, results):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            '=== compared with {} ==='.format(base.get('label') or options_label(base))))
+        for transport, summary in results['transports'].items():
+            base_summary = base['transports'].get(transport)
+            if base_summary is None:
+                continue
+            for op, entry in summary['ops'].items():
+                base_entry = base_summary['ops'].get(op)
+                if base_entry is None:
+                    continue
+                self.stdout.write('{:<3} {:<16} queries/op {} -> {}  p95 {}ms -> {}ms'.format(
+                    transport, op,
+                    base_entry['queries_per_op'], entry['queries_per_op'],
+                    base_entry['latency']['p95_ms'], entry['latency']['p95_ms']))
+            self.stdout.write('{:<3} matches/s {} -> {}'.format(
+                transport, base_summary['matches_per_sec'], summary['matches_per_sec']))
+
+
+def options_label(results):
+    return ', '.join('{}={}'.format(key, value) for key, value in results['options'].items())
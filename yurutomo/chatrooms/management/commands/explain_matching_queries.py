@@ -0,0 +1,118 @@
+"""
+マッチングのホットクエリの実行計画を確認する
+
+    python manage.py explain_matching_queries --sizes 1000 100000
+
+レコード数ごとにダミーの User / MatchingRecord / Room を作り、
+ANALYZE したうえで EXPLAIN ANALYZE の結果と実行時間を表示する。
+作ったデータはトランザクションごとロールバックするので残らない。
+"""
+import time
+import random
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from chatrooms.models import Room, MatchingRecord, Topic
+
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Seed dummy matching data and show query plans of the matching hot queries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 100000],
+                            help='numbers of matching records to seed')
+        parser.add_argument('--topics', type=int, default=100,
+                            help='number of topics')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        try:
+            with transaction.atomic():
+                self.run(rng, sorted(options['sizes']), options['topics'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, rng, sizes, topic_count):
+        topics = Topic.objects.bulk_create([
+            Topic(name='bench-topic-{}'.format(i), number=rng.randint(2, 5)) for i in range(topic_count)
+        ])
+        now = timezone.now()
+        seeded = 0
+        for size in sizes:
+            self.seed(rng, topics, now, seeded, size)
+            seeded = size
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+
+            self.stdout.write(self.style.MIGRATE_HEADING('=== {} records ==='.format(size)))
+            topic = rng.choice(topics)
+            record = MatchingRecord.objects.filter(topic=topic).first() or MatchingRecord.objects.first()
+
+            waiting = MatchingRecord.objects.filter(
+                topic=record.topic_id,
+                number=record.number,
+                state=MatchingRecord.State.WAITING).order_by('submission_time')[:record.number]
+            self.explain('MatchingRecord waiting', waiting)
+
+            rooms = Room.objects.filter(
+                users=record.user_id,
+                is_active=True,
+                created_date__gte=record.submission_time).order_by('-created_date')[:1]
+            self.explain('Room of user', rooms)
+
+    def seed(self, rng, topics, now, start, stop):
+        users = User.objects.bulk_create([
+            User(username='bench-{}'.format(i), password='!') for i in range(start, stop)
+        ], batch_size=5000)
+
+        # 待ち状態は一部だけで、大半は終わったレコード
+        states = [MatchingRecord.State.WAITING, MatchingRecord.State.PENDING, MatchingRecord.State.CONFIRMED]
+        records = []
+        for i, user in enumerate(users):
+            topic = rng.choice(topics)
+            records.append(MatchingRecord(
+                user=user,
+                topic=topic,
+                number=topic.number,
+                submission_time=now - datetime.timedelta(seconds=stop - start - i),
+                state=rng.choice(states) if rng.random() < 0.2 else MatchingRecord.State.INACTIVE,
+            ))
+        MatchingRecord.objects.bulk_create(records, batch_size=5000)
+
+        # 2人ずつルームを作る
+        rooms = Room.objects.bulk_create([
+            Room(is_active=rng.random() < 0.1, created_date=now - datetime.timedelta(seconds=i))
+            for i in range(len(users) // 2)
+        ], batch_size=5000)
+        Membership = Room.users.through
+        Membership.objects.bulk_create([
+            Membership(room_id=room.pk, user_id=user.pk)
+            for room, pair in zip(rooms, zip(users[0::2], users[1::2]))
+            for user in pair
+        ], batch_size=5000)
+
+    def explain(self, label, queryset):
+        start = time.perf_counter()
+        list(queryset)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if connection.vendor == 'postgresql':
+            plan = queryset.explain(analyze=True)
+        else:
+            plan = queryset.explain()
+        self.stdout.write(self.style.SUCCESS('--- {} ({:.2f} ms)'.format(label, elapsed)))
+        self.stdout.write(plan)
@@ -0,0 +1,223 @@
+"""
+ws/room-match/ の負荷試験
+
+    python manage.py loadtest_room_match --clients 2000 --number 2 --latency 0.001 --confirm
+
+clients 人分のユーザーを作り、WebsocketCommunicator で ws/room-match/ に接続して
+start_wait してからマッチングする（'got matched!' が届く）までの時間を計測する。
+--confirm を指定すると、続けて confirm_matching してから全員の承認がそろうまでの時間も計測する。
+プッシュ通知が無効なら get_room でポーリングする。
+
+チャンネルレイヤーは既定で chatrooms.layers.SimulatedChannelLayer に差し替えるので Redis は要らない
+（--layer settings で settings.CHANNEL_LAYERS のものを使う）。
+DB には loadtest- で始まるユーザーとトピックを作り、終わったら消す。テスト用の DB で実行すること。
+"""
+import asyncio
+import contextlib
+import json
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from chatrooms import bench, matching, notifications, popularity, protocol
+from chatrooms.layers import SimulatedChannelLayer, use_channel_layer
+from chatrooms.models import Room, Topic
+from chatrooms.routing import websocket_urlpatterns
+from yurutomo import dbpool
+
+
+User = get_user_model()
+
+PREFIX = 'loadtest-'
+
+
+class Command(BaseCommand):
+    help = 'Open many WebSocket sessions against ws/room-match/ and report time-to-match.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000,
+                            help='number of concurrent WebSocket sessions')
+        parser.add_argument('--number', type=int, default=2,
+                            help='room size')
+        parser.add_argument('--topics', type=int, default=1,
+                            help='number of topics to spread clients over')
+        parser.add_argument('--ramp', type=float, default=1.0,
+                            help='seconds over which clients start waiting')
+        parser.add_argument('--timeout', type=float, default=60,
+                            help='seconds each client waits for a match')
+        parser.add_argument('--poll-interval', type=float, default=0.5,
+                            help='get_room interval when push notifications are disabled')
+        parser.add_argument('--confirm', action='store_true',
+                            help='also confirm and measure time until everyone confirmed')
+        parser.add_argument('--msgpack', action='store_true',
+                            help='use the msgpack subprotocol')
+        parser.add_argument('--layer', choices=['simulated', 'settings'], default='simulated')
+        parser.add_argument('--latency', type=float, default=0.001,
+                            help='simulated layer: seconds added to each layer call')
+        parser.add_argument('--jitter', type=float, default=0,
+                            help='simulated layer: random extra seconds (0 to jitter)')
+        parser.add_argument('--capacity', type=int, default=100,
+                            help='simulated layer: messages per channel')
+        parser.add_argument('--expiry', type=int, default=60,
+                            help='simulated layer: message expiry in seconds')
+        parser.add_argument('--json', action='store_true',
+                            help='print results as JSON')
+
+    def handle(self, *args, **options):
+        if options['clients'] % options['number']:
+            raise CommandError('--clients must be a multiple of --number.')
+
+        layer = None
+        if options['layer'] == 'simulated':
+            layer = SimulatedChannelLayer(
+                latency=options['latency'],
+                jitter=options['jitter'],
+                capacity=options['capacity'],
+                expiry=options['expiry'],
+            )
+
+        with use_channel_layer(layer) if layer else contextlib.nullcontext():
+            users, topics = self.seed(options)
+            try:
+                results = asyncio.run(self.run(users, topics, options))
+            finally:
+                self.cleanup()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            '=== {clients} clients, room size {number}, push={push} ==='.format(**results)))
+        self.stdout.write('time to match:    ' + bench.format_summary(results['time_to_match']))
+        if options['confirm']:
+            self.stdout.write('time to complete: ' + bench.format_summary(results['time_to_complete']))
+        self.stdout.write(self.style.SUCCESS(
+            '{matched} matched, {timed_out} timed out, {matches_per_sec} rooms/s'.format(**results)))
+
+    def seed(self, options):
+        self.cleanup()
+        topics = Topic.objects.bulk_create([
+            Topic(name='{}topic-{}'.format(PREFIX, i), number=options['number'])
+            for i in range(options['topics'])
+        ])
+        users = User.objects.bulk_create([
+            User(username='{}{}'.format(PREFIX, i), password='!')
+            for i in range(options['clients'])
+        ], batch_size=5000)
+        return users, topics
+
+    def cleanup(self):
+        users = User.objects.filter(username__startswith=PREFIX)
+        Room.objects.filter(users__in=users).delete()
+        users.delete()
+        Topic.objects.filter(name__startswith=PREFIX).delete()
+        popularity.invalidate()
+        matching.engine.clear()
+
+    async def run(self, users, topics, options):
+        # ASGI ワーカーと同じスレッドプールで DB を使う
+        dbpool.install(asyncio.get_running_loop())
+
+        application = URLRouter(websocket_urlpatterns)
+        interval = options['ramp'] / len(users) if users else 0
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            self.client(application, user, topics[i % len(topics)], i * interval, options)
+            for i, user in enumerate(users)
+        ])
+        elapsed = time.perf_counter() - start
+
+        time_to_match = [result[0] for result in results if result[0] is not None]
+        time_to_complete = [result[1] for result in results if result[1] is not None]
+        return {
+            'clients': len(users),
+            'number': options['number'],
+            'push': notifications.is_enabled(),
+            'codec': protocol.MSGPACK.name if options['msgpack'] else protocol.JSON.name,
+            'time_to_match': bench.summarize(time_to_match),
+            'time_to_complete': bench.summarize(time_to_complete),
+            'matched': len(time_to_match),
+            'timed_out': len(users) - len(time_to_match),
+            'elapsed_s': round(elapsed, 3),
+            'matches_per_sec': round(len(time_to_match) / options['number'] / elapsed, 1),
+        }
+
+    async def client(self, application, user, topic, delay, options):
+        """ 1 人分のセッション（マッチングまでの時間, 承認がそろうまでの時間）を返す """
+        await asyncio.sleep(delay)
+
+        codec = protocol.MSGPACK if options['msgpack'] else protocol.JSON
+        subprotocols = [codec.subprotocol] if codec.subprotocol else None
+        communicator = WebsocketCommunicator(application, '/ws/room-match/', subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect(timeout=options['timeout'])
+        if not connected:
+            return None, None
+
+        poll = None
+        if not notifications.is_enabled():
+            poll = {'method': 'get_room'}
+
+        try:
+            start = time.perf_counter()
+            await self.send(communicator, codec, {
+                'method': 'start_wait',
+                'condition': {'topic': topic.name, 'number': options['number']},
+            })
+            data = await self.wait_for(
+                communicator, codec, start + options['timeout'], options['poll_interval'], poll,
+                lambda data: data.get('message') == 'got matched!')
+            if data is None:
+                return None, None
+            matched = time.perf_counter()
+            if not options['confirm']:
+                return matched - start, None
+
+            await self.send(communicator, codec, {'method': 'confirm_matching', 'room_id': data['room_id']})
+            data = await self.wait_for(
+                communicator, codec, matched + options['timeout'], options['poll_interval'], None,
+                lambda data: data.get('message') == 'matching complete' or (
+                    data.get('message') == 'room status' and data.get('status') == 'completed'))
+            if data is None:
+                return matched - start, None
+            return matched - start, time.perf_counter() - matched
+        finally:
+            await communicator.disconnect()
+
+    async def send(self, communicator, codec, data):
+        if codec is protocol.MSGPACK:
+            data = dict(data, method=protocol.METHOD_CODES[data['method']])
+        await communicator.send_to(**codec.encode(data))
+
+    async def wait_for(self, communicator, codec, deadline, poll_interval, poll, predicate):
+        """
+        predicate に合うメッセージが届くまで待つ（期限を過ぎたら None）
+        poll があれば poll_interval ごとに送る
+        """
+        next_poll = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return None
+            timeout = deadline - now
+            if poll is not None:
+                if now >= next_poll:
+                    await self.send(communicator, codec, poll)
+                    next_poll = now + poll_interval
+                timeout = min(timeout, next_poll - now)
+
+            # receive_output() はタイムアウトするとコンシューマーを止めてしまうので、
+            # 出力のキューから直接受け取る
+            try:
+                output = await asyncio.wait_for(communicator.output_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                continue
+            if output['type'] != 'websocket.send':
+                return None
+            data = codec.decode(output.get('text'), output.get('bytes'))
+            if data is not None and predicate(data):
+                return data
@@ -0,0 +1,478 @@
+"""
+マッチングエンジン
+
+待機中のユーザーを (topic, number) ごとの FIFO キューでメモリ上に保持し、
+キューが number 人に達した時点でグループを作る。
+ポーリングのたびに MatchingRecord を走査する代わりに、
+DB にはマッチングが成立したときだけ書き込む。
+
+キューはプロセスごとに持つので、ASGI ワーカーは 1 プロセスで動かすこと。
+プロセス起動後、最初に使われたときに DB の待機中レコードから復元する。
+
+クライアントが応答しなくなったレコード（last_seen が MATCHING_RECORD_TTL 秒より前）は
+expire_stale でまとめて無効にする（reaper.py が定期的に呼ぶ）。
+"""
+import bisect
+import datetime
+import itertools
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import Room, MatchingRecord
+from . import confirmations, membership, notifications, popularity, roster
+
+
+User = get_user_model()
+
+
+class MatchingEngine:
+    """ (topic, number) ごとの FIFO 待ち行列 """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (topic_id, number) -> [(submission_time, seq, user_id), ...]  submission_time 昇順
+        self._queues = defaultdict(list)
+        self._seq = itertools.count()
+        # user_id -> (topic_id, number)
+        self._keys = {}
+        self._loaded = False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, user_id):
+        return user_id in self._keys
+
+    def clear(self):
+        with self._lock:
+            self._queues.clear()
+            self._keys.clear()
+            self._loaded = False
+
+    def load(self, records):
+        """ 待機中のレコードからキューを復元する """
+        with self._lock:
+            for record in records:
+                self._push(record.topic_id, record.number, record.submission_time, record.user_id)
+            self._loaded = True
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def _push(self, topic_id, number, submission_time, user_id):
+        self._remove(user_id)
+        key = (topic_id, number)
+        # 同時刻の登録は後から来たものを後ろに並べる
+        bisect.insort_right(self._queues[key], (submission_time, next(self._seq), user_id))
+        self._keys[user_id] = key
+
+    def _remove(self, user_id):
+        key = self._keys.pop(user_id, None)
+        if key is None:
+            return False
+        queue = self._queues[key]
+        for i, entry in enumerate(queue):
+            if entry[2] == user_id:
+                del queue[i]
+                break
+        if not queue:
+            del self._queues[key]
+        return True
+
+    # 待ち行列に追加
+    def enqueue(self, topic_id, number, submission_time, user_id):
+        with self._lock:
+            self._push(topic_id, number, submission_time, user_id)
+
+    # 待ち行列から削除
+    def dequeue(self, user_id):
+        with self._lock:
+            return self._remove(user_id)
+
+    # 先頭から number 人取り出す。人数が足りなければ None
+    def pop_group(self, topic_id, number):
+        key = (topic_id, number)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None or len(queue) < number:
+                return None
+            entries = queue[:number]
+            del queue[:number]
+            if not queue:
+                del self._queues[key]
+            for entry in entries:
+                del self._keys[entry[2]]
+        return entries
+
+    # 取り出したエントリを先頭に戻す
+    def push_back(self, topic_id, number, entries):
+        with self._lock:
+            for submission_time, _, user_id in entries:
+                self._push(topic_id, number, submission_time, user_id)
+
+
+engine = MatchingEngine()
+
+
+# 応答がなくなってからレコードを無効にするまでの秒数
+def _record_ttl():
+    return getattr(settings, 'MATCHING_RECORD_TTL', 120)
+
+
+# last_seen を更新する間隔（秒）
+def heartbeat_interval():
+    return getattr(settings, 'MATCHING_HEARTBEAT_INTERVAL', 30)
+
+
+def _ensure_loaded():
+    if engine.loaded:
+        return
+    # 応答のなくなったレコードは復元しない
+    records = MatchingRecord.objects.filter(
+        state=MatchingRecord.State.WAITING,
+        last_seen__gte=timezone.now() - datetime.timedelta(seconds=_record_ttl()),
+    ).only('user', 'topic', 'number', 'submission_time')
+    engine.load(records)
+
+
+# 待ち行列に登録し、人数が揃えばルームを作成する
+def enqueue(record):
+    _ensure_loaded()
+    engine.enqueue(record.topic_id, record.number, record.submission_time, record.user_id)
+    return form_room(record.topic_id, record.number)
+
+
+# 待ち行列から外す
+def dequeue(user_id):
+    _ensure_loaded()
+    return engine.dequeue(user_id)
+
+
+# form_room でロック中のレコードがあったときのやり直し
+LOCK_RETRIES = 3
+LOCK_RETRY_DELAY = 0.01
+
+
+def form_room(topic_id, number):
+    """
+    キューの先頭 number 人でルームを作成する
+    揃っていなければ None を返す
+
+    レコードの確保・ルーム作成・メンバー追加・保留状態への変更を
+    1 つのトランザクションで行う。
+    他のリクエストがロック中のレコードは SKIP LOCKED で飛ばすので、
+    同じユーザーが 2 つのルームに入ることはない。
+    ロックされていただけで待ち状態のままのユーザーは待ち行列に戻し、
+    少し待ってやり直す（LOCK_RETRIES 回まで。だめなら次の登録・ポーリングのときに作る）。
+    """
+    retries = 0
+    while True:
+        entries = engine.pop_group(topic_id, number)
+        if entries is None:
+            return None
+
+        user_ids = [entry[2] for entry in entries]
+        with transaction.atomic():
+            # 待ち状態のままのレコードだけを確保する
+            claimed = list(MatchingRecord.objects.select_for_update(skip_locked=True).filter(
+                user__in=user_ids,
+                topic=topic_id,
+                number=number,
+                state=MatchingRecord.State.WAITING).values_list('pk', 'user'))
+
+            if len(claimed) == number:
+                room = Room.objects.create(is_active=True)
+                Membership = Room.users.through
+                Membership.objects.bulk_create([
+                    Membership(room_id=room.pk, user_id=user_id) for user_id in user_ids
+                ])
+                # 保留状態にする
+                MatchingRecord.objects.filter(pk__in=[pk for pk, _ in claimed]).transition(
+                    MatchingRecord.State.WAITING, MatchingRecord.State.PENDING)
+
+                if confirmations.is_enabled():
+                    transaction.on_commit(lambda: async_to_sync(confirmations.open_room)(room.pk, user_ids))
+                transaction.on_commit(lambda: membership.fill(room.pk, user_ids))
+                transaction.on_commit(lambda: roster.build(room.pk))
+                notifications.notify_matched(room, user_ids)
+                return room
+
+        # 確保できなかったレコードのうち、ロック中なだけで待ち状態のままのものも戻す
+        # （ロックせずに読むので、ロックを待たない）
+        claimed_ids = {user_id for _, user_id in claimed}
+        skipped = [user_id for user_id in user_ids if user_id not in claimed_ids]
+        locked_ids = set(MatchingRecord.objects.filter(
+            user__in=skipped,
+            topic=topic_id,
+            number=number,
+            state=MatchingRecord.State.WAITING).values_list('user', flat=True))
+        # 状態が変わったエントリだけを捨てる
+        engine.push_back(topic_id, number, [e for e in entries if e[2] in claimed_ids or e[2] in locked_ids])
+
+        if locked_ids:
+            retries += 1
+            if retries > LOCK_RETRIES:
+                return None
+            time.sleep(LOCK_RETRY_DELAY * retries)
+
+
+# 待ち行列に入っているか
+def is_queued(user_id):
+    _ensure_loaded()
+    return user_id in engine
+
+
+def get_match_room(user_id):
+    """
+    マッチングしたルームを返す
+    まだマッチングしていなければ None
+    待ち状態のレコードがなければ MatchingRecord.DoesNotExist
+    """
+    myrecord = MatchingRecord.objects.get(
+        user=user_id,
+        state__in=[MatchingRecord.State.WAITING, MatchingRecord.State.PENDING])
+
+    # ポーリングをハートビートとして扱う（heartbeat_interval ごとに 1 回だけ書き込む）
+    now = timezone.now()
+    if myrecord.last_seen < now - datetime.timedelta(seconds=heartbeat_interval()):
+        MatchingRecord.objects.filter(pk=myrecord.pk).touch(now)
+
+    # 入れるルームが既にあればそれを返す
+    room = Room.objects.filter(
+        users=user_id,
+        is_active=True,
+        created_date__gte=myrecord.submission_time).order_by('-created_date').first()
+
+    if room is None:
+        # 承認待ちのルームがキャンセルされた場合
+        if myrecord.is_pending:
+            return None
+        # 待ち行列にいなければ並び直す
+        if is_queued(user_id):
+            return None
+        room = enqueue(myrecord)
+        if room is None or not room.users.filter(pk=user_id).exists():
+            return None
+        return room
+
+    if not myrecord.is_pending:
+        # 保留状態にする
+        MatchingRecord.objects.filter(pk=myrecord.pk).transition(
+            MatchingRecord.State.WAITING, MatchingRecord.State.PENDING)
+    return room
+
+
+# ルームの承認状態
+ROOM_COMPLETED = 'completed'
+ROOM_CANCELLED = 'cancelled'
+ROOM_PENDING = 'pending'
+# レコードのないメンバーがいる
+ROOM_MISSING = 'missing'
+
+
+def get_room_status(room_id, user_id=None):
+    """
+    ルームのメンバー全員のレコードから承認状態を返す
+    メンバーごとにレコードを引かず、1 クエリで集計する
+    ルームがない場合や user_id がメンバーでない場合は None
+    """
+    State = MatchingRecord.State
+    aggregates = dict(
+        members=Count('pk'),
+        records=Count('matchingrecord'),
+        cancelled=Count('pk', filter=Q(matchingrecord__state=State.INACTIVE)),
+        confirmed=Count('pk', filter=Q(matchingrecord__state=State.CONFIRMED)),
+    )
+    if user_id is not None:
+        aggregates['is_member'] = Count('pk', filter=Q(pk=user_id))
+    counts = User.objects.filter(room=room_id).aggregate(**aggregates)
+
+    if counts['members'] == 0 or counts.get('is_member') == 0:
+        return None
+    if counts['records'] < counts['members']:
+        return ROOM_MISSING
+    if counts['cancelled']:
+        return ROOM_CANCELLED
+    if counts['confirmed'] < counts['members']:
+        return ROOM_PENDING
+    return ROOM_COMPLETED
+
+
+def _current_room(user_id):
+    """ ユーザーが承認待ちのルーム """
+    record = MatchingRecord.objects.filter(user=user_id).first()
+    if record is None:
+        return None
+    return Room.objects.filter(
+        users=user_id,
+        is_active=True,
+        created_date__gte=record.submission_time).order_by('-created_date').first()
+
+
+def close_rooms(*room_ids):
+    """ ルームを無効にしてメンバーのキャッシュを消す """
+    Room.objects.filter(pk__in=room_ids).update(is_active=False)
+    membership.invalidate(*room_ids)
+
+
+def update_room_status(user_id):
+    """
+    ユーザーが承認待ちのルームの状態をメンバー全員に通知する
+    キャンセルされていればルームを無効にする
+    ルームの状態を返す（ルームがなければ None）
+    """
+    room = _current_room(user_id)
+    if room is None:
+        return None
+
+    status = get_room_status(room.pk)
+    if status == ROOM_CANCELLED:
+        close_rooms(room.pk)
+    if notifications.is_enabled():
+        notifications.notify_room_status(room.pk, status, room.users.values_list('pk', flat=True))
+    return status
+
+
+def leave_room(user_id):
+    """
+    承認待ちのルームをキャンセルする（登録解除の前に呼ぶ）
+    マッチングが完了したルームはそのまま
+    """
+    room = _current_room(user_id)
+    if room is None:
+        return
+
+    status = confirmations.UNKNOWN
+    if confirmations.is_enabled():
+        status = async_to_sync(confirmations.get_status)(room.pk, user_id)
+    if status == confirmations.UNKNOWN:
+        if get_room_status(room.pk) == ROOM_COMPLETED:
+            return
+    elif status == confirmations.COMPLETED:
+        return
+
+    close_rooms(room.pk)
+
+    # メンバーに通知する
+    if status != confirmations.UNKNOWN:
+        async_to_sync(confirmations.cancel)(room.pk, user_id)
+    else:
+        notifications.notify_room_status(room.pk, ROOM_CANCELLED, room.users.values_list('pk', flat=True))
+
+
+# 承認状態を MatchingRecord に反映（confirmations.persist から）
+def confirm_record(user_id):
+    MatchingRecord.objects.filter(user=user_id).transition(
+        MatchingRecord.State.PENDING, MatchingRecord.State.CONFIRMED)
+
+
+def confirm_room(room_id, user_id):
+    """
+    マッチングを承認してルームの状態を返す（1 トランザクション）
+    ルームがない場合や user_id がメンバーでない場合は None
+    この承認で全員そろったら人気度に加算する
+    """
+    if not room_id:
+        return None
+
+    # メンバーかどうかはキャッシュで調べる
+    if not membership.is_member(room_id, user_id):
+        return None
+
+    with transaction.atomic():
+        # メンバー全員のレコードを決まった順にロックし、同時に承認したメンバーを 1 人ずつ処理する
+        # （後から承認したメンバーが先の承認を見て、全員そろったことに気付けるようにする）
+        list(MatchingRecord.objects.select_for_update().filter(
+            user__in=Room.users.through.objects.filter(room=room_id).values('user'),
+        ).order_by('pk').values_list('pk', flat=True))
+
+        updated = MatchingRecord.objects.filter(user=user_id).transition(
+            MatchingRecord.State.PENDING, MatchingRecord.State.CONFIRMED)
+        if not updated:
+            return get_room_status(room_id)
+
+        status = update_room_status(user_id)
+        if status == ROOM_COMPLETED:
+            popularity.record_completion(user_id)
+        return status
+
+
+def touch(user_id, now=None):
+    """
+    クライアントからの応答を記録する（WebSocket のハートビートから）
+    待ち状態なのに待ち行列にいなければ（別の接続の切断で外された場合など）並び直す
+    """
+    touched = MatchingRecord.objects.filter(user=user_id).touch(now)
+    if touched and not is_queued(user_id):
+        record = MatchingRecord.objects.filter(user=user_id, state=MatchingRecord.State.WAITING).only(
+            'user', 'topic', 'number', 'submission_time').first()
+        if record is not None:
+            enqueue(record)
+    return touched
+
+
+def expire_stale(now=None):
+    """
+    last_seen が MATCHING_RECORD_TTL 秒より前の待ち状態・保留状態のレコードを無効にし、
+    それらのユーザーが承認待ちのルームをキャンセルする
+    レコードもルームもまとめて UPDATE する。無効にしたレコードの数を返す
+    """
+    State = MatchingRecord.State
+    cutoff = (now or timezone.now()) - datetime.timedelta(seconds=_record_ttl())
+
+    with transaction.atomic():
+        # 他のリクエストが処理中のレコードは次の回に回す
+        stale = dict(MatchingRecord.objects.select_for_update(skip_locked=True).filter(
+            state__in=[State.WAITING, State.PENDING],
+            last_seen__lt=cutoff).values_list('user', 'state'))
+        if not stale:
+            return 0
+
+        # 保留状態のユーザーが入っている、マッチング後に作られたルーム
+        pending_ids = [user_id for user_id, state in stale.items() if state == State.PENDING]
+        room_ids = []
+        if pending_ids:
+            room_ids = list(Room.objects.filter(
+                is_active=True,
+                users__in=pending_ids,
+                created_date__gte=F('users__matchingrecord__submission_time'),
+            ).values_list('pk', flat=True).distinct())
+        if room_ids:
+            close_rooms(*room_ids)
+
+        expired = MatchingRecord.objects.filter(user__in=list(stale)).transition(
+            [State.WAITING, State.PENDING], State.INACTIVE)
+
+        if room_ids:
+            members = defaultdict(list)
+            for room_id, user_id in Room.users.through.objects.filter(
+                    room__in=room_ids).values_list('room', 'user'):
+                members[room_id].append(user_id)
+            for room_id, user_ids in members.items():
+                if confirmations.is_enabled():
+                    # カウンタのキャンセルでメンバーに通知される
+                    transaction.on_commit(lambda room_id=room_id, user_id=user_ids[0]: async_to_sync(
+                        confirmations.cancel)(room_id, user_id))
+                else:
+                    notifications.notify_room_status(room_id, ROOM_CANCELLED, user_ids)
+
+    for user_id in stale:
+        engine.dequeue(user_id)
+    return expired
+
+
+# confirmations の結果を承認状態に変換
+COUNTER_STATUS = {
+    confirmations.CANCELLED: ROOM_CANCELLED,
+    confirmations.PENDING: ROOM_PENDING,
+    confirmations.COMPLETED: ROOM_COMPLETED,
+}
@@ -0,0 +1,45 @@
+"""
+ルームのメンバー
+
+ルームごとのメンバーの user_id をキャッシュに持ち、メンバーかどうかを
+ルームとユーザーの JOIN なしで調べる。
+ルームの作成時（コミット後）に登録し、ルームを閉じたときに消す。
+キャッシュになければ DB から読んで登録する（メンバーはルームの作成後に変わらない）。
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Room
+
+
+def _key(room_id):
+    return 'chatrooms:room_members:{}'.format(room_id)
+
+
+def _timeout():
+    return getattr(settings, 'ROOM_MEMBERS_CACHE_TIMEOUT', 60 * 60)
+
+
+# ルームの作成時
+def fill(room_id, user_ids):
+    cache.set(_key(room_id), [str(user_id) for user_id in user_ids], _timeout())
+
+
+# ルームを閉じたとき
+def invalidate(*room_ids):
+    cache.delete_many([_key(room_id) for room_id in room_ids])
+
+
+def get_members(room_id):
+    """ メンバーの user_id（文字列）のリスト。ルームがなければ空 """
+    members = cache.get(_key(room_id))
+    if members is None:
+        members = [str(user_id) for user_id in Room.users.through.objects.filter(
+            room=room_id).values_list('user', flat=True)]
+        # 読んでいる間に fill されていれば上書きしない
+        cache.add(_key(room_id), members, _timeout())
+    return members
+
+
+def is_member(room_id, user_id):
+    return str(user_id) in get_members(room_id)
@@ -0,0 +1,202 @@
+"""
+メトリクス
+
+プロセス内にカウンタ・ゲージ・ヒストグラムを持ち、Prometheus のテキスト形式で出力する。
+ヒストグラムは固定のバケットごとの件数と合計だけを持つので、観測のコストは
+ロック 1 回とバケットの二分探索だけで済む。
+
+    REQUESTS = registry.counter('name', 'help', ['label'])
+    REQUESTS.labels('value').inc()
+
+views.metrics（/metrics）で出力する。
+"""
+import bisect
+import threading
+
+
+# 秒
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# クエリ数
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+# バイト
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError('Expected labels {}'.format(self.labelnames))
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, values, child):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            for suffix, extra, value in self._samples(values, child):
+                lines.append('{}{}{} {}'.format(
+                    self.name, suffix, _format_labels(self.labelnames, values, extra), _format_value(value)))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+        self._function = None
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function):
+        """ 出力するときに function() の値を使う """
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return self._value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def _samples(self, values, child):
+        return [('_total', (), child.get())]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def _samples(self, values, child):
+        return [('', (), child.get())]
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def get(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _samples(self, values, child):
+        counts, total = child.get()
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', [('le', _format_value(float(bound)))], cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            # 同じ名前なら登録済みのものを返す（モジュールの再読み込み対策）
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
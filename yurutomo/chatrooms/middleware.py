@@ -0,0 +1,73 @@
+"""
+chatrooms の API（api/...）のリクエストごとに
+DB のクエリ数・DB の時間・全体の時間・レスポンスのサイズを metrics のヒストグラムに記録する。
+"""
+import time
+
+from django.db import connection
+
+from .metrics import registry, COUNT_BUCKETS, SIZE_BUCKETS
+
+
+REQUESTS = registry.counter(
+    'chatrooms_api_requests', 'Requests to chatrooms API endpoints.', ['endpoint', 'status'])
+DURATION = registry.histogram(
+    'chatrooms_api_request_duration_seconds', 'Total time of chatrooms API requests.', ['endpoint'])
+DB_QUERIES = registry.histogram(
+    'chatrooms_api_db_queries', 'DB queries per chatrooms API request.', ['endpoint'],
+    buckets=COUNT_BUCKETS)
+DB_DURATION = registry.histogram(
+    'chatrooms_api_db_duration_seconds', 'DB time per chatrooms API request.', ['endpoint'])
+RESPONSE_SIZE = registry.histogram(
+    'chatrooms_api_response_size_bytes', 'Response body size of chatrooms API requests.', ['endpoint'],
+    buckets=SIZE_BUCKETS)
+
+
+class _QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+def _endpoint(request):
+    """ chatrooms の api/... なら URL 名、それ以外は None """
+    match = request.resolver_match
+    if match is None or match.namespace != 'chatrooms' or not match.route.startswith('api/'):
+        return None
+    return match.url_name
+
+
+class ApiMetricsMiddleware:
+    """
+    セッションや認証のクエリも数えるので、MIDDLEWARE のなるべく先頭に置く
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = _QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        endpoint = _endpoint(request)
+        if endpoint is None:
+            return response
+
+        REQUESTS.labels(endpoint, response.status_code).inc()
+        DURATION.labels(endpoint).observe(duration)
+        DB_QUERIES.labels(endpoint).observe(timer.count)
+        DB_DURATION.labels(endpoint).observe(timer.duration)
+        if not response.streaming:
+            RESPONSE_SIZE.labels(endpoint).observe(len(response.content))
+        return response
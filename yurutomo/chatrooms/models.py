@@ -3,6 +3,7 @@ from django.db import models
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex
 
 
 User = get_user_model()
@@ -11,6 +12,12 @@ User = get_user_model()
 
 class Tag(models.Model):
     name = models.CharField(_('tag name'), max_length=255)
+
+    class Meta:
+        indexes = [
+            # 部分一致検索 (pg_trgm)
+            GinIndex(fields=['name'], name='tag_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
     
     def __str__(self):
         return self.name
@@ -30,6 +37,14 @@ class Topic(models.Model):
     name = models.CharField(_('topic name'), max_length=255)
     number = models.IntegerField(_('number'), default=2)
     tags = models.ManyToManyField(Tag, blank=True)
+    # 人気度（popularity.py で加算する）
+    popularity = models.FloatField(_('popularity'), default=0, db_index=True)
+
+    class Meta:
+        indexes = [
+            # 部分一致検索・類似度順 (pg_trgm)
+            GinIndex(fields=['name'], name='topic_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.name
@@ -61,13 +76,111 @@ class Room(models.Model):
 
     is_active = models.BooleanField(_('active'), default=False)
 
+    class Meta:
+        indexes = [
+            # マッチングしたルームの検索 (users, is_active, created_date >= X) ORDER BY -created_date
+            models.Index(fields=['is_active', '-created_date'], name='room_active_created_idx'),
+        ]
+
+
+class MatchingRecordQuerySet(models.QuerySet):
+
+    def transition(self, from_states, to_state, **fields):
+        """
+        状態が from_states のレコードを to_state に変更する
+        UPDATE ... WHERE state IN (from_states) の 1 文で行い、変更した件数を返す
+        """
+        if not isinstance(from_states, (list, tuple, set)):
+            from_states = [from_states]
+        for from_state in from_states:
+            if to_state not in MatchingRecord.TRANSITIONS[from_state]:
+                raise ValueError('Invalid transition: {} -> {}'.format(
+                    MatchingRecord.State(from_state).label, MatchingRecord.State(to_state).label))
+        return self.filter(state__in=from_states).update(state=to_state, **fields)
+
+    def register(self, user_id, topic, number, submission_time):
+        """
+        マッチングに登録する
+        既に待ち状態であれば登録せずに None を返す
+        """
+        State = MatchingRecord.State
+        fields = dict(topic=topic, number=number, submission_time=submission_time, last_seen=submission_time)
+
+        updated = self.filter(user=user_id).transition(State.INACTIVE, State.WAITING, **fields)
+        if updated:
+            return MatchingRecord(user_id=user_id, state=State.WAITING, **fields)
+
+        record, created = self.get_or_create(user_id=user_id, defaults=dict(state=State.WAITING, **fields))
+        if not created:
+            return None
+        return record
+
+    def touch(self, now=None):
+        """ マッチング中のレコードの最終応答時刻を更新する """
+        return self.filter(state__in=MatchingRecord.ACTIVE_STATES).update(last_seen=now or timezone.now())
+
 
 class MatchingRecord(models.Model):
+
+    class State(models.IntegerChoices):
+        INACTIVE = 0, _('inactive')
+        WAITING = 1, _('waiting for matching')
+        PENDING = 2, _('waiting for confirmation')
+        CONFIRMED = 3, _('confirmed')
+
+    # 状態遷移 (変更前 -> 変更後)
+    TRANSITIONS = {
+        # マッチング登録
+        State.INACTIVE: {State.WAITING},
+        # マッチング成立 / 登録解除
+        State.WAITING: {State.PENDING, State.INACTIVE},
+        # 承認 / 登録解除 / 承認キャンセル（承認の書き込みがまだのとき）
+        State.PENDING: {State.CONFIRMED, State.INACTIVE, State.WAITING},
+        # 承認キャンセル / 登録解除
+        State.CONFIRMED: {State.WAITING, State.INACTIVE},
+    }
+
+    # マッチング中の状態
+    ACTIVE_STATES = [State.WAITING, State.PENDING, State.CONFIRMED]
+
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE, null=True)
     number = models.IntegerField(_('number of users'), default=2)
     submission_time = models.DateTimeField(_('submission time'), default=timezone.now)
 
-    is_active = models.BooleanField(_('is waiting for matching'), default=False)
-    is_pending = models.BooleanField(_('is waiting for confirmation'), default=False)
-    is_confirmed = models.BooleanField(_('is confirmed'), default=False)
\ No newline at end of file
+    state = models.PositiveSmallIntegerField(_('state'), choices=State.choices, default=State.INACTIVE)
+    # クライアントから最後に応答があった時刻（ポーリング・ハートビート）
+    last_seen = models.DateTimeField(_('last seen'), default=timezone.now)
+
+    objects = MatchingRecordQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # 条件の一致するレコードを登録順に取得
+            models.Index(
+                fields=['topic', 'number', 'state', 'submission_time'],
+                name='matching_condition_idx'),
+            # 待ち状態のレコードのみ
+            models.Index(
+                fields=['topic', 'number', 'submission_time'],
+                name='matching_waiting_idx',
+                condition=models.Q(state=1)),  # State.WAITING
+            models.Index(fields=['state'], name='matching_state_idx'),
+            # 応答のなくなったレコードの検索
+            models.Index(fields=['state', 'last_seen'], name='matching_last_seen_idx'),
+        ]
+
+    # マッチング中か
+    @property
+    def is_active(self):
+        return self.state != self.State.INACTIVE
+
+    # 承認待ちか
+    @property
+    def is_pending(self):
+        return self.state == self.State.PENDING
+
+    # 承認済みか
+    @property
+    def is_confirmed(self):
+        return self.state == self.State.CONFIRMED
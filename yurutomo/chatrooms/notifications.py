@@ -0,0 +1,87 @@
+"""
+マッチング状態のプッシュ通知
+
+ルームの作成や承認状態の変化を、各ユーザーのグループ（グループ名 = user_id）へ
+group_send で送る。MatchingConsumer がクライアントへ転送するので、
+クライアントはポーリングせずに待つことができる。
+
+settings.MATCHING_PUSH_NOTIFICATIONS が False なら何もしない。
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+
+from . import protocol
+
+
+def is_enabled():
+    return getattr(settings, 'MATCHING_PUSH_NOTIFICATIONS', False)
+
+
+def _send(user_ids, event):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    send = async_to_sync(channel_layer.group_send)
+    for user_id in user_ids:
+        send(str(user_id), event)
+
+
+def _send_on_commit(user_ids, event):
+    # ルームの作成がコミットされてから通知する
+    user_ids = [str(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: _send(user_ids, event))
+
+
+# マッチングしたことを通知
+def notify_matched(room, user_ids):
+    if not is_enabled():
+        return
+    room_id = str(room.pk)
+    room_url = reverse('chatrooms:room', kwargs={'pk': room.pk})
+    _send_on_commit(user_ids, {
+        'type': 'match.found',
+        'room_id': room_id,
+        'room_url': room_url,
+        'group_size': len(user_ids),
+        # 全員に同じフレームを送るので先に作っておく
+        'frames': protocol.encode_frames({
+            'room_id': room_id,
+            'room_url': room_url,
+            'message': 'got matched!',
+        }),
+    })
+
+
+def _room_status_event(room_id, status):
+    return {
+        'type': 'room.status',
+        'room_id': str(room_id),
+        'status': status,
+        'frames': protocol.encode_frames({
+            'room_id': str(room_id),
+            'status': status,
+            'message': 'room status',
+        }),
+    }
+
+
+# 承認状態の変化を通知
+def notify_room_status(room_id, status, user_ids):
+    if not is_enabled():
+        return
+    _send_on_commit(user_ids, _room_status_event(room_id, status))
+
+
+# 承認状態の変化を通知（非同期コンテキストから）
+async def send_room_status(room_id, status, user_ids):
+    if not is_enabled():
+        return
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = _room_status_event(room_id, status)
+    for user_id in user_ids:
+        await channel_layer.group_send(str(user_id), event)
@@ -0,0 +1,89 @@
+"""
+トピックの人気度
+
+マッチング登録とマッチング完了のたびに Topic.popularity を加算する。
+時間がたつほど古いイベントの重みが半減期ごとに半分になるように、
+加算する値を基準時刻からの経過時間で 2 ** (経過時間 / 半減期) 倍にしておく。
+全トピックが同じ割合で減衰するので、popularity の大きい順がそのまま人気順になり、
+定期的に減衰させる処理は要らない。
+
+2 ** (経過時間 / 半減期) はすぐに float の範囲を超えるので、popularity には
+重みの合計の自然対数を持ち、log-sum-exp で加算する（大小関係は変わらない）。
+
+人気トピックの一覧はキャッシュし、一定時間ごとに作り直す。
+"""
+import datetime
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Abs, Exp, Greatest, Least, Ln
+from django.utils import timezone
+
+from .models import Topic, MatchingRecord
+
+
+# 基準時刻
+EPOCH = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+# イベントの重み
+REGISTRATION_WEIGHT = 1.0
+COMPLETION_WEIGHT = 3.0
+
+CACHE_KEY = 'chatrooms:popular_topics'
+
+
+def _half_life():
+    return getattr(settings, 'TOPIC_POPULARITY_HALF_LIFE', datetime.timedelta(days=7))
+
+
+# Postgres の EXP は小さすぎる値でアンダーフローのエラーになるので差をここで打ち切る
+# （e ** -700 は加算しても変わらない）
+MAX_LOG_DIFFERENCE = 700.0
+
+
+def _exponent(now=None):
+    """ 基準時刻からの経過時間による倍率の自然対数 """
+    now = now or timezone.now()
+    return (now - EPOCH) / _half_life() * math.log(2)
+
+
+def _add(topic_id, weight):
+    # popularity = ln(e ** popularity + weight * 2 ** (経過時間 / 半減期))
+    #            = max(a, b) + ln(1 + e ** -|a - b|)
+    a = F('popularity')
+    b = Value(math.log(weight) + _exponent(), output_field=FloatField())
+    difference = Least(Abs(a - b), Value(MAX_LOG_DIFFERENCE, output_field=FloatField()))
+    one = Value(1.0, output_field=FloatField())
+    Topic.objects.filter(pk=topic_id).update(popularity=Greatest(a, b) + Ln(one + Exp(-difference)))
+
+
+# マッチング登録
+def record_registration(topic_id):
+    if topic_id is None:
+        return
+    _add(topic_id, REGISTRATION_WEIGHT)
+
+
+# マッチング完了
+def record_completion(user_id):
+    topic_id = MatchingRecord.objects.filter(user=user_id).values_list('topic', flat=True).first()
+    if topic_id is None:
+        return
+    _add(topic_id, COMPLETION_WEIGHT)
+
+
+def get_popular_topics():
+    """ 人気トピックの上位（キャッシュから） """
+    topics = cache.get(CACHE_KEY)
+    if topics is None:
+        limit = getattr(settings, 'POPULAR_TOPICS_LIMIT', 20)
+        topics = [topic.data() for topic in Topic.objects.order_by('-popularity', 'name')[:limit]]
+        cache.set(CACHE_KEY, topics, getattr(settings, 'POPULAR_TOPICS_CACHE_TIMEOUT', 60))
+    return topics
+
+
+# トピックが追加・削除されたとき
+def invalidate():
+    cache.delete(CACHE_KEY)
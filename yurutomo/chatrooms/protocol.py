@@ -0,0 +1,147 @@
+"""
+WebSocket のメッセージ形式
+
+接続時にクライアントが Sec-WebSocket-Protocol で MSGPACK_SUBPROTOCOL を
+指定していれば msgpack のバイナリフレームでやり取りする。
+  - method は文字列の代わりに METHOD_CODES の整数
+  - datetime はエポックからのミリ秒（整数）
+指定がなければ従来どおり JSON のテキストフレームを使う。
+"""
+import json
+
+import msgpack
+from django.utils import timezone
+
+
+MSGPACK_SUBPROTOCOL = 'yurutomo.msgpack.v1'
+
+# method の整数コード
+METHOD_CODES = {
+    'start_wait': 1,
+    'quit_wait': 2,
+    'get_room': 3,
+    'status': 4,
+    'confirm_matching': 5,
+    'heartbeat': 6,
+}
+METHOD_NAMES = {code: name for name, code in METHOD_CODES.items()}
+
+
+class TimestampFormatter:
+    """
+    日時を '%d-%m-%Y:%H:%M:%S.ffffff' にする
+    localtime と秒までの書式化は秒が変わったときだけ行う
+    """
+
+    def __init__(self):
+        # (エポック秒, 秒までの文字列)
+        self._cache = (None, '')
+
+    def format(self, now=None):
+        now = now or timezone.now()
+        second = int(now.timestamp())
+        cached_second, prefix = self._cache
+        if cached_second != second:
+            prefix = '{:%d-%m-%Y:%H:%M:%S}'.format(timezone.localtime(now))
+            self._cache = (second, prefix)
+        return '{}.{:06d}'.format(prefix, now.microsecond)
+
+
+_formatter = TimestampFormatter()
+
+
+class JsonCodec:
+    """ JSON（テキストフレーム） """
+    name = 'json'
+    subprotocol = None
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            return None
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def frame(self, raw):
+        return {'text_data': raw}
+
+    def encode(self, data):
+        return self.frame(self.dumps(data))
+
+    def timestamp(self, now=None):
+        return _formatter.format(now)
+
+
+class MsgpackCodec:
+    """ msgpack（バイナリフレーム） """
+    name = 'msgpack'
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return None
+        try:
+            data = msgpack.unpackb(bytes_data, raw=False)
+        except (ValueError, msgpack.UnpackException):
+            return None
+        if not isinstance(data, dict):
+            return None
+        method = data.get('method')
+        if isinstance(method, int):
+            data['method'] = METHOD_NAMES.get(method)
+        return data
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def frame(self, raw):
+        return {'bytes_data': raw}
+
+    def encode(self, data):
+        return self.frame(self.dumps(data))
+
+    def timestamp(self, now=None):
+        now = now or timezone.now()
+        return int(now.timestamp() * 1000)
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec()
+CODECS = (JSON, MSGPACK)
+
+
+def encode_frames(data, timestamp=False, now=None):
+    """
+    全形式のフレームを 1 回ずつ作る
+    group_send のイベントに入れておけば、受け取った各コンシューマーは
+    変換せずにそのまま送ればよい
+    """
+    now = now or timezone.now()
+    frames = {}
+    for codec in CODECS:
+        payload = data
+        if timestamp:
+            payload = dict(data, datetime=codec.timestamp(now))
+        frames[codec.name] = codec.dumps(payload)
+    return frames
+
+
+def group_message(message):
+    """ タイムスタンプ付きメッセージの send.message イベント """
+    return {
+        'type': 'send.message',
+        'message': message,
+        'frames': encode_frames({'message': message}, timestamp=True),
+    }
+
+
+def negotiate(subprotocols):
+    """ クライアントが指定したサブプロトコルから形式を選ぶ """
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return MSGPACK
+    return JSON
@@ -0,0 +1,56 @@
+"""
+WebSocket のメソッドごとの流量制限
+
+接続ごと・メソッドごとにトークンバケットを持つ。
+1 秒あたり rate 個ずつトークンが増え（最大 burst 個）、1 メッセージで 1 個使う。
+トークンがなければそのメッセージは処理しない。
+
+settings.WS_RATE_LIMITS = {method: (rate, burst), 'default': (rate, burst)}
+"""
+import time
+
+from django.conf import settings
+
+
+DEFAULT_RATE_LIMITS = {
+    'default': (5, 10),
+}
+
+
+def get_limit(method):
+    limits = getattr(settings, 'WS_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+    return limits.get(method) or limits.get('default') or DEFAULT_RATE_LIMITS['default']
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def consume(self, tokens=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class RateLimiter:
+    """ 1 接続分のトークンバケット（メソッドごと） """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buckets = {}
+
+    def allow(self, method):
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            rate, burst = get_limit(method)
+            bucket = self._buckets[method] = TokenBucket(rate, burst, self.clock)
+        return bucket.consume()
@@ -0,0 +1,65 @@
+"""
+応答のなくなったマッチングの掃除
+
+ASGI プロセスのイベントループで MATCHING_REAPER_INTERVAL 秒ごとに matching.expire_stale を呼ぶ。
+待ち行列（matching.engine）はプロセスごとに持つので、同じプロセスで動かす
+（asgi.py の ReaperMiddleware が最初の接続を受けたときに始める）。
+MATCHING_REAPER_INTERVAL が 0 なら動かさない。
+"""
+import asyncio
+import logging
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from . import matching
+from .metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+EXPIRED = registry.counter(
+    'chatrooms_matching_expired', 'Matching records expired because the client stopped responding.')
+
+
+def interval():
+    return getattr(settings, 'MATCHING_REAPER_INTERVAL', 30)
+
+
+# id(loop) -> 掃除のタスク
+_tasks = {}
+
+
+async def run():
+    expire_stale = DatabaseSyncToAsync(matching.expire_stale, thread_sensitive=False)
+    while True:
+        await asyncio.sleep(interval())
+        try:
+            expired = await expire_stale()
+        except Exception:
+            logger.exception('reaper failed')
+            continue
+        if expired:
+            EXPIRED.labels().inc(expired)
+            logger.info('expired matching records', extra={'count': expired})
+
+
+def start(loop=None):
+    """ イベントループで掃除を始める（ループごとに 1 回だけ） """
+    if not interval():
+        return
+    loop = loop or asyncio.get_event_loop()
+    if id(loop) in _tasks:
+        return
+    _tasks[id(loop)] = loop.create_task(run())
+
+
+class ReaperMiddleware:
+    """ 最初の接続を受けたときに掃除を始める ASGI ミドルウェア """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        start(asyncio.get_running_loop())
+        return await self.app(scope, receive, send)
@@ -0,0 +1,55 @@
+"""
+ルームのメンバー表
+
+ルームのページで使うメンバーの名前とアイコンの URL・縮小版の srcset（uuid ごと）を
+JSON にしてキャッシュに持つ。ページを開くたびに User を読んでアイコンの URL を
+解決する代わりに、キャッシュの 1 つの値からそのまま描画する。
+ルームの作成時（コミット後）に作り、プロフィールを変更したときに作り直す。
+"""
+import json
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from accounts import icons
+from .models import Room
+
+
+User = get_user_model()
+
+
+def _key(room_id):
+    return 'chatrooms:room_roster:{}'.format(room_id)
+
+
+def _timeout():
+    return getattr(settings, 'ROOM_ROSTER_CACHE_TIMEOUT', 60 * 60)
+
+
+def build(room_id):
+    """ DB からメンバー表を作ってキャッシュに入れる """
+    members = User.objects.filter(room=room_id).only('uuid', 'username', 'icon_image', 'icon_processed')
+    roster = {
+        'member_names': json.dumps({str(member.uuid): member.username for member in members}),
+        'member_icons': json.dumps({str(member.uuid): icons.icon_url(member) for member in members}),
+        # 縮小版がまだなければ含めない（member_icons を使う）
+        'member_icon_sets': json.dumps({
+            str(member.uuid): icons.srcset(member) for member in members if member.icon_processed}),
+    }
+    cache.set(_key(room_id), roster, _timeout())
+    return roster
+
+
+def get_roster(room_id):
+    """ {'member_names': JSON, 'member_icons': JSON, 'member_icon_sets': JSON} """
+    roster = cache.get(_key(room_id))
+    if roster is None:
+        roster = build(room_id)
+    return roster
+
+
+def refresh_user(user_id):
+    """ ユーザーが入っている有効なルームのメンバー表を作り直す（プロフィールの変更時） """
+    for room_id in Room.objects.filter(users=user_id, is_active=True).values_list('pk', flat=True):
+        build(room_id)
@@ -0,0 +1,40 @@
+"""
+トピック検索
+
+キーワードごとに Topic.name と Tag.name の部分一致を AND で絞り込む。
+タグは JOIN せずにサブクエリで引くので、同じトピックが重複しない。
+PostgreSQL では pg_trgm の GIN インデックスで ILIKE '%...%' を引き、
+トライグラム類似度の高い順に並べる。
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from .models import Topic, Tag
+
+
+def _limit():
+    return getattr(settings, 'TOPIC_SEARCH_LIMIT', 20)
+
+
+def search_topics(search_text, limit=None):
+    if limit is None:
+        limit = _limit()
+
+    if search_text == '/all':
+        # allコマンド = 全データ
+        return list(Topic.objects.order_by('name')[:limit])
+
+    query = Q()
+    for keyword in search_text.split():
+        tagged = Tag.objects.filter(name__icontains=keyword).values('topic')
+        query &= Q(name__icontains=keyword) | Q(pk__in=tagged)
+
+    result = Topic.objects.filter(query)
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import TrigramSimilarity
+        result = result.annotate(
+            similarity=TrigramSimilarity('name', search_text)).order_by('-similarity', 'name')
+    else:
+        result = result.order_by('name')
+    return list(result[:limit])
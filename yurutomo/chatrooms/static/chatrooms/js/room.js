@@ -22,6 +22,8 @@ const room = new Vue({
         // Peer
         peerId: "",
 
+        // 自分の ID
+        userId: userId,
         // Room
         roomId: roomId,
         roomMode: "sfu", // sfu or mesh
@@ -31,6 +33,8 @@ const room = new Vue({
         memberNames: memberNames,
         // Peer ID とアイコン画像の対応表
         memberIcons: memberIcons,
+        // Peer ID とアイコンの縮小版（srcset）の対応表
+        memberIconSets: memberIconSets,
 
         // ストリーム
         localStream: {    // 自分のストリーム
@@ -6,6 +6,7 @@ const app = new Vue({
         url: {
             popularTopics: popularTopicsUrl,
             searchTopics: searchTopicsUrl,
+            suggestTopics: suggestTopicsUrl,
             createTopic: createTopicUrl,
 
             register: registerUrl,
@@ -18,8 +19,20 @@ const app = new Vue({
         param: {},
         csrftoken: null,
 
+        // サーバーからのプッシュ通知
+        pushEnabled: matchingPushEnabled,
+        socket: null,
+        // マッチング中に送るハートビートの間隔（ミリ秒）
+        heartbeatInterval: matchingHeartbeatInterval * 1000,
+        heartbeatTimerId: null,
+        // 切断されたときの再接続
+        reconnectDelay: 1000,
+        reconnectTimerId: null,
+
         // マッチング待ち中か
         isMatching: false,
+        // 承認して他のユーザーを待っているか
+        isConfirmed: false,
 
         showMatching: true,
         showWaiting: false,
@@ -78,6 +91,10 @@ const app = new Vue({
         // マッチング登録状況をリセットする
         this.quit();
         this.matchingMessageText = "";
+
+        if (this.pushEnabled) {
+            this.connectSocket();
+        }
     },
     computed: {
         // マッチングボタン押せない
@@ -124,6 +141,25 @@ const app = new Vue({
             })
         },
 
+        // 入力中のtopicを補完
+        suggestTopics: function () {
+            const prefix = this.searchText.trim();
+            if (prefix.length == 0 || prefix.startsWith("/")) {
+                return;
+            }
+
+            axios.get(this.url.suggestTopics, {
+                params: {
+                    prefix: prefix,
+                }
+            }).then((result) => {
+                // 返ってくる前に入力が変わっていれば捨てる
+                if (this.searchText.trim() === prefix) {
+                    this.searchResult = result.data.topics;
+                }
+            })
+        },
+
         // topicを追加
         createTopic: function () {
             this.newTopic = this.newTopic.trim();
@@ -165,6 +201,77 @@ const app = new Vue({
             return cleanedName;
         },
 
+        // プッシュ通知を受け取る WebSocket に接続
+        connectSocket: function () {
+            const scheme = location.protocol === "https:" ? "wss://" : "ws://";
+            // msgpack が読み込めていればバイナリでやり取りする（なければ JSON）
+            const protocols = (typeof MessagePack !== "undefined") ? [msgpackSubprotocol] : [];
+            this.socket = new WebSocket(scheme + location.host + "/ws/room-match/", protocols);
+            this.socket.binaryType = "arraybuffer";
+
+            this.socket.onopen = () => {
+                this.reconnectDelay = 1000;
+            };
+
+            this.socket.onmessage = (event) => {
+                const data = (typeof event.data === "string")
+                    ? JSON.parse(event.data)
+                    : MessagePack.decode(new Uint8Array(event.data));
+                if (data.message === "got matched!") {
+                    if (!this.isMatching || this.showConfirm) {
+                        return;
+                    }
+                    this.onMatched(data.room_id, data.room_url);
+                } else if (data.message === "room status") {
+                    if (data.room_id !== this.roomId) {
+                        return;
+                    }
+                    this.onRoomStatus(data.status === "completed", data.status === "cancelled");
+                }
+            };
+
+            // マッチング中はハートビートを送る（送らなくなるとサーバー側でマッチングが無効になる）
+            this.heartbeatTimerId = setInterval(() => {
+                if (this.isMatching && this.isPushReady()) {
+                    this.sendSocket({ method: "heartbeat" });
+                }
+            }, this.heartbeatInterval);
+
+            // 切断されたらポーリングに戻し、間隔を空けながら再接続する
+            this.socket.onclose = () => {
+                clearInterval(this.heartbeatTimerId);
+                this.socket = null;
+
+                if (this.isMatching && this.showWaiting) {
+                    this.setMatchingWaitTimer(2000);
+                } else if (this.isMatching && this.isConfirmed) {
+                    this.setCompleteWaitTimer(1000);
+                }
+
+                clearTimeout(this.reconnectTimerId);
+                this.reconnectTimerId = setTimeout(() => {
+                    this.connectSocket();
+                }, this.reconnectDelay);
+                this.reconnectDelay = Math.min(this.reconnectDelay * 2, 30000);
+            };
+        },
+
+        // 接続時に決めた形式で送信（msgpack なら method は整数コード）
+        sendSocket: function (data) {
+            if (this.socket.protocol === msgpackSubprotocol) {
+                this.socket.send(MessagePack.encode(Object.assign({}, data, {
+                    method: msgpackMethodCodes[data.method],
+                })));
+                return;
+            }
+            this.socket.send(JSON.stringify(data));
+        },
+
+        // プッシュ通知を受け取れる状態か
+        isPushReady: function () {
+            return this.socket !== null && this.socket.readyState === WebSocket.OPEN;
+        },
+
         startLifeGuage: function () {
             this.lifeBar = document.getElementById('life-progressbar');
             this.lifeBar.value = 100;
@@ -214,6 +321,7 @@ const app = new Vue({
         // マッチング登録解除
         quit: function () {
             this.isMatching = false;
+            this.isConfirmed = false;
             this.showConfirm = false;
             this.showWaiting = false;
             this.showMatching = true;
@@ -237,7 +345,9 @@ const app = new Vue({
         // マッチング承認
         confirm: function () {
             this.stopLifeGuage();
-            axios.post(this.url.confirm, {}, {
+            axios.post(this.url.confirm, {
+                room_id: this.roomId
+            }, {
                 headers: { "Content-type": "application/json", "X-CSRFToken": this.csrftoken }
             })
                 .then((result) => {
@@ -258,7 +368,9 @@ const app = new Vue({
         // マッチング承認をキャンセル
         cancelConfirm: function () {
             this.stopLifeGuage();
-            return axios.post(this.url.cancel, {}, {
+            return axios.post(this.url.cancel, {
+                room_id: this.roomId
+            }, {
                 headers: { "Content-type": "application/json", "X-CSRFToken": this.csrftoken }
             })
         },
@@ -281,26 +393,76 @@ const app = new Vue({
             clearTimeout(this.timer.confirmDisplayTimerId);
         },
 
+        // マッチングしたとき
+        onMatched: function (roomId, roomUrl) {
+            this.roomId = roomId;
+            this.roomUrl = roomUrl;
+            clearInterval(this.timer.matchingWaitTimerId);
+            this.isConfirmed = false;
+
+            // 最長10秒間承認ボタンを表示
+            this.showMatching = false;
+            this.showWaiting = false;
+            this.showConfirm = true;
+            this.startLifeGuage();
+            this.timer.confirmDisplayTimerId = setTimeout(this.quit, 10000);
+        },
+
+        // 承認状態を受け取ったとき
+        onRoomStatus: function (isCompleted, isCancelled) {
+            // 誰かがキャンセルしたとき
+            if (isCancelled) {
+                this.flashMatchingMessage("他のユーザーがキャンセルしました");
+
+                clearInterval(this.timer.completeWaitTimerId);
+
+                // 自分も承認をキャンセル
+                this.cancelConfirm()
+                    .then((result) => {
+                        console.log(result.data);
+                        if (result.data.is_cancelled) {
+                            // 再びマッチング待ち
+                            this.setMatchingWaitTimer(2000);
+                            return;
+                        }
+                    })
+
+            }
+            // マッチング完了したとき
+            if (isCompleted) {
+                clearInterval(this.timer.completeWaitTimerId);
+
+                // ルームへ移動
+                location.href = this.roomUrl;
+                return;
+            }
+        },
+
         // マッチングを待つ
         setMatchingWaitTimer: function (interval) {
+            this.isConfirmed = false;
             this.showConfirm = false;
             this.showMatching = false;
             this.showWaiting = true;
+
+            // プッシュ通知が使えるならポーリングしない（一度だけ確認する）
+            if (this.isPushReady()) {
+                axios.get(this.url.getMatchRoom)
+                    .then((result) => {
+                        if (result.data.is_matched) {
+                            this.onMatched(result.data.room_id, result.data.room_url);
+                        }
+                    })
+                return;
+            }
+
+            clearInterval(this.timer.matchingWaitTimerId);
             this.timer.matchingWaitTimerId = setInterval((getRoomId = () => {
                 axios.get(this.url.getMatchRoom)
                     .then((result) => {
                         // マッチングした場合
                         if (result.data.is_matched) {
-                            this.roomId = result.data.room_id;
-                            this.roomUrl = result.data.room_url;
-                            clearInterval(this.timer.matchingWaitTimerId);
-
-                            // 最長10秒間承認ボタンを表示
-                            this.showMatching = false;
-                            this.showWaiting = false;
-                            this.showConfirm = true;
-                            this.startLifeGuage();
-                            this.timer.confirmDisplayTimerId = setTimeout(this.quit, 10000);
+                            this.onMatched(result.data.room_id, result.data.room_url);
                         }
                     })
                     .catch((error) => {
@@ -313,9 +475,17 @@ const app = new Vue({
 
         // マッチング承認を待つ
         setCompleteWaitTimer: function (interval) {
+            this.isConfirmed = true;
             this.showConfirm = true;
             this.showMatching = false;
             this.showWaiting = false;
+
+            // プッシュ通知が使えるなら room status を待つ
+            if (this.isPushReady()) {
+                return;
+            }
+
+            clearInterval(this.timer.completeWaitTimerId);
             this.timer.completeWaitTimerId = setInterval((getMatchCompleted = () => {
                 axios.get(this.url.isCompleted, {
                     params: {
@@ -323,32 +493,7 @@ const app = new Vue({
                     }
                 })
                     .then((result) => {
-                        // 誰かがキャンセルしたとき
-                        if (result.data.is_cancelled) {
-                            this.flashMatchingMessage("他のユーザーがキャンセルしました");
-
-                            clearInterval(this.timer.completeWaitTimerId);
-
-                            // 自分も承認をキャンセル
-                            this.cancelConfirm()
-                                .then((result) => {
-                                    console.log(result.data);
-                                    if (result.data.is_cancelled) {
-                                        // 再びマッチング待ち
-                                        this.setMatchingWaitTimer(2000);
-                                        return;
-                                    }
-                                })
-
-                        }
-                        // マッチング完了したとき
-                        if (result.data.is_completed) {
-                            clearInterval(this.timer.completeWaitTimerId);
-
-                            // ルームへ移動
-                            location.href = this.roomUrl;
-                            return;
-                        }
+                        this.onRoomStatus(result.data.is_completed, result.data.is_cancelled);
                     })
                     .catch((error) => {
                         console.log(error);
@@ -1,20 +1,51 @@
+import io
+import asyncio
 import json
-from django.test import TestCase
+import math
+import time
+import uuid
+import logging
+import threading
+import datetime
+from unittest import mock
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, override_settings
+from django.db import connection, transaction
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.test import Client
+from django.utils import timezone
+from django.core.cache import cache
+from asgiref.sync import async_to_sync
+from channels.db import DatabaseSyncToAsync
+from channels.exceptions import ChannelFull
+from channels.testing import WebsocketCommunicator
+import msgpack
 
-from .models import Room, MatchingRecord, Topic
+from .models import Room, MatchingRecord, Topic, Tag
+from . import autocomplete, bench, confirmations, matching, membership, metrics, popularity, protocol, roster
+from .matching import MatchingEngine, engine
+from .consumers import CONNECTIONS, HANDLER_DURATION, MatchingConsumer, _method_label
+from .layers import SimulatedChannelLayer
+from .logs import JsonFormatter, QueueStreamHandler
+from .ratelimit import RateLimiter, TokenBucket
+from yurutomo.dbpool import BoundedExecutor
 
 User = get_user_model()
 
+# Redis なしでテストする
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
 
 # マッチング登録のテスト
 class MatchingRegisterTests(TestCase):
     def setUp(self):
-        self.user = User.objects.create_user(
-            'testuser', 'test@gmail.com', 'password')
+        self.user = User.objects.create_user('testuser', password='password')
         self.topic = Topic.objects.create(name='Test')
+        engine.clear()
 
     # ログインしていない場合
     def test_not_logged_in(self):
@@ -43,7 +74,7 @@ class MatchingRegisterTests(TestCase):
     def test_already_registered(self):
         topic = 'Test'
         number = 3
-        record = MatchingRecord.objects.create(user=self.user, topic=self.topic, number=number, is_active=True)
+        record = MatchingRecord.objects.create(user=self.user, topic=self.topic, number=number, state=MatchingRecord.State.WAITING)
         record.save()
 
         self.client.force_login(self.user)
@@ -82,9 +113,9 @@ class MatchingRegisterTests(TestCase):
 # マッチング登録解除のテスト
 class MatchingUnregisterTests(TestCase):
     def setUp(self):
-        self.user = User.objects.create_user(
-            'testuser', 'test@gmail.com', 'password')
+        self.user = User.objects.create_user('testuser', password='password')
         self.topic = Topic.objects.create(name='Test')
+        engine.clear()
 
     # ログインしていない場合
     def test_not_logged_in(self):
@@ -105,7 +136,7 @@ class MatchingUnregisterTests(TestCase):
     def test_registered(self):
         topic = 'Test'
         number = 3
-        record = MatchingRecord.objects.create(user=self.user, topic=self.topic, number=number, is_active=True)
+        record = MatchingRecord.objects.create(user=self.user, topic=self.topic, number=number, state=MatchingRecord.State.WAITING)
 
         self.client.force_login(self.user)
         response = self.client.post(reverse('chatrooms:unregister_matching'), data=json.dumps({}), content_type='application/json')
@@ -123,9 +154,9 @@ class MatchingUnregisterTests(TestCase):
 # マッチング待ちのテスト
 class GetMatchRoomTests(TestCase):
     def setUp(self):
-        self.user = User.objects.create_user(
-            'testuser', 'test@gmail.com', 'password')
+        self.user = User.objects.create_user('testuser', password='password')
         self.topic = Topic.objects.create(name='Test')
+        engine.clear()
     
     # ログインしていない場合
     def test_not_logged_in(self):
@@ -194,7 +225,7 @@ class GetMatchRoomTests(TestCase):
         c1 = Client()
         c1.force_login(self.user)
         c2 = Client()
-        c2.force_login(User.objects.create_user('testuser2', 'test2@gmail.com', 'password2'))
+        c2.force_login(User.objects.create_user('testuser2', password='password2'))
 
         post_data = {
             'condition': {
@@ -213,13 +244,35 @@ class GetMatchRoomTests(TestCase):
         self.assertTrue(response2.json()['is_matched'])
         self.assertEqual(response1.json()['room_id'], response2.json()['room_id'])
     
+    # 人数が揃った時点でルームが作られる
+    def test_room_created_on_register(self):
+        user2 = User.objects.create_user('testuser2', password='password2')
+        c1 = Client()
+        c1.force_login(self.user)
+        c2 = Client()
+        c2.force_login(user2)
+
+        post_data = {
+            'condition': {
+                'topic': 'Test',
+                'number': 2
+            }
+        }
+        c1.post(reverse('chatrooms:register_matching'), data=json.dumps(post_data), content_type='application/json')
+        self.assertFalse(Room.objects.filter(users=self.user).exists())
+        c2.post(reverse('chatrooms:register_matching'), data=json.dumps(post_data), content_type='application/json')
+
+        room = Room.objects.get(users=self.user)
+        self.assertEqual(set(room.users.values_list('pk', flat=True)), {self.user.pk, user2.pk})
+        self.assertEqual(MatchingRecord.objects.filter(state=MatchingRecord.State.PENDING).count(), 2)
+
     # 3人以上でマッチングした場合
     def test_many_users(self):
         user_counts = 5
         clients = []
         for i in range(user_counts):
             c = Client()
-            c.force_login(User.objects.create_user(f'testuser{i}', f'test{i}@gmail.com', f'password{i}'))
+            c.force_login(User.objects.create_user(f'testuser{i}', password=f'password{i}'))
             clients.append(c)
         
         post_data = {
@@ -240,12 +293,145 @@ class GetMatchRoomTests(TestCase):
             self.assertTrue(response.json()['is_matched'])
             self.assertEqual(response.json()['room_id'], responses[0].json()['room_id'])
 
+# ルーム作成のテスト
+class FormRoomTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(3)
+        ]
+        self.topic = Topic.objects.create(name='Test')
+        engine.clear()
+        engine.load([])
+
+    def add_record(self, user, state=MatchingRecord.State.WAITING):
+        record = MatchingRecord.objects.create(
+            user=user, topic=self.topic, number=2, state=state)
+        engine.enqueue(self.topic.pk, 2, record.submission_time, user.pk)
+        return record
+
+    # 全員分のレコードを1つのルームにまとめる
+    def test_form_room(self):
+        for user in self.users[:2]:
+            self.add_record(user)
+        room = matching.form_room(self.topic.pk, 2)
+
+        self.assertEqual(Room.objects.count(), 1)
+        self.assertEqual(set(room.users.values_list('pk', flat=True)), {u.pk for u in self.users[:2]})
+        self.assertEqual(MatchingRecord.objects.filter(state=MatchingRecord.State.PENDING).count(), 2)
+        self.assertEqual(len(engine), 0)
+
+    # 既に保留中のユーザーは別のルームに入らない
+    def test_skip_pending_record(self):
+        self.add_record(self.users[0], state=MatchingRecord.State.PENDING)
+        self.add_record(self.users[1])
+        self.assertIsNone(matching.form_room(self.topic.pk, 2))
+        self.assertEqual(Room.objects.count(), 0)
+        self.assertNotIn(self.users[0].pk, engine)
+        self.assertIn(self.users[1].pk, engine)
+
+        self.add_record(self.users[2])
+        room = matching.form_room(self.topic.pk, 2)
+        self.assertEqual(set(room.users.values_list('pk', flat=True)), {u.pk for u in self.users[1:]})
+
+
+
+# 他のトランザクションがロック中のレコードのテスト
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class FormRoomLockTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(2)
+        ]
+        self.topic = Topic.objects.create(name='Test')
+        engine.clear()
+        engine.load([])
+        self.addCleanup(engine.clear)
+        for user in self.users:
+            record = MatchingRecord.objects.create(user=user, topic=self.topic, number=2, state=MatchingRecord.State.WAITING)
+            engine.enqueue(self.topic.pk, 2, record.submission_time, user.pk)
+
+    def lock_record(self, user):
+        """ 別の接続で user のレコードをロックし、release.set() で離す """
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            try:
+                with transaction.atomic():
+                    MatchingRecord.objects.select_for_update().get(user=user)
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait(10)
+        return release, thread
+
+    # ロックされていただけのユーザーは待ち行列から消えない
+    @mock.patch.object(matching, 'LOCK_RETRY_DELAY', 0)
+    def test_locked_record_stays_queued(self):
+        release, thread = self.lock_record(self.users[1])
+        try:
+            self.assertIsNone(matching.form_room(self.topic.pk, 2))
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(Room.objects.count(), 0)
+        self.assertIn(self.users[0].pk, engine)
+        self.assertIn(self.users[1].pk, engine)
+
+        # ロックが外れれば同じ 2 人でルームができる
+        room = matching.form_room(self.topic.pk, 2)
+        self.assertEqual(set(room.users.values_list('pk', flat=True)), {u.pk for u in self.users})
+
+
+# 状態遷移のテスト
+class MatchingRecordStateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='password')
+        self.topic = Topic.objects.create(name='Test')
+
+    # 遷移元の状態でなければ更新しない
+    def test_transition(self):
+        State = MatchingRecord.State
+        MatchingRecord.objects.create(user=self.user, topic=self.topic, state=State.WAITING)
+        records = MatchingRecord.objects.filter(user=self.user)
+
+        self.assertEqual(records.transition(State.PENDING, State.CONFIRMED), 0)
+        self.assertEqual(records.transition(State.WAITING, State.PENDING), 1)
+        self.assertEqual(records.transition(State.WAITING, State.PENDING), 0)
+        self.assertEqual(records.get().state, State.PENDING)
+
+    # 定義されていない遷移
+    def test_invalid_transition(self):
+        State = MatchingRecord.State
+        with self.assertRaises(ValueError):
+            MatchingRecord.objects.transition(State.INACTIVE, State.CONFIRMED)
+
+    # 待ち状態なら登録し直さない
+    def test_register(self):
+        now = timezone.now()
+        record = MatchingRecord.objects.register(self.user.pk, self.topic, 2, now)
+        self.assertEqual(record.state, MatchingRecord.State.WAITING)
+        self.assertIsNone(MatchingRecord.objects.register(self.user.pk, self.topic, 2, now))
+
+        MatchingRecord.objects.filter(user=self.user).transition(
+            MatchingRecord.State.WAITING, MatchingRecord.State.INACTIVE)
+        self.assertIsNotNone(MatchingRecord.objects.register(self.user.pk, self.topic, 3, now))
+        self.assertEqual(MatchingRecord.objects.get(user=self.user).number, 3)
+
+
 # マッチング承認のテスト
 class MatchingConfirmTests(TestCase):
     def setUp(self):
-        self.user = User.objects.create_user(
-            'testuser', 'test@gmail.com', 'password')
+        self.user = User.objects.create_user('testuser', password='password')
         self.topic = Topic.objects.create(name='Test')
+        engine.clear()
     
     # ログインしていない場合
     def test_not_logged_in(self):
@@ -262,8 +448,7 @@ class MatchingConfirmTests(TestCase):
             user=self.user,
             topic=self.topic,
             number=3,
-            is_active=True,
-            is_pending=False)
+            state=MatchingRecord.State.WAITING)
         response = self.client.post(reverse('chatrooms:confirm_matching'), data=json.dumps({}), content_type='application/json')
         self.assertEqual(response.status_code, 200)
         self.assertFalse(response.json()['is_confirmed'])
@@ -275,8 +460,7 @@ class MatchingConfirmTests(TestCase):
             user=self.user,
             topic=self.topic,
             number=3,
-            is_active=True,
-            is_pending=True)
+            state=MatchingRecord.State.PENDING)
         response = self.client.post(reverse('chatrooms:confirm_matching'), data=json.dumps({}), content_type='application/json')
         self.assertEqual(response.status_code, 200)
         self.assertTrue(response.json()['is_confirmed'])
@@ -292,9 +476,9 @@ class MatchingConfirmTests(TestCase):
 # マッチング承認キャンセルのテスト
 class CancelConfirmTests(TestCase):
     def setUp(self):
-        self.user = User.objects.create_user(
-            'testuser', 'test@gmail.com', 'password')
+        self.user = User.objects.create_user('testuser', password='password')
         self.topic = Topic.objects.create(name='Test')
+        engine.clear()
     
     # ログインしていない場合
     def test_not_logged_in(self):
@@ -311,8 +495,7 @@ class CancelConfirmTests(TestCase):
             user=self.user,
             topic=self.topic,
             number=3,
-            is_active=True,
-            is_confirmed=False)
+            state=MatchingRecord.State.WAITING)
         response = self.client.post(reverse('chatrooms:cancel_confirm'), data=json.dumps({}), content_type='application/json')
         self.assertEqual(response.status_code, 200)
         self.assertFalse(response.json()['is_cancelled'])
@@ -324,9 +507,7 @@ class CancelConfirmTests(TestCase):
             user=self.user,
             topic=self.topic,
             number=3,
-            is_active=True,
-            is_pending=False,
-            is_confirmed=True)
+            state=MatchingRecord.State.CONFIRMED)
         response = self.client.post(reverse('chatrooms:cancel_confirm'), data=json.dumps({}), content_type='application/json')
         self.assertEqual(response.status_code, 200)
         self.assertTrue(response.json()['is_cancelled'])
@@ -340,11 +521,12 @@ class CancelConfirmTests(TestCase):
         self.assertFalse(record.is_confirmed)
 
 # マッチング完了のテスト
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
 class MatchingCompleteTests(TestCase):
     def setUp(self):
-        self.user = User.objects.create_user(
-            'testuser', 'test@gmail.com', 'password')
+        self.user = User.objects.create_user('testuser', password='password')
         self.topic = Topic.objects.create(name='Test')
+        engine.clear()
     
     # ログインしていない場合
     def test_not_logged_in(self):
@@ -386,7 +568,7 @@ class MatchingCompleteTests(TestCase):
         c1 = Client()
         c1.force_login(self.user)
         c2 = Client()
-        c2.force_login(User.objects.create_user('testuser2', 'test2@gmail.com', 'password2'))
+        c2.force_login(User.objects.create_user('testuser2', password='password2'))
 
         post_data = {
             'condition': {
@@ -418,7 +600,7 @@ class MatchingCompleteTests(TestCase):
         clients = []
         for i in range(user_counts):
             c = Client()
-            c.force_login(User.objects.create_user(f'testuser{i}', f'test{i}@gmail.com', f'password{i}'))
+            c.force_login(User.objects.create_user(f'testuser{i}', password=f'password{i}'))
             clients.append(c)
         
         post_data = {
@@ -448,3 +630,973 @@ class MatchingCompleteTests(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertTrue(response.json()['is_completed'])
 
+
+
+# マッチングエンジンのテスト
+class MatchingEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = MatchingEngine()
+        self.t0 = datetime.datetime(2021, 1, 1)
+
+    def time(self, seconds):
+        return self.t0 + datetime.timedelta(seconds=seconds)
+
+    # 人数が足りない場合
+    def test_not_enough(self):
+        self.engine.enqueue(1, 3, self.time(0), 'a')
+        self.engine.enqueue(1, 3, self.time(1), 'b')
+        self.assertIsNone(self.engine.pop_group(1, 3))
+        self.assertEqual(len(self.engine), 2)
+
+    # 登録時刻の古い順に取り出される
+    def test_fifo(self):
+        self.engine.enqueue(1, 2, self.time(2), 'c')
+        self.engine.enqueue(1, 2, self.time(0), 'a')
+        self.engine.enqueue(1, 2, self.time(1), 'b')
+        group = self.engine.pop_group(1, 2)
+        self.assertEqual([entry[2] for entry in group], ['a', 'b'])
+        self.assertIn('c', self.engine)
+        self.assertNotIn('a', self.engine)
+
+    # topic と number が違うキューは混ざらない
+    def test_separate_queues(self):
+        self.engine.enqueue(1, 2, self.time(0), 'a')
+        self.engine.enqueue(2, 2, self.time(1), 'b')
+        self.engine.enqueue(1, 3, self.time(2), 'c')
+        self.assertIsNone(self.engine.pop_group(1, 2))
+
+    # 登録し直すと古いエントリは消える
+    def test_requeue(self):
+        self.engine.enqueue(1, 2, self.time(0), 'a')
+        self.engine.enqueue(2, 2, self.time(1), 'a')
+        self.assertEqual(len(self.engine), 1)
+        self.assertTrue(self.engine.dequeue('a'))
+        self.assertFalse(self.engine.dequeue('a'))
+        self.assertEqual(len(self.engine), 0)
+
+    # 取り出したエントリを戻すと順番が保たれる
+    def test_push_back(self):
+        self.engine.enqueue(1, 2, self.time(0), 'a')
+        self.engine.enqueue(1, 2, self.time(1), 'b')
+        group = self.engine.pop_group(1, 2)
+        self.engine.enqueue(1, 2, self.time(2), 'c')
+        self.engine.push_back(1, 2, group[1:])
+        group = self.engine.pop_group(1, 2)
+        self.assertEqual([entry[2] for entry in group], ['b', 'c'])
+
+
+# プッシュ通知のテスト
+@override_settings(MATCHING_PUSH_NOTIFICATIONS=True, CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PushNotificationTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='password')
+        self.user2 = User.objects.create_user('testuser2', password='password2')
+        self.topic = Topic.objects.create(name='Test')
+        engine.clear()
+
+    def register(self, user):
+        c = Client()
+        c.force_login(user)
+        post_data = {
+            'condition': {
+                'topic': 'Test',
+                'number': 2
+            }
+        }
+        c.post(reverse('chatrooms:register_matching'), data=json.dumps(post_data), content_type='application/json')
+        return c
+
+    # マッチングしたら全員に通知される
+    @mock.patch('chatrooms.notifications._send')
+    def test_matched(self, send):
+        self.register(self.user)
+        send.assert_not_called()
+        self.register(self.user2)
+
+        room = Room.objects.get(users=self.user)
+        send.assert_called_once()
+        user_ids, event = send.call_args[0]
+        self.assertEqual(set(user_ids), {str(self.user.pk), str(self.user2.pk)})
+        self.assertEqual(event['type'], 'match.found')
+        self.assertEqual(event['room_id'], str(room.pk))
+
+    # 全員が承認したら完了が通知される
+    @mock.patch('chatrooms.notifications._send')
+    def test_completed(self, send):
+        clients = [self.register(self.user), self.register(self.user2)]
+        for c in clients:
+            c.post(reverse('chatrooms:confirm_matching'), data=json.dumps({}), content_type='application/json')
+
+        user_ids, event = send.call_args[0]
+        self.assertEqual(event['type'], 'room.status')
+        self.assertEqual(event['status'], 'completed')
+
+
+# ルームの承認状態のテスト
+class RoomStatusTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(3)
+        ]
+        self.topic = Topic.objects.create(name='Test')
+        self.room = Room.objects.create(is_active=True)
+        self.room.users.add(*self.users)
+        for user in self.users:
+            MatchingRecord.objects.create(user=user, topic=self.topic, number=3, state=MatchingRecord.State.PENDING)
+
+    def set_state(self, user, state):
+        MatchingRecord.objects.filter(user=user).update(state=state)
+
+    # 1クエリで集計する
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            matching.get_room_status(self.room.pk, self.users[0].pk)
+
+    def test_status(self):
+        self.assertEqual(matching.get_room_status(self.room.pk), matching.ROOM_PENDING)
+        for user in self.users:
+            self.set_state(user, MatchingRecord.State.CONFIRMED)
+        self.assertEqual(matching.get_room_status(self.room.pk), matching.ROOM_COMPLETED)
+        self.set_state(self.users[1], MatchingRecord.State.INACTIVE)
+        self.assertEqual(matching.get_room_status(self.room.pk), matching.ROOM_CANCELLED)
+        MatchingRecord.objects.filter(user=self.users[2]).delete()
+        self.assertEqual(matching.get_room_status(self.room.pk), matching.ROOM_MISSING)
+
+    # メンバーでないユーザー
+    def test_not_member(self):
+        other = User.objects.create_user('other', password='password')
+        self.assertIsNone(matching.get_room_status(self.room.pk, other.pk))
+        self.assertIsNotNone(matching.get_room_status(self.room.pk, self.users[0].pk))
+
+    # 承認と状態の取得を 1 回で行う
+    def test_confirm_room(self):
+        MatchingRecord.objects.update(submission_time=self.room.created_date - datetime.timedelta(minutes=1))
+        for user in self.users[:2]:
+            self.assertEqual(matching.confirm_room(self.room.pk, user.pk), matching.ROOM_PENDING)
+        # 承認済みのユーザーがもう一度承認しても状態を返すだけ
+        self.assertEqual(matching.confirm_room(self.room.pk, self.users[0].pk), matching.ROOM_PENDING)
+        self.assertEqual(matching.confirm_room(self.room.pk, self.users[2].pk), matching.ROOM_COMPLETED)
+
+        self.topic.refresh_from_db()
+        self.assertGreater(self.topic.popularity, 0)
+
+    def test_confirm_room_not_member(self):
+        other = User.objects.create_user('other', password='password')
+        self.assertIsNone(matching.confirm_room(self.room.pk, other.pk))
+        self.assertIsNone(matching.confirm_room(None, self.users[0].pk))
+
+
+# 同時に承認したときのテスト
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConcurrentConfirmTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(2)
+        ]
+        self.topic = Topic.objects.create(name='Test')
+        self.room = Room.objects.create(is_active=True)
+        self.room.users.add(*self.users)
+        self.addCleanup(membership.invalidate, self.room.pk)
+        submission_time = self.room.created_date - datetime.timedelta(minutes=1)
+        for user in self.users:
+            MatchingRecord.objects.create(
+                user=user, topic=self.topic, number=2, state=MatchingRecord.State.PENDING,
+                submission_time=submission_time)
+
+    # 最後に承認したメンバーが全員そろったことに気付く
+    def test_last_confirmer_completes(self):
+        get_room_status = matching.get_room_status
+
+        # 承認から集計までの間にもう 1 人の承認が入るようにする
+        def slow_get_room_status(*args, **kwargs):
+            time.sleep(0.1)
+            return get_room_status(*args, **kwargs)
+
+        barrier = threading.Barrier(len(self.users))
+        results = {}
+
+        def confirm(user):
+            try:
+                barrier.wait(10)
+                results[user.pk] = matching.confirm_room(self.room.pk, user.pk)
+            finally:
+                connection.close()
+
+        with mock.patch.object(matching, 'get_room_status', slow_get_room_status):
+            threads = [threading.Thread(target=confirm, args=(user,)) for user in self.users]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sorted(results.values()), sorted([matching.ROOM_PENDING, matching.ROOM_COMPLETED]))
+        self.assertEqual(matching.get_room_status(self.room.pk), matching.ROOM_COMPLETED)
+        self.topic.refresh_from_db()
+        self.assertGreater(self.topic.popularity, 0)
+
+
+# 応答のなくなったマッチングを無効にするテスト
+@override_settings(MATCHING_RECORD_TTL=60, ROOM_CONFIRMATION_COUNTERS=False, MATCHING_PUSH_NOTIFICATIONS=False)
+class ExpireStaleTests(TestCase):
+    def setUp(self):
+        engine.clear()
+        self.addCleanup(engine.clear)
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(4)
+        ]
+        self.topic = Topic.objects.create(name='Test')
+        self.now = timezone.now()
+        self.old = self.now - datetime.timedelta(minutes=5)
+
+    def create_record(self, user, state, last_seen):
+        return MatchingRecord.objects.create(
+            user=user, topic=self.topic, number=2, state=state,
+            submission_time=self.old, last_seen=last_seen)
+
+    def test_expire_waiting(self):
+        State = MatchingRecord.State
+        self.create_record(self.users[0], State.WAITING, self.old)
+        self.create_record(self.users[1], State.WAITING, self.now)
+        self.create_record(self.users[2], State.CONFIRMED, self.old)
+        engine.load(MatchingRecord.objects.filter(state=State.WAITING))
+
+        self.assertEqual(matching.expire_stale(self.now), 1)
+        states = dict(MatchingRecord.objects.values_list('user', 'state'))
+        self.assertEqual(states[self.users[0].pk], State.INACTIVE)
+        self.assertEqual(states[self.users[1].pk], State.WAITING)
+        # 承認済みのレコードはそのまま
+        self.assertEqual(states[self.users[2].pk], State.CONFIRMED)
+        self.assertNotIn(self.users[0].pk, engine)
+        self.assertIn(self.users[1].pk, engine)
+
+    # 応答のない保留状態のユーザーのルームはキャンセルする
+    def test_expire_pending_room(self):
+        State = MatchingRecord.State
+        self.create_record(self.users[0], State.PENDING, self.old)
+        self.create_record(self.users[1], State.PENDING, self.now)
+        room = Room.objects.create(is_active=True, created_date=self.old + datetime.timedelta(seconds=1))
+        room.users.add(self.users[0], self.users[1])
+        # マッチング前に作られたルームは対象外
+        completed = Room.objects.create(is_active=True, created_date=self.old - datetime.timedelta(days=1))
+        completed.users.add(self.users[0], self.users[2])
+
+        self.assertEqual(matching.expire_stale(self.now), 1)
+        room.refresh_from_db()
+        completed.refresh_from_db()
+        self.assertFalse(room.is_active)
+        self.assertTrue(completed.is_active)
+        self.assertEqual(matching.get_room_status(room.pk), matching.ROOM_CANCELLED)
+
+    def test_nothing_to_expire(self):
+        self.create_record(self.users[0], MatchingRecord.State.WAITING, self.now)
+        self.assertEqual(matching.expire_stale(self.now), 0)
+
+    # ポーリングで last_seen を更新する
+    @override_settings(MATCHING_HEARTBEAT_INTERVAL=30)
+    def test_poll_touches_record(self):
+        record = self.create_record(self.users[0], MatchingRecord.State.WAITING, self.old)
+        engine.load([])
+        matching.get_match_room(self.users[0].pk)
+        record.refresh_from_db()
+        self.assertGreater(record.last_seen, self.old)
+        self.assertEqual(matching.expire_stale(), 0)
+
+
+# ルームのメンバーのキャッシュのテスト
+class RoomMembershipTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(3)
+        ]
+        self.room = Room.objects.create(is_active=True)
+        self.room.users.add(*self.users[:2])
+        self.addCleanup(membership.invalidate, self.room.pk)
+
+    def test_cached(self):
+        self.assertTrue(membership.is_member(self.room.pk, self.users[0].pk))
+        # 2 回目からは DB を読まない
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member(str(self.room.pk), self.users[1].pk))
+            self.assertFalse(membership.is_member(self.room.pk, self.users[2].pk))
+
+    def test_fill_and_close(self):
+        membership.fill(self.room.pk, [self.users[2].pk])
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member(self.room.pk, self.users[2].pk))
+        matching.close_rooms(self.room.pk)
+        self.assertFalse(membership.is_member(self.room.pk, self.users[2].pk))
+        self.assertTrue(membership.is_member(self.room.pk, self.users[0].pk))
+
+    def test_room_view_access(self):
+        self.client.force_login(self.users[2])
+        response = self.client.get(reverse('chatrooms:room', kwargs={'pk': self.room.pk}))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('chatrooms:room', kwargs={'pk': uuid.uuid4()}))
+        self.assertEqual(response.status_code, 404)
+
+
+# ルームのメンバー表のテスト
+class RoomRosterTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(2)
+        ]
+        self.room = Room.objects.create(is_active=True)
+        self.room.users.add(*self.users)
+        self.addCleanup(cache.delete, roster._key(self.room.pk))
+
+    def test_roster(self):
+        data = roster.get_roster(self.room.pk)
+        names = json.loads(data['member_names'])
+        icons = json.loads(data['member_icons'])
+        self.assertEqual(names[str(self.users[0].pk)], 'testuser0')
+        self.assertEqual(set(icons), {str(user.pk) for user in self.users})
+        # 2 回目からはキャッシュから
+        with self.assertNumQueries(0):
+            self.assertEqual(roster.get_roster(self.room.pk), data)
+
+    # プロフィールの変更で作り直す
+    def test_refresh_user(self):
+        roster.get_roster(self.room.pk)
+        User.objects.filter(pk=self.users[1].pk).update(username='renamed')
+        roster.refresh_user(self.users[1].pk)
+        names = json.loads(roster.get_roster(self.room.pk)['member_names'])
+        self.assertEqual(names[str(self.users[1].pk)], 'renamed')
+
+# 承認カウンタのテスト
+class ConfirmationStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = confirmations.MemoryStore()
+        async_to_sync(self.store.open_room)('room', ['a', 'b'])
+
+    def test_confirm(self):
+        confirm = async_to_sync(self.store.confirm)
+        self.assertEqual(confirm('room', 'x'), confirmations.UNKNOWN)
+        self.assertEqual(confirm('room', 'a'), confirmations.PENDING)
+        self.assertEqual(confirm('room', 'a'), confirmations.PENDING)
+        # 最後の1人だけが COMPLETED_NOW を受け取る
+        self.assertEqual(confirm('room', 'b'), confirmations.COMPLETED_NOW)
+        self.assertEqual(confirm('room', 'b'), confirmations.COMPLETED)
+
+    def test_cancel(self):
+        async_to_sync(self.store.confirm)('room', 'a')
+        self.assertEqual(async_to_sync(self.store.cancel)('room', 'b'), 1)
+        self.assertEqual(async_to_sync(self.store.cancel)('room', 'a'), 0)
+        self.assertEqual(async_to_sync(self.store.confirm)('room', 'a'), confirmations.CANCELLED)
+        self.assertEqual(async_to_sync(self.store.status)('room', 'a'), confirmations.CANCELLED)
+
+
+# 承認カウンタを使ったマッチング承認のテスト
+@override_settings(ROOM_CONFIRMATION_COUNTERS=True, CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class CounterConfirmTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'testuser{i}', password=f'password{i}')
+            for i in range(2)
+        ]
+        self.topic = Topic.objects.create(name='Test')
+        self.room = Room.objects.create(is_active=True)
+        self.room.users.add(*self.users)
+        for user in self.users:
+            MatchingRecord.objects.create(user=user, topic=self.topic, number=2, state=MatchingRecord.State.PENDING)
+        async_to_sync(confirmations.open_room)(self.room.pk, [user.pk for user in self.users])
+
+    @mock.patch('chatrooms.confirmations.persist')
+    def test_completed(self, persist):
+        clients = []
+        for user in self.users:
+            c = Client()
+            c.force_login(user)
+            clients.append(c)
+
+        for c in clients:
+            response = c.post(reverse('chatrooms:confirm_matching'), data=json.dumps({'room_id': str(self.room.pk)}), content_type='application/json')
+            self.assertTrue(response.json()['is_confirmed'])
+        # MatchingRecord の更新と人気度の加算はリクエストの外で行う
+        self.assertEqual(persist.call_args_list, [
+            mock.call(matching.confirm_record, self.users[0].pk),
+            mock.call(popularity.record_completion, self.users[1].pk),
+            mock.call(matching.confirm_record, self.users[1].pk),
+        ])
+        self.assertEqual(MatchingRecord.objects.filter(state=MatchingRecord.State.CONFIRMED).count(), 0)
+
+        # 全員そろった承認で 1 回だけ人気度に加算する
+        before = Topic.objects.get(pk=self.topic.pk).popularity
+        for call in persist.call_args_list:
+            func, *args = call[0]
+            func(*args)
+        self.assertGreater(Topic.objects.get(pk=self.topic.pk).popularity, before)
+        self.assertEqual(MatchingRecord.objects.filter(state=MatchingRecord.State.CONFIRMED).count(), 2)
+
+        # 完了はカウンタから判定する
+        response = clients[0].get(reverse('chatrooms:get_match_completed'), data={'room_id': str(self.room.pk)})
+        self.assertTrue(response.json()['is_completed'])
+
+    # 承認の書き込み（persist）より先にキャンセルが来た場合
+    @mock.patch('chatrooms.confirmations.persist')
+    def test_cancel_before_persist(self, persist):
+        engine.clear()
+        engine.load([])
+        self.addCleanup(engine.clear)
+        self.client.force_login(self.users[0])
+        data = json.dumps({'room_id': str(self.room.pk)})
+        self.client.post(reverse('chatrooms:confirm_matching'), data=data, content_type='application/json')
+        self.assertEqual(MatchingRecord.objects.get(user=self.users[0]).state, MatchingRecord.State.PENDING)
+
+        response = self.client.post(reverse('chatrooms:cancel_confirm'), data=data, content_type='application/json')
+        self.assertTrue(response.json()['is_cancelled'])
+        self.assertEqual(MatchingRecord.objects.get(user=self.users[0]).state, MatchingRecord.State.WAITING)
+
+        # 遅れて来た書き込みは何もしない
+        func, *args = persist.call_args[0]
+        func(*args)
+        self.assertEqual(MatchingRecord.objects.get(user=self.users[0]).state, MatchingRecord.State.WAITING)
+
+
+# トピック検索のテスト
+class SearchTopicsTests(TestCase):
+    def setUp(self):
+        self.game = Topic.objects.create(name='ゲーム雑談')
+        self.music = Topic.objects.create(name='音楽')
+        tags = [Tag.objects.create(name='ゲーム音楽'), Tag.objects.create(name='ゲームBGM')]
+        self.music.tags.add(*tags)
+
+    def search(self, text):
+        response = self.client.get(reverse('chatrooms:search_topics'), data={'search_text': text})
+        self.assertEqual(response.status_code, 200)
+        return [topic['name'] for topic in response.json()['topics']]
+
+    def test_no_text(self):
+        response = self.client.get(reverse('chatrooms:search_topics'))
+        self.assertEqual(response.status_code, 400)
+
+    # タグが複数一致しても重複しない
+    def test_distinct(self):
+        self.assertEqual(sorted(self.search('ゲーム')), sorted(['ゲーム雑談', '音楽']))
+
+    # キーワードはすべて一致する必要がある
+    def test_keywords(self):
+        self.assertEqual(self.search('ゲーム BGM'), ['音楽'])
+        self.assertEqual(self.search('雑談 BGM'), [])
+
+    @override_settings(TOPIC_SEARCH_LIMIT=1)
+    def test_limit(self):
+        self.assertEqual(len(self.search('/all')), 1)
+
+
+# 人気トピックのテスト
+class PopularTopicsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='password')
+        self.topics = [Topic.objects.create(name=name) for name in ['A', 'B', 'C']]
+        cache.clear()
+
+    def popular(self):
+        response = self.client.get(reverse('chatrooms:popular_topics'))
+        self.assertEqual(response.status_code, 200)
+        return [topic['name'] for topic in response.json()['topics']]
+
+    # 登録の多い順
+    def test_order(self):
+        popularity.record_registration(self.topics[2].pk)
+        popularity.record_registration(self.topics[2].pk)
+        popularity.record_registration(self.topics[1].pk)
+        self.assertEqual(self.popular(), ['C', 'B', 'A'])
+
+    # 古いイベントほど重みが小さい
+    def test_decay(self):
+        now = timezone.now()
+        half_life = popularity._half_life()
+        self.assertAlmostEqual(popularity._exponent(now + half_life) - popularity._exponent(now), math.log(2))
+
+    # 半減期が短くても値があふれない
+    @override_settings(TOPIC_POPULARITY_HALF_LIFE=datetime.timedelta(seconds=1))
+    def test_short_half_life(self):
+        popularity.record_registration(self.topics[1].pk)
+        popularity.record_completion(self.user.pk)
+        popularity.record_registration(self.topics[0].pk)
+        popularity.record_registration(self.topics[0].pk)
+        self.assertEqual(self.popular()[0], 'A')
+        for topic in Topic.objects.all():
+            self.assertTrue(math.isfinite(topic.popularity))
+
+    # キャッシュから返す
+    def test_cached(self):
+        self.popular()
+        popularity.record_registration(self.topics[2].pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.popular(), ['A', 'B', 'C'])
+        popularity.invalidate()
+        self.assertEqual(self.popular()[0], 'C')
+
+    @override_settings(POPULAR_TOPICS_LIMIT=2)
+    def test_limit(self):
+        self.assertEqual(len(self.popular()), 2)
+
+
+# トピック補完のテスト
+class SuggestTopicsTests(TestCase):
+    def setUp(self):
+        autocomplete.suggester.clear()
+        self.game = Topic.objects.create(name='ゲーム雑談')
+        self.music = Topic.objects.create(name='Music')
+        self.music.tags.add(Tag.objects.create(name='ゲーム音楽'))
+
+    def suggest(self, prefix):
+        response = self.client.get(reverse('chatrooms:suggest_topics'), data={'prefix': prefix})
+        self.assertEqual(response.status_code, 200)
+        return [topic['name'] for topic in response.json()['topics']]
+
+    def test_no_prefix(self):
+        response = self.client.get(reverse('chatrooms:suggest_topics'))
+        self.assertEqual(response.status_code, 400)
+
+    # トピック名の一致が先、タグの一致が後
+    def test_prefix(self):
+        self.assertEqual(self.suggest('ゲーム'), ['ゲーム雑談', 'Music'])
+        self.assertEqual(self.suggest('雑談'), [])
+
+    # 全角・大文字小文字・空白の違いを無視する
+    def test_normalize(self):
+        self.assertEqual(self.suggest('ｍｕｓ'), ['Music'])
+        self.assertEqual(self.suggest('ゲーム 雑'), ['ゲーム雑談'])
+
+    # 作成後のモデルの変更を反映する（DB には問い合わせない）
+    def test_signals(self):
+        self.suggest('a')
+        topic = Topic.objects.create(name='Anime')
+        with self.assertNumQueries(0):
+            self.assertEqual(autocomplete.suggest('ani', 10), [topic.data()])
+        topic.delete()
+        self.assertEqual(autocomplete.suggest('ani', 10), [])
+        self.game.tags.add(Tag.objects.create(name='Arcade'))
+        self.assertEqual(autocomplete.suggest('arc', 10), [self.game.data()])
+
+
+# WebSocket のメッセージ形式のテスト
+class ProtocolTests(SimpleTestCase):
+    def test_negotiate(self):
+        self.assertIs(protocol.negotiate([]), protocol.JSON)
+        self.assertIs(protocol.negotiate(['other', protocol.MSGPACK_SUBPROTOCOL]), protocol.MSGPACK)
+
+    def test_msgpack_method_code(self):
+        codec = protocol.MSGPACK
+        frame = codec.encode({'method': protocol.METHOD_CODES['confirm_matching'], 'room_id': 'abc'})
+        self.assertIn('bytes_data', frame)
+        data = codec.decode(bytes_data=frame['bytes_data'])
+        self.assertEqual(data, {'method': 'confirm_matching', 'room_id': 'abc'})
+
+    # メトリクスのラベルは既知の method だけ（辞書を引けない値でも落ちない）
+    def test_method_label(self):
+        self.assertEqual(_method_label('get_room'), 'get_room')
+        self.assertEqual(_method_label('other'), 'unknown')
+        self.assertEqual(_method_label([]), 'unknown')
+        self.assertEqual(_method_label({'get_room': 1}), 'unknown')
+
+    def test_timestamp(self):
+        now = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(protocol.MSGPACK.timestamp(now), 1609459200000)
+        self.assertIsInstance(protocol.JSON.timestamp(now), str)
+
+    # 秒が同じなら書式化済みの部分を使い回す
+    @override_settings(USE_TZ=True, TIME_ZONE='Asia/Tokyo')
+    def test_timestamp_formatter(self):
+        formatter = protocol.TimestampFormatter()
+        now = datetime.datetime(2021, 1, 1, 0, 0, 0, 123, tzinfo=datetime.timezone.utc)
+        self.assertEqual(formatter.format(now), '01-01-2021:09:00:00.000123')
+        with mock.patch('chatrooms.protocol.timezone.localtime') as localtime:
+            self.assertEqual(
+                formatter.format(now.replace(microsecond=999999)), '01-01-2021:09:00:00.999999')
+            localtime.assert_not_called()
+        self.assertEqual(
+            formatter.format(now + datetime.timedelta(seconds=1)), '01-01-2021:09:00:01.000123')
+
+    # group_send 用のフレームは形式ごとに 1 回だけ作る
+    def test_group_message(self):
+        event = protocol.group_message('matching complete')
+        self.assertEqual(event['type'], 'send.message')
+        data = json.loads(event['frames']['json'])
+        self.assertEqual(data['message'], 'matching complete')
+        data = protocol.MSGPACK.decode(bytes_data=event['frames']['msgpack'])
+        self.assertEqual(data['message'], 'matching complete')
+        self.assertIsInstance(data['datetime'], int)
+
+    # 壊れたフレームや形式の違うフレームは None
+    def test_invalid_frame(self):
+        self.assertIsNone(protocol.JSON.decode(text_data='{'))
+        self.assertIsNone(protocol.JSON.decode(text_data='[]'))
+        self.assertIsNone(protocol.JSON.decode(bytes_data=b'\x80'))
+        self.assertIsNone(protocol.MSGPACK.decode(text_data='{}'))
+        self.assertIsNone(protocol.MSGPACK.decode(bytes_data=b'\xc1'))
+
+
+# ASGI ワーカーの executor のテスト
+class BoundedExecutorTests(SimpleTestCase):
+    def test_stats(self):
+        executor = BoundedExecutor(2)
+        self.addCleanup(executor.shutdown)
+        futures = [executor.submit(pow, 2, i) for i in range(5)]
+        self.assertEqual([future.result() for future in futures], [1, 2, 4, 8, 16])
+
+        stats = executor.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertLessEqual(stats['threads'], 2)
+        self.assertEqual(stats['submitted'], 5)
+        self.assertEqual(stats['completed'], 5)
+        self.assertEqual(stats['queued'], 0)
+        self.assertLessEqual(stats['peak_running'], 2)
+
+
+
+# MatchingConsumer のテスト
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MatchingConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='password')
+        self.topic = Topic.objects.create(name='Test')
+        engine.clear()
+        self.addCleanup(engine.clear)
+
+    def communicator(self, user=None, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            MatchingConsumer.as_asgi(), '/ws/room-match/', subprotocols=subprotocols)
+        communicator.scope['user'] = user or self.user
+        return communicator
+
+    # msgpack を指定すれば method は整数コードで、返信はバイナリフレーム
+    def test_msgpack(self):
+        async def run():
+            communicator = self.communicator(subprotocols=[protocol.MSGPACK_SUBPROTOCOL])
+            connected, subprotocol = await communicator.connect()
+            await communicator.send_to(bytes_data=msgpack.packb({'method': protocol.METHOD_CODES['status']}))
+            output = await communicator.receive_output(1)
+            await communicator.disconnect()
+            return connected, subprotocol, output
+
+        connected, subprotocol, output = async_to_sync(run)()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, protocol.MSGPACK_SUBPROTOCOL)
+        self.assertNotIn('text', output)
+        self.assertEqual(msgpack.unpackb(output['bytes'], raw=False)['message'], 'status')
+
+    # 指定しなければ従来どおり JSON のテキストフレーム
+    def test_json(self):
+        async def run():
+            communicator = self.communicator()
+            connected, subprotocol = await communicator.connect()
+            await communicator.send_json_to({'method': 'status'})
+            output = await communicator.receive_output(1)
+            await communicator.disconnect()
+            return subprotocol, output
+
+        subprotocol, output = async_to_sync(run)()
+        self.assertIsNone(subprotocol)
+        self.assertNotIn('bytes', output)
+        self.assertEqual(json.loads(output['text'])['message'], 'status')
+
+    # 実行中の get_room に重なった get_room は DB を引かずに同じ結果を返す
+    def test_get_room_coalesced(self):
+        calls = []
+
+        async def get_match_room(consumer):
+            calls.append(consumer.user_id)
+            await asyncio.sleep(0.1)
+            return None
+
+        _, before = HANDLER_DURATION.labels('get_room').get()
+
+        async def run():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.send_json_to({'method': 'get_room'})
+            await communicator.send_json_to({'method': 'get_room'})
+            outputs = [await communicator.receive_json_from(1), await communicator.receive_json_from(1)]
+            await communicator.disconnect()
+            return outputs
+
+        with mock.patch.object(MatchingConsumer, 'get_match_room', get_match_room):
+            outputs = async_to_sync(run)()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([output['message'] for output in outputs], ['now waiting...'] * 2)
+        # 処理時間は返信までを記録する
+        _, after = HANDLER_DURATION.labels('get_room').get()
+        self.assertGreaterEqual(after - before, 0.2)
+
+    # 想定外の例外でも返信する
+    def test_get_room_error(self):
+        async def get_match_room(consumer):
+            raise RuntimeError('boom')
+
+        async def run():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.send_json_to({'method': 'get_room'})
+            output = await communicator.receive_json_from(1)
+            await communicator.disconnect()
+            return output
+
+        with mock.patch.object(MatchingConsumer, 'get_match_room', get_match_room), \
+                self.assertLogs('chatrooms.consumers', logging.ERROR):
+            output = async_to_sync(run)()
+        self.assertEqual(output['message'], 'error')
+        self.assertEqual(output['error'], 'internal error')
+
+    # 文字列でない method にも unknown method を返し、接続は切らない
+    def test_unhashable_method(self):
+        async def run():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.send_json_to({'method': []})
+            unknown = await communicator.receive_json_from(1)
+            await communicator.send_json_to({'method': 'status'})
+            status = await communicator.receive_json_from(1)
+            await communicator.disconnect()
+            return unknown, status
+
+        unknown, status = async_to_sync(run)()
+        self.assertEqual(unknown['message'], 'unknown method')
+        self.assertEqual(status['message'], 'status')
+
+    def register(self, user=None):
+        record = MatchingRecord.objects.register((user or self.user).pk, self.topic, 3, timezone.now())
+        matching.enqueue(record)
+        return record
+
+    # 切断したユーザーは待ち行列から外す
+    def test_disconnect_dequeues(self):
+        self.register()
+
+        async def run():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+        self.assertFalse(matching.is_queued(self.user.pk))
+
+    # 同じユーザーの別の接続が残っていれば外さない
+    def test_disconnect_other_tab(self):
+        self.register()
+
+        async def run():
+            first, second = self.communicator(), self.communicator()
+            await first.connect()
+            await second.connect()
+            await first.disconnect()
+            queued = await DatabaseSyncToAsync(matching.is_queued)(self.user.pk)
+            await second.disconnect()
+            return queued
+
+        self.assertTrue(async_to_sync(run)())
+        self.assertFalse(matching.is_queued(self.user.pk))
+
+    # 待ち行列から外せなくても接続数のゲージは減らす
+    def test_disconnect_error(self):
+        gauge = CONNECTIONS.labels('MatchingConsumer')
+        before = gauge.get()
+
+        async def run():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.disconnect()
+
+        with mock.patch.object(matching, 'dequeue', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                async_to_sync(run)()
+        self.assertEqual(gauge.get(), before)
+
+    # ハートビートで last_seen を更新し、外れていた待ち行列に並び直す
+    @override_settings(MATCHING_HEARTBEAT_INTERVAL=30)
+    def test_heartbeat(self):
+        old = timezone.now() - datetime.timedelta(seconds=60)
+        record = MatchingRecord.objects.register(self.user.pk, self.topic, 3, old)
+        engine.load([])
+
+        async def run():
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.send_json_to({'method': 'heartbeat'})
+            # メッセージは順に処理されるので、status の返信が届けばハートビートは終わっている
+            await communicator.send_json_to({'method': 'status'})
+            await communicator.receive_json_from(1)
+            queued = await DatabaseSyncToAsync(matching.is_queued)(self.user.pk)
+            await communicator.disconnect()
+            return queued
+
+        self.assertTrue(async_to_sync(run)())
+        record.refresh_from_db()
+        self.assertGreater(record.last_seen, old)
+
+
+# ベンチマークの集計のテスト
+class BenchSummaryTests(SimpleTestCase):
+    def test_summarize(self):
+        summary = bench.summarize([i / 1000 for i in range(100, 0, -1)])
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['p50_ms'], 50)
+        self.assertEqual(summary['p95_ms'], 95)
+        self.assertEqual(summary['p99_ms'], 99)
+        self.assertEqual(summary['max_ms'], 100)
+
+    def test_empty(self):
+        summary = bench.summarize([])
+        self.assertEqual(summary['count'], 0)
+        self.assertIsNone(summary['p99_ms'])
+        self.assertEqual(bench.format_summary(summary), 'n=0')
+
+
+# 負荷試験用のチャンネルレイヤーのテスト
+class SimulatedChannelLayerTests(SimpleTestCase):
+    def test_group_send_latency(self):
+        layer = SimulatedChannelLayer(latency=0.01)
+
+        async def run():
+            channels = [await layer.new_channel() for _ in range(3)]
+            for channel in channels:
+                await layer.group_add('room', channel)
+            # group_send はメンバー数によらず 1 往復分
+            start = time.perf_counter()
+            await layer.group_send('room', {'type': 'test.message'})
+            elapsed = time.perf_counter() - start
+            messages = [await layer.receive(channel) for channel in channels]
+            return elapsed, messages
+
+        elapsed, messages = async_to_sync(run)()
+        self.assertGreaterEqual(elapsed, 0.01)
+        self.assertLess(elapsed, 0.03)
+        self.assertEqual([message['type'] for message in messages], ['test.message'] * 3)
+
+    def test_capacity(self):
+        layer = SimulatedChannelLayer(capacity=1)
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.send(channel, {'type': 'test.message'})
+            await layer.send(channel, {'type': 'test.message'})
+
+        with self.assertRaises(ChannelFull):
+            async_to_sync(run)()
+
+
+# 全スレッドのクエリ数のテスト
+class QueryCounterTests(TestCase):
+    def test_count(self):
+        with bench.QueryCounter() as counter:
+            User.objects.count()
+            Topic.objects.count()
+        User.objects.count()
+        self.assertEqual(counter.count, 2)
+
+
+# メトリクスのテスト
+@override_settings(METRICS_TOKEN='secret')
+class MetricsTests(TestCase):
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('test_seconds', 'Test.', ['endpoint'], buckets=(0.1, 1))
+        histogram.labels('a').observe(0.05)
+        histogram.labels('a').observe(0.5)
+        histogram.labels('a').observe(5)
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{endpoint="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{endpoint="a",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{endpoint="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{endpoint="a"} 3', lines)
+
+    # API のリクエストが記録される
+    def test_api_metrics(self):
+        client = Client()
+        client.get(reverse('chatrooms:popular_topics'))
+        response = client.get(reverse('chatrooms:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('chatrooms_api_requests_total{endpoint="popular_topics",status="200"}', body)
+        self.assertIn('chatrooms_api_db_queries_count{endpoint="popular_topics"}', body)
+        # /metrics 自体は記録しない
+        self.assertNotIn('endpoint="metrics"', body)
+
+    # ローカル以外からは見えない
+    def test_not_local(self):
+        response = Client().get(
+            reverse('chatrooms:metrics'), REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 404)
+
+    # プロキシ経由（REMOTE_ADDR が 127.0.0.1）でもトークンがなければ見えない
+    def test_token_required(self):
+        client = Client()
+        self.assertEqual(client.get(reverse('chatrooms:metrics')).status_code, 404)
+        response = client.get(reverse('chatrooms:metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 404)
+
+    # トークンを設定しなければ公開しない
+    @override_settings(METRICS_TOKEN=None)
+    def test_disabled_without_token(self):
+        response = Client().get(reverse('chatrooms:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 404)
+
+
+# 構造化ログのテスト
+class StructuredLogTests(SimpleTestCase):
+    def test_json_formatter(self):
+        record = logging.makeLogRecord({
+            'name': 'chatrooms.consumers', 'levelname': 'INFO', 'msg': 'ws message',
+            'method': 'get_room', 'duration_ms': 1.5})
+        data = json.loads(JsonFormatter().format(record))
+        self.assertEqual(data['event'], 'ws message')
+        self.assertEqual(data['method'], 'get_room')
+        self.assertEqual(data['duration_ms'], 1.5)
+        self.assertNotIn('msg', data)
+
+    # 書き出しは別スレッドで行う
+    def test_queue_handler(self):
+        stream = io.StringIO()
+        handler = QueueStreamHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        log = logging.getLogger('chatrooms.tests.queue')
+        log.propagate = False
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+
+        log.warning('ws disconnect', extra={'code': 1000})
+        handler.stop()
+        data = json.loads(stream.getvalue())
+        self.assertEqual(data['event'], 'ws disconnect')
+        self.assertEqual(data['code'], 1000)
+
+
+# WebSocket の流量制限のテスト
+class RateLimitTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, 3, self.clock)
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+        # 0.5 秒で 1 個増える
+        self.now = 0.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+        # 上限を超えては増えない
+        self.now = 100
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+    @override_settings(WS_RATE_LIMITS={'default': (1, 2), 'get_room': (1, 1)})
+    def test_rate_limiter_per_method(self):
+        limiter = RateLimiter(self.clock)
+        self.assertTrue(limiter.allow('get_room'))
+        self.assertFalse(limiter.allow('get_room'))
+        # 他のメソッドは別のバケット
+        self.assertTrue(limiter.allow('status'))
+        self.assertTrue(limiter.allow('status'))
+        self.assertFalse(limiter.allow('status'))
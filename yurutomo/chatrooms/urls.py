@@ -13,6 +13,7 @@ urlpatterns = [
 
     path('api/populartopics', views.popular_topics, name='popular_topics'),
     path('api/searchtopics', views.search_topics, name='search_topics'),
+    path('api/suggesttopics', views.suggest_topics, name='suggest_topics'),
     path('api/createtopic', views.create_topic, name='create_topic'),
 
     path('api/registermatching', views.register_matching, name='register_matching'),
@@ -21,4 +22,6 @@ urlpatterns = [
     path('api/confirmmatching', views.confirm_matching, name='confirm_matching'),
     path('api/cancelconfirm', views.cancel_confirm, name='cancel_confirm'),
     path('api/getmatchcompleted', views.get_match_completed, name='get_match_completed'),
+
+    path('metrics', views.export_metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,5 +1,7 @@
+import hmac
 import json
 import requests
+from asgiref.sync import async_to_sync
 from django.shortcuts import render
 from django.utils import timezone
 from django.contrib.auth import get_user_model
@@ -7,12 +9,15 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.db.models import Q
 from django.http import QueryDict
+from django.http import Http404
 from django.http.response import JsonResponse, HttpResponse
+from django.conf import settings
 from django.views import generic
 from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 
 from .models import Room, MatchingRecord, Topic
+from . import autocomplete, confirmations, matching, membership, metrics, notifications, popularity, protocol, roster, search
 
 User = get_user_model()
 
@@ -31,6 +36,10 @@ class RoomMatchView(LoginRequiredMixin, generic.TemplateView):
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['push_enabled'] = notifications.is_enabled()
+        context['msgpack_subprotocol'] = protocol.MSGPACK_SUBPROTOCOL
+        context['msgpack_method_codes'] = json.dumps(protocol.METHOD_CODES)
+        context['heartbeat_interval'] = matching.heartbeat_interval()
         return context
 
 
@@ -40,22 +49,17 @@ class RoomView(LoginRequiredMixin, UserPassesTestMixin, generic.TemplateView):
 
     # Room に紐づいたユーザーのみアクセス可能にする
     def test_func(self):
-        user = self.request.user
-        room = get_object_or_404(Room, pk=self.kwargs['pk'])
-        return any([user.pk == member.pk for member in room.users.all()])
+        members = membership.get_members(self.kwargs['pk'])
+        if not members:
+            raise Http404
+        return str(self.request.user.pk) in members
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        room = get_object_or_404(Room, pk=self.kwargs['pk'])
-        context['room'] = room
+        context['room_id'] = self.kwargs['pk']
 
-        members = room.users.all()
-
-        member_names = {str(member.uuid): member.username for member in members}
-        context['member_names'] = json.dumps(member_names)
-
-        member_icons = {str(member.uuid): member.icon_image.url for member in members}
-        context['member_icons'] = json.dumps(member_icons)
+        # member_names, member_icons（キャッシュのメンバー表から）
+        context.update(roster.get_roster(self.kwargs['pk']))
 
         return context
 
@@ -78,12 +82,7 @@ def skyway(request):
 検索API
 """
 def popular_topics(request):
-    params = request.GET
-
-    # TODO
-    # Topicにpopularityカラムを追加
-    result = Topic.objects.all()
-    return JsonResponse({"topics": [topic.data() for topic in result]}, status=200)
+    return JsonResponse({"topics": popularity.get_popular_topics()}, status=200)
 
 
 def search_topics(request):
@@ -92,28 +91,26 @@ def search_topics(request):
     search_text = params.get('search_text')
     if search_text is None or not search_text:
         return JsonResponse({}, status=400)
-    
-    if search_text == '/all':
-        # allコマンド = 全データ
-        query = Q()
-    else:
-        keywords = search_text.split()
-
-        query = Q()
-        for keyword in keywords:
-            query &= (
-                Q(name__icontains=keyword)
-                | Q(name__istartswith=keyword)
-                | Q(name__iendswith=keyword)
-                | Q(tags__name__icontains=keyword)
-                | Q(tags__name__istartswith=keyword)
-                | Q(tags__name__iendswith=keyword)
-            )
-
-    result = Topic.objects.filter(query)
+
+    result = search.search_topics(search_text)
     return JsonResponse({"topics": [topic.data() for topic in result]}, status=200)
 
 
+def suggest_topics(request):
+    params = request.GET
+
+    prefix = params.get('prefix')
+    if prefix is None or not prefix:
+        return JsonResponse({}, status=400)
+
+    try:
+        limit = min(int(params.get('limit', 10)), 50)
+    except ValueError:
+        return JsonResponse({}, status=400)
+
+    return JsonResponse({"topics": autocomplete.suggest(prefix, limit)}, status=200)
+
+
 """
 トピック追加API
 """
@@ -127,6 +124,7 @@ def create_topic(request):
     if not created:
         return JsonResponse({'is_created': False, 'message': 'A topic with the same name already exists.'})
     topic.save()
+    popularity.invalidate()
     return JsonResponse({'is_created': True}, status=200)
 
 
@@ -152,26 +150,14 @@ def register_matching(request):
         return JsonResponse({}, status=400)
 
     # 既に待ち状態であれば登録しない
-    record = MatchingRecord.objects.filter(user=user_id, is_active=True).first()
-    if record is not None:
+    record = MatchingRecord.objects.register(user_id, topic, condition['number'], timezone.now())
+    if record is None:
         return JsonResponse({'is_registered': False}, status=200)
-    
-    submission_time = timezone.now()
-    defaults = {
-        'user': User.objects.get(pk=user_id),
-        'topic': topic,
-        'number': condition['number'],
-        'submission_time': submission_time,
-        'is_active': True,
-        'is_pending': False,
-        'is_confirmed': False
-    }
-
-    record, created = MatchingRecord.objects.update_or_create(
-        user=User.objects.get(pk=user_id),
-        defaults=defaults,
-    )
-    record.save()
+
+    popularity.record_registration(topic.pk)
+
+    # 待ち行列に追加（人数が揃えばここでルームが作られる）
+    matching.enqueue(record)
     return JsonResponse({'is_registered': True}, status=200)
 
 
@@ -181,15 +167,16 @@ def unregister_matching(request):
     json_data = json.loads(request.body)
     user_id = request.user.pk
 
+    # 承認待ちのルームがあればキャンセルする
+    matching.leave_room(user_id)
+
     # 解除するレコードがなければ処理しない
-    record = MatchingRecord.objects.filter(user=user_id, is_active=True).first()
-    if record is None:
+    updated = MatchingRecord.objects.filter(user=user_id).transition(
+        MatchingRecord.ACTIVE_STATES, MatchingRecord.State.INACTIVE)
+    if not updated:
         return JsonResponse({'is_unregistered': False}, status=200)
 
-    record.is_active = False
-    record.is_pending = False
-    record.is_confirmed = False
-    record.save()
+    matching.dequeue(user_id)
     return JsonResponse({'is_unregistered': True}, status=200)
 
 
@@ -199,81 +186,17 @@ def unregister_matching(request):
 def get_match_room(request):
     user_id = request.user.pk
 
-    myrecord = MatchingRecord.objects.filter(
-        user=user_id,
-        is_active=True,
-        is_pending=False,
-        is_confirmed=False).first()
-    if myrecord is None:
+    try:
+        room = matching.get_match_room(user_id)
+    except MatchingRecord.DoesNotExist:
         return JsonResponse({'message': 'valid record is not found.'}, status=404)
 
-    # 入れるルームが既にあればそれを返す
-    room = Room.objects.filter(
-        users=user_id,
-        is_active=True,
-        created_date__gte=myrecord.submission_time).order_by('-created_date').first()
-    if room is not None:
-        # 保留状態にする
-        myrecord.is_pending = True
-        myrecord.save()
-        return JsonResponse({
-            'is_matched': True,
-            'room_id': str(room.pk),
-            'room_url': reverse_lazy('chatrooms:room', kwargs={'pk': room.pk})
-            },
-            status=200)
-
-    """
-    マッチングできるかチェック
-    """
-    # マッチングするものがあるか検索
-    match_records = MatchingRecord.objects.filter(
-        topic=myrecord.topic,
-        number=myrecord.number,
-        is_active=True,
-        is_pending=False,
-        is_confirmed=False).order_by('submission_time')
-
-    # クエリセットが条件の数より少ない場合は不適
-    if match_records.count() < myrecord.number:
-        return JsonResponse({
-            'is_matched': False,
-            'message': 'not matched.'
-            }, status=200)
-
-    # クエリセットを条件の数に制限
-    match_records = match_records[:myrecord.number]
-
-    # クエリセットと関連した User を取得し、idをリスト match_users_id に格納
-    match_users_id = [record.user.pk for record in match_records]
-
-    # 自分が入っていない場合は不適
-    if not user_id in match_users_id:
+    if room is None:
         return JsonResponse({
             'is_matched': False,
             'message': 'not matched.'
             }, status=200)
 
-
-    """
-    ルームを作成
-    """
-    # 既に作られているか
-    room = Room.objects.filter(
-        users=user_id,
-        is_active=True,
-        created_date__gte=myrecord.submission_time).order_by('-created_date').first()
-    if room is None:
-        # ない場合はルーム作成
-        room = Room.objects.create(is_active=True)
-        for user_id in match_users_id:
-            room.users.add(User.objects.get(pk=user_id))
-    
-    
-    # 保留状態にする
-    myrecord.is_pending = True
-    myrecord.save()
-    
     return JsonResponse({
         'is_matched': True,
         'room_id': str(room.pk),
@@ -288,13 +211,24 @@ def confirm_matching(request):
     json_data = json.loads(request.body)
     user_id = request.user.pk
 
-    record = MatchingRecord.objects.filter(user=user_id, is_active=True, is_pending=True, is_confirmed=False).first()
-    if record is None:
+    # Redis のカウンタで承認する（MatchingRecord は後から更新）
+    room_id = json_data.get('room_id')
+    if room_id and confirmations.is_enabled():
+        result = async_to_sync(confirmations.confirm)(room_id, user_id)
+        if result == confirmations.CANCELLED:
+            return JsonResponse({'is_confirmed': False}, status=200)
+        if result != confirmations.UNKNOWN:
+            confirmations.persist(matching.confirm_record, user_id)
+            return JsonResponse({'is_confirmed': True}, status=200)
+
+    updated = MatchingRecord.objects.filter(user=user_id).transition(
+        MatchingRecord.State.PENDING, MatchingRecord.State.CONFIRMED)
+    if not updated:
         return JsonResponse({'is_confirmed': False}, status=200)
-    
-    record.is_confirmed = True
-    record.is_pending = False
-    record.save()
+
+    # 全員そろったら人気度に加算
+    if matching.update_room_status(user_id) == matching.ROOM_COMPLETED:
+        popularity.record_completion(user_id)
     return JsonResponse({'is_confirmed': True}, status=200)
 
 # マッチング承認をキャンセルして再び待ち状態へ
@@ -303,13 +237,23 @@ def cancel_confirm(request):
     json_data = json.loads(request.body)
     user_id = request.user.pk
 
-    record = MatchingRecord.objects.filter(user=user_id, is_active=True, is_pending=False, is_confirmed=True).first()
-    if record is None:
+    from_states = [MatchingRecord.State.CONFIRMED]
+    room_id = json_data.get('room_id')
+    if room_id and confirmations.is_enabled():
+        # カウンタで承認済みなら、confirmations.persist の書き込みがまだで
+        # レコードが保留状態のままのこともある（後から来た書き込みは保留状態にしか効かない）
+        if async_to_sync(confirmations.withdraw)(room_id, user_id):
+            from_states.append(MatchingRecord.State.PENDING)
+
+    # 待ち行列に戻るので MatchingRecord もここで更新する
+    updated = MatchingRecord.objects.filter(user=user_id).transition(
+        from_states, MatchingRecord.State.WAITING)
+    if not updated:
         return JsonResponse({'is_cancelled': False}, status=200)
-    
-    record.is_pending = False
-    record.is_confirmed = False
-    record.save()
+
+    matching.update_room_status(user_id)
+    # 再び待ち行列に並ぶ
+    matching.enqueue(MatchingRecord.objects.get(user=user_id))
     return JsonResponse({'is_cancelled': True}, status=200)
 
 # 他のユーザーがマッチングを承認したか
@@ -326,63 +270,68 @@ def get_match_completed(request):
             'message': 'invalid room id.'
             }, status=400)
     
-    room = Room.objects.filter(pk=room_id, users=user_id).first()
-    if room is None:
+    status = None
+    # Redis のカウンタがあればそれを使う
+    if confirmations.is_enabled():
+        result = async_to_sync(confirmations.get_status)(room_id, user_id)
+        status = matching.COUNTER_STATUS.get(result)
+    if status is None:
+        status = matching.get_room_status(room_id, user_id)
+    if status is None:
         return JsonResponse({
             'is_completed': False,
             'is_cancelled': False,
             'message': 'invalid room id.'
             }, status=400)
 
-    users = room.users.all()
-
-    for user in users:
-        try:
-            record = MatchingRecord.objects.filter(user=user.pk).first()
-        except User.matchingrecord.RelatedObjectDoesNotExist as ex:
-            print('User.matchingrecord.RelatedObjectDoesNotExist')
-            return JsonResponse({
-                'is_completed': False,
-                'is_cancelled': False,
-                'message': 'error',
-                'error': ex
-                }, status=500)
-        except Exception as ex:
-            return JsonResponse({
-                'is_completed': False,
-                'is_cancelled': False,
-                'message': 'error',
-                'error': ex
-                }, status=500)
-        
-        # レコードが見つからない場合
-        if record is None:
-            return JsonResponse({
-                'is_completed': False,
-                'is_cancelled': False,
-                'message': 'record is not found.'
-                }, status=404)
-        
-        # キャンセル処理
-        if not record.is_active:
-            room.is_active = False
-            room.save()
-            return JsonResponse({
-                'is_completed': False,
-                'is_cancelled': True,
-                'message': 'matching cancelled.'
-                }, status=200)
-
-        # 未完了
-        if not record.is_confirmed:
-            return JsonResponse({
-                'is_completed': False,
-                'is_cancelled': False,
-                'message': 'not confirmed.'
-                }, status=200)
-    
+    # レコードが見つからない場合
+    if status == matching.ROOM_MISSING:
+        return JsonResponse({
+            'is_completed': False,
+            'is_cancelled': False,
+            'message': 'record is not found.'
+            }, status=404)
+
+    # キャンセル処理
+    if status == matching.ROOM_CANCELLED:
+        matching.close_rooms(room_id)
+        return JsonResponse({
+            'is_completed': False,
+            'is_cancelled': True,
+            'message': 'matching cancelled.'
+            }, status=200)
+
+    # 未完了
+    if status == matching.ROOM_PENDING:
+        return JsonResponse({
+            'is_completed': False,
+            'is_cancelled': False,
+            'message': 'not confirmed.'
+            }, status=200)
+
     return JsonResponse({
         'is_completed': True,
         'is_cancelled': False,
         'message': 'matching done.'
         }, status=200)
+
+
+# メトリクス（Prometheus のテキスト形式）
+# METRICS_TOKEN を設定したときだけ公開し、Authorization: Bearer <METRICS_TOKEN> を付けたリクエストにだけ返す。
+# nginx の裏では REMOTE_ADDR が常に 127.0.0.1 になるので、METRICS_ALLOWED_IPS だけには頼らない。
+# 外からは nginx でも閉じておく:
+#
+#     location = /metrics {
+#         deny all;
+#     }
+def export_metrics(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        raise Http404
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        raise Http404
+    scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.strip(), token):
+        raise Http404
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
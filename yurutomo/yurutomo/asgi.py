@@ -23,7 +23,12 @@ from channels.auth import AuthMiddlewareStack
 
 from chatrooms.routing import websocket_urlpatterns
 
-application = ProtocolTypeRouter({
+from chatrooms.reaper import ReaperMiddleware
+from yurutomo.dbpool import ExecutorMiddleware
+
+# DB 処理のスレッド数（= DB 接続数）を ASGI_THREAD_POOL_SIZE に制限する
+# 応答のなくなったマッチングを定期的に無効にする
+application = ExecutorMiddleware(ReaperMiddleware(ProtocolTypeRouter({
     'http': django_asgi_app,
     'websocket': AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
-})
+})))
@@ -0,0 +1,131 @@
+"""
+ASGI ワーカーのスレッドプールと DB 接続
+
+Django の DB 接続はスレッドごとに作られるので、同時に DB を使うスレッド数が
+そのまま Postgres への接続数になる。
+database_sync_to_async(thread_sensitive=False) はイベントループの既定の executor で
+動くので、それを settings.ASGI_THREAD_POOL_SIZE スレッドの executor に差し替えて
+接続数の上限にする。あふれた処理は executor の待ち行列に並ぶ。
+CONN_MAX_AGE で接続を使い回すので、スレッドごとの接続がそのまま接続プールになる。
+
+stats() で executor と接続の状態を返す（/metrics にも asgi_db_pool_* として出る）。
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+from chatrooms.metrics import registry
+
+
+def pool_size():
+    return getattr(settings, 'ASGI_THREAD_POOL_SIZE', 8)
+
+
+class BoundedExecutor(ThreadPoolExecutor):
+    """ 実行中・待ち中の処理数を数える ThreadPoolExecutor """
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix='asgi-db')
+        self._stats_lock = threading.Lock()
+        self.submitted = 0
+        self.running = 0
+        self.completed = 0
+        self.peak_running = 0
+        self.peak_queued = 0
+
+    def _run(self, fn, args, kwargs):
+        with self._stats_lock:
+            self.running += 1
+            self.peak_running = max(self.peak_running, self.running)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.running -= 1
+                self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self.submitted += 1
+            queued = self.submitted - self.running - self.completed
+            self.peak_queued = max(self.peak_queued, queued)
+        return super().submit(self._run, fn, args, kwargs)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'size': self._max_workers,
+                'threads': len(self._threads),
+                'submitted': self.submitted,
+                'running': self.running,
+                'queued': self.submitted - self.running - self.completed,
+                'completed': self.completed,
+                'peak_running': self.peak_running,
+                'peak_queued': self.peak_queued,
+            }
+
+
+_lock = threading.Lock()
+_executor = None
+# executor を設定したイベントループ
+_loops = set()
+
+# 開いた DB 接続の数（プロセス全体）
+_connections_opened = 0
+
+
+@connection_created.connect
+def _count_connection(sender, connection, **kwargs):
+    global _connections_opened
+    with _lock:
+        _connections_opened += 1
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = BoundedExecutor(pool_size())
+        return _executor
+
+
+def install(loop=None):
+    """ イベントループの既定の executor を差し替える """
+    loop = loop or asyncio.get_event_loop()
+    if id(loop) in _loops:
+        return
+    loop.set_default_executor(get_executor())
+    _loops.add(id(loop))
+
+
+def stats():
+    executor = _executor
+    result = executor.stats() if executor is not None else {'size': pool_size()}
+    result['connections_opened'] = _connections_opened
+    result['conn_max_age'] = settings.DATABASES['default'].get('CONN_MAX_AGE', 0)
+    return result
+
+
+for _key, _documentation in (
+        ('size', 'Threads allowed in the ASGI DB executor.'),
+        ('threads', 'Threads started by the ASGI DB executor.'),
+        ('running', 'Jobs running in the ASGI DB executor.'),
+        ('queued', 'Jobs waiting for an ASGI DB executor thread.'),
+        ('peak_queued', 'Most jobs that waited for an ASGI DB executor thread at once.'),
+        ('connections_opened', 'DB connections opened by this process.')):
+    registry.gauge('asgi_db_pool_' + _key, _documentation).labels().set_function(
+        lambda key=_key: stats().get(key, 0))
+
+
+class ExecutorMiddleware:
+    """ 最初の接続を受けたときに executor を差し替える ASGI ミドルウェア """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        install(asyncio.get_running_loop())
+        return await self.app(scope, receive, send)
@@ -0,0 +1,70 @@
+"""
+MEDIA_ROOT のファイルの配信
+
+ファイルの中身は Web サーバーに送らせる（ASGI ワーカーで画像のバイト列を流さない）。
+settings.MEDIA_SENDFILE で送り方を選ぶ。
+  - 'x-accel-redirect': nginx の internal な location（MEDIA_ACCEL_REDIRECT_PREFIX）へ転送する
+  - 'x-sendfile': Apache の mod_xsendfile などにファイルのパスを渡す
+  - None: Django が返す（開発用）
+
+内容のハッシュ名のファイルと、?v= が今の内容のハッシュと一致する URL は
+内容が変わらないので、期限なし（immutable）でキャッシュさせる。
+アップロードされたアイコンの元の画像は配信しない（accounts.icons.is_public）。
+
+    # nginx
+    location /protected-media/ {
+        internal;
+        alias /path/to/media/;
+    }
+"""
+import mimetypes
+import os
+import posixpath
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control
+
+from accounts import icons
+from accounts.storage import icon_storage
+
+
+# 1 年
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+
+def _sendfile_response(path, fullpath):
+    backend = getattr(settings, 'MEDIA_SENDFILE', None)
+    if backend == 'x-accel-redirect':
+        response = HttpResponse()
+        prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix + quote(path)
+    elif backend == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = fullpath
+    else:
+        return FileResponse(open(fullpath, 'rb'))
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    response['Content-Type'] = content_type or 'application/octet-stream'
+    return response
+
+
+def serve(request, path):
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not icons.is_public(path) or not os.path.isfile(fullpath):
+        raise Http404
+
+    response = _sendfile_response(path, fullpath)
+    if icon_storage.is_immutable(path, request.GET.get('v')):
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'MEDIA_CACHE_MAX_AGE', 60 * 60))
+    return response
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'sass_processor',
 
     'accounts.apps.AccountsConfig',
@@ -51,6 +52,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # API のクエリ数・時間を記録する（セッション・認証のクエリも数えるので先頭に置く）
+    'chatrooms.middleware.ApiMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -92,6 +95,8 @@ DATABASES = {
         'PASSWORD': '****',
         'HOST': 'localhost',
         'PORT': '',
+        # スレッドごとの接続を使い回す（秒）
+        'CONN_MAX_AGE': 60,
     }
 }
 # Password validation
@@ -143,8 +148,16 @@ SASS_TEMPLATE_EXTS = ['.html', '.haml']
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# メディアの中身の送り方（yurutomo.media）: 'x-accel-redirect'（nginx）/ 'x-sendfile' / None（Django）
+MEDIA_SENDFILE = None if DEBUG else 'x-accel-redirect'
+# X-Accel-Redirect で転送する nginx の internal な location
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+# ハッシュ名でないメディアのキャッシュ期間（秒）
+MEDIA_CACHE_MAX_AGE = 60 * 60
 
 USER_ICON_UPLOAD_DIR = 'uploads/icon/'
+# アイコンの縮小を行うスレッド数（accounts.icons）
+USER_ICON_WORKERS = 1
 
 # Redirect after login
 LOGIN_URL = 'accounts:login'
@@ -161,9 +174,81 @@ ACTIVATION_TIMEOUT_SECONDS = 60*60*24
 # Channels
 ASGI_APPLICATION = 'yurutomo.asgi.application'
 
+# チャンネルレイヤーの Redis
+# 複数指定すると channels_redis がグループ名・チャンネル名の consistent hash でシャードに振り分ける
+# （ユーザーごとのグループもルームのグループも各シャードに分散する）
+# 台数を変えると振り分け先が変わるので、全 ASGI ワーカーを同時に再起動すること
+# 例: CHANNEL_REDIS_HOSTS=redis1:6379,redis2:6379,redis3:6379
+CHANNEL_REDIS_HOSTS = [
+    (host, int(port)) for host, port in (
+        address.rsplit(':', 1)
+        for address in os.environ.get('CHANNEL_REDIS_HOSTS', '127.0.0.1:6379').split(',')
+    )
+]
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {'hosts': [('127.0.0.1', 6379)], },
+        'CONFIG': {'hosts': CHANNEL_REDIS_HOSTS, },
+    },
+}
+
+# マッチング状態を WebSocket でプッシュ通知する（False ならクライアントはポーリング）
+MATCHING_PUSH_NOTIFICATIONS = True
+
+# ルームの承認状態を Redis のカウンタで管理する
+ROOM_CONFIRMATION_COUNTERS = True
+# カウンタの有効期限（秒）
+ROOM_CONFIRMATION_TTL = 600
+
+# クライアントから MATCHING_RECORD_TTL 秒応答がなければマッチングを無効にする
+MATCHING_RECORD_TTL = 120
+# クライアントがハートビートを送る間隔（秒）。last_seen もこの間隔でしか更新しない
+MATCHING_HEARTBEAT_INTERVAL = 30
+# 応答のなくなったマッチングを掃除する間隔（秒）。0 なら掃除しない
+MATCHING_REAPER_INTERVAL = 30
+
+# トピック検索の最大件数
+TOPIC_SEARCH_LIMIT = 20
+
+# 人気トピックの件数とキャッシュの有効期限（秒）
+POPULAR_TOPICS_LIMIT = 20
+POPULAR_TOPICS_CACHE_TIMEOUT = 60
+
+# ASGI ワーカーで DB 処理を行うスレッド数
+# スレッドごとに DB 接続を持つので、1 プロセスあたりの DB 接続数は
+# ASGI_THREAD_POOL_SIZE + 2（HTTP のビュー用と confirmations.persist 用）までになる
+# Postgres の max_connections をプロセス数で割った値より小さくすること
+ASGI_THREAD_POOL_SIZE = 8
+
+# /metrics を見られる IP アドレス
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# /metrics に必要なトークン（Authorization: Bearer <token>）。設定しなければ /metrics は公開しない
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+
+# ログ
+# chatrooms のログは 1 行の JSON にして、別スレッドで書き出す（イベントループで stderr を待たない）
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'chatrooms.logs.JsonFormatter'},
     },
+    'handlers': {
+        'queue': {'class': 'chatrooms.logs.QueueStreamHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'chatrooms': {'handlers': ['queue'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+# WebSocket のメッセージごとのログを出す割合（メトリクスは全件記録する）
+WS_LOG_SAMPLE_RATE = 0.01
+
+# WebSocket のメソッドごとの流量制限（1 接続あたり）: (1 秒に増えるトークン数, 上限)
+WS_RATE_LIMITS = {
+    'default': (5, 10),
+    'start_wait': (1, 3),
+    'quit_wait': (1, 3),
+    'get_room': (2, 5),
 }
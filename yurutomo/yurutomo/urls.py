@@ -14,9 +14,10 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
-from django.conf.urls.static import static
+
+from yurutomo import media
 
 # adminsite のサイドバーを無効にする
 admin.site.enable_nav_sidebar = False
@@ -25,8 +26,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('chatrooms.urls')),
     path('accounts/', include('accounts.urls')),
-    path('accounts/', include('django.contrib.auth.urls'))
-]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    path('accounts/', include('django.contrib.auth.urls')),
+    # ファイルの中身は MEDIA_SENDFILE で Web サーバーに送らせる
+    re_path(r'^{}(?P<path>.+)$'.format(settings.MEDIA_URL.lstrip('/')), media.serve, name='media'),
+]
\ No newline at end of file